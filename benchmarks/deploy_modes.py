@@ -0,0 +1,97 @@
+"""
+Compares the time to deploy commands with each script and execution mode,
+against the simulated router, with a delay for each commit like a real router
+
+Run from the repository root with: python -m benchmarks.deploy_modes
+"""
+import argparse
+import tempfile
+import time
+from typing import List
+
+from ubiquiti_config_generator.github import deploy_helper, deployment
+from ubiquiti_config_generator.github.deployment_metadata import DeployMetadata
+from ubiquiti_config_generator.messages import db
+from ubiquiti_config_generator.router_simulator import RouterSimulator
+
+MODES = {
+    "Files": {},
+    "Files, compact": {"compact-command-scripts": True},
+    "Session": {"execution-mode": "session"},
+    "Session, compact": {
+        "execution-mode": "session",
+        "compact-command-scripts": True,
+    },
+    "Pipelined": {"execution-mode": "pipelined"},
+}
+
+
+def generate_phases(host_count: int, phase_count: int) -> List[List[str]]:
+    """
+    Generates phases of commands adding hosts to address groups
+    """
+    return [
+        [
+            f"set firewall group address-group phase{phase} address "
+            f"10.{phase}.{host // 256 % 256}.{host % 256}"
+            for host in range(host_count // phase_count)
+        ]
+        for phase in range(phase_count)
+    ]
+
+
+def measure(name: str, options: dict, phases: List[List[str]], commit_delay: float):
+    """
+    Prints the time to deploy the phases in a mode
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        simulator = RouterSimulator(directory + "/router", commit_delay)
+        deploy_config = {
+            "auto-rollback-on-failure": True,
+            "reboot-after-minutes": None,
+            "save-after-commit": False,
+            "script-cfg-path": simulator.cfg_wrapper_path,
+            "router": {"command-file-path": simulator.directory},
+            **options,
+        }
+        deploy_helper.get_router_connection = lambda config: simulator.connect()
+        try:
+            start = time.perf_counter()
+            succeeded = deployment.load_and_execute_config_changes(
+                phases, DeployMetadata("abc", "def", "", "", deploy_config), ""
+            )
+            elapsed = time.perf_counter() - start
+        finally:
+            simulator.close()
+
+        script_size = sum([len(data) for data in simulator.files.values()])
+        print(
+            f"{name}: {elapsed:.2f}s, {'succeeded' if succeeded else 'failed'}, "
+            f"{len(simulator.commits)} commits taking "
+            f"{sum([commit.seconds for commit in simulator.commits]):.2f}s, "
+            f"{script_size / 1024:.0f} KiB of scripts"
+        )
+
+
+def main():
+    """
+    Runs the benchmark
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hosts", type=int, default=1000)
+    parser.add_argument("--phases", type=int, default=4)
+    parser.add_argument("--commit-delay", type=float, default=2)
+    arguments = parser.parse_args()
+
+    # Deployment logs are not needed
+    db.add_deployment_log = lambda *args, **kwargs: True
+    db.add_deployment_logs = lambda *args, **kwargs: True
+
+    phases = generate_phases(arguments.hosts, arguments.phases)
+    print(f"{sum([len(phase) for phase in phases])} commands in {len(phases)} phases")
+    for name, options in MODES.items():
+        measure(name, options, phases, arguments.commit_delay)
+
+
+if __name__ == "__main__":
+    main()
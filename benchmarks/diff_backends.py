@@ -0,0 +1,99 @@
+"""
+Compares the time and memory of the indexed and sorted configuration diffs,
+using synthetic configurations with many hosts
+
+Run from the repository root with: python -m benchmarks.diff_backends
+"""
+import argparse
+import time
+import tracemalloc
+from typing import Callable, List
+
+from ubiquiti_config_generator.github import config_difference
+
+
+def generate_commands(host_count: int, changed_every: int = 0) -> List[str]:
+    """
+    Generates the commands a configuration with this many hosts would have,
+    changing the address of every Nth host if given
+    """
+    commands = []
+    for host in range(host_count):
+        network = f"network{host // 250}"
+        address = f"10.{host // 65536}.{host // 256 % 256}.{host % 256}"
+        if changed_every and host % changed_every == 0:
+            address = f"10.255.{host // 256 % 256}.{host % 256}"
+
+        commands.extend(
+            [
+                f"firewall group address-group {network}-hosts address {address}",
+                f"service dhcp-server shared-network-name {network} subnet "
+                f"10.0.0.0/8 static-mapping host{host} ip-address {address}",
+                f"service dhcp-server shared-network-name {network} subnet "
+                f"10.0.0.0/8 static-mapping host{host} mac-address "
+                f"00:00:00:{host // 65536 % 256:02x}:{host // 256 % 256:02x}:"
+                f"{host % 256:02x}",
+            ]
+        )
+        rule = f"firewall name {network}-IN rule {host % 250 * 10 + 10} "
+        commands.extend(
+            [
+                rule + "action accept",
+                rule + f"description 'Allow host{host}'",
+                rule + "protocol tcp",
+                rule + f"destination address {address}",
+                rule + "destination port 443",
+            ]
+        )
+
+    return commands
+
+
+def measure(name: str, diff: Callable, current: List[str], previous: List[str]):
+    """
+    Prints the time and peak memory of a diff
+    Memory is measured separately, since tracing it slows everything down
+    """
+    start = time.perf_counter()
+    difference = diff(current, previous)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    diff(current, previous)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    print(
+        f"{name}: {elapsed:.2f}s, {peak / 1024 / 1024:.1f} MiB peak, "
+        f"{len(difference.added)} added, {len(difference.removed)} removed, "
+        f"{len(difference.changed)} changed"
+    )
+
+
+def main():
+    """
+    Runs the benchmark
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hosts", type=int, default=10000)
+    parser.add_argument("--changed-every", type=int, default=100)
+    arguments = parser.parse_args()
+
+    previous = generate_commands(arguments.hosts)
+    current = generate_commands(arguments.hosts, arguments.changed_every)
+    print(f"{len(current)} current and {len(previous)} previous commands")
+
+    measure(
+        "Indexed",
+        lambda current, previous: config_difference.diff_command_indexes(
+            config_difference.index_commands(current),
+            config_difference.index_commands(previous),
+        ),
+        current,
+        previous,
+    )
+    measure("Sorted", config_difference.diff_sorted_commands, current, previous)
+
+
+if __name__ == "__main__":
+    main()
@@ -372,6 +372,7 @@ def test_load_sample_config():
     for command_segment in [
         external_address,
         *port_groups,
+        node.address_groups,
         global_settings,
         nat,
         *networks,
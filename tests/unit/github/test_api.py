@@ -272,6 +272,36 @@ def test_checkout(monkeypatch, capsys):
     assert printed.out == "Checking out abc123 in a-repo\n", "Output printed"
 
 
+def test_get_changed_files(monkeypatch):
+    """
+    .
+    """
+
+    # pylint: disable=unused-argument
+    def run(command, **kwargs):
+        """
+        .
+        """
+        assert command == [
+            "git",
+            "diff",
+            "--name-only",
+            "--no-renames",
+            "abc",
+            "def",
+        ], "Diff command correct"
+        assert kwargs["cwd"] == "a-repo", "Diff run in repo"
+        return subprocess.CompletedProcess(
+            command, 0, "networks/lan/config.yaml\nnat/5000.yaml\n", ""
+        )
+
+    monkeypatch.setattr(subprocess, "run", run)
+    assert api.get_changed_files("a-repo", "abc", "def") == [
+        "networks/lan/config.yaml",
+        "nat/5000.yaml",
+    ], "Changed files returned"
+
+
 def test_summarize_deploy_config():
     """
     .
@@ -4,10 +4,13 @@ Tests the Github API functionality
 import time
 from typing import Union
 
-from ubiquiti_config_generator import root_parser, file_paths
+from ubiquiti_config_generator import firewall_analysis, root_parser, file_paths
 from ubiquiti_config_generator.github import checks, push, api, deploy_helper
 from ubiquiti_config_generator.github.api import GREEN_CHECK, RED_CROSS
 from ubiquiti_config_generator.messages import db
+from ubiquiti_config_generator.messages.command_snapshot import CommandSnapshot
+from ubiquiti_config_generator.nodes.firewall import Firewall
+from ubiquiti_config_generator.rule_optimizer import RuleOptimization
 from ubiquiti_config_generator.testing_utils import counter_wrapper
 
 
@@ -180,22 +183,34 @@ def test_get_pr_comment(monkeypatch):
     )
     # This is mocked via the diff configurations, so can make this a no-op
     # pylint: disable=unused-argument
-    monkeypatch.setattr(root_parser.RootNode, "get_commands", lambda self: ([], []))
+    monkeypatch.setattr(
+        root_parser.RootNode, "get_commands", lambda self, network_names=None: ([], [])
+    )
     assert checks.get_pr_comment(
-        {},
+        {"apply-difference-only": True},
         root_parser.RootNode(None, [], None, [], None),
         root_parser.RootNode(None, [], None, [], None),
     ) == (
-        "deploy config\n"
-        "## Commands added:\n\n"
-        "- c 3\n"
-        "- d 7\n"
-        "## Commands removed:\n\n"
-        "- d 4\n"
-        "- e 6\n"
-        "## Commands changed:\n\n"
+        "deploy config\n\n"
+        "## Summary\n\n"
+        "2 added, 2 removed, 1 changed across 4 areas\n"
+        "Estimated 1 commit phases and 5 router round trips\n\n"
+        "| Area | Added | Removed | Changed |\n"
+        "|---|---|---|---|\n"
+        "| C | 1 | 0 | 0 |\n"
+        "| D | 1 | 1 | 0 |\n"
+        "| E | 0 | 1 | 0 |\n"
+        "| A | 0 | 0 | 1 |\n\n"
+        "### C\n\n"
+        "- Added: c 3\n\n"
+        "### D\n\n"
+        "- Added: d 7\n"
+        "- Removed: d 4\n\n"
+        "### E\n\n"
+        "- Removed: e 6\n\n"
+        "### A\n\n"
         # No newline for last line
-        "- a 1"
+        "- Changed: a 1"
     ), "PR comment generated as expected for all categories"
 
     only_add_differences = deploy_helper.ConfigDifference()
@@ -205,13 +220,93 @@ def test_get_pr_comment(monkeypatch):
         deploy_helper, "diff_configurations", lambda branch, prod: only_add_differences
     )
     assert checks.get_pr_comment(
-        {},
+        {"apply-difference-only": True, "execution-mode": "session"},
         root_parser.RootNode(None, [], None, [], None),
         root_parser.RootNode(None, [], None, [], None),
     ) == (
-        "deploy config\n" "## Commands added:\n\n" "- a 5"
+        "deploy config\n\n"
+        "## Summary\n\n"
+        "1 added, 0 removed, 0 changed across 1 areas\n"
+        "Estimated 0 commit phases and 4 router round trips\n\n"
+        "| Area | Added | Removed | Changed |\n"
+        "|---|---|---|---|\n"
+        "| A | 1 | 0 | 0 |\n\n"
+        "### A\n\n"
+        "- Added: a 5"
     ), "Only added returned for command summary"
 
+    monkeypatch.setattr(
+        root_parser.RootNode,
+        "get_commands",
+        lambda self, network_names=None: ([], ["a 5", "b 2"]),
+    )
+    snapshot = CommandSnapshot("abc", ["b 3"], {"b": "3"}, [], [])
+    assert checks.get_pr_comment(
+        {"apply-difference-only": True},
+        root_parser.RootNode(None, [], None, [], None),
+        None,
+        snapshot,
+    ).endswith(
+        "### A\n\n- Added: a 5\n\n### B\n\n- Changed: b 2"
+    ), "Production snapshot compared against"
+
+    assert (
+        checks.get_pr_comment(
+            {"apply-difference-only": True, "skip-unchanged-deployments": True},
+            root_parser.RootNode(None, [], None, [], None),
+            None,
+            CommandSnapshot("abc", ["a 5", "b 2"], {}, [], []),
+        )
+        == "deploy config\n\nNo configuration changes"
+    ), "Unchanged configuration not compared"
+
+    monkeypatch.setattr(
+        firewall_analysis,
+        "analyze_configuration",
+        lambda root_node: [
+            firewall_analysis.FirewallAnalysis(
+                "lan-IN",
+                [firewall_analysis.RuleFinding(20, firewall_analysis.REDUNDANT, [10])],
+            )
+        ],
+    )
+    assert checks.get_pr_comment(
+        {"apply-difference-only": True, "analyze-firewall-rules": True},
+        root_parser.RootNode(None, [], None, [], None),
+        None,
+        snapshot,
+    ).endswith(
+        "- Changed: b 2\n\n"
+        "## Firewall rule findings\n\n"
+        "- Firewall lan-IN rule 20 is redundant with rule 10, "
+        "which has the same action"
+    ), "Firewall rule findings listed"
+
+    firewall = Firewall("lan-IN", "in", "lan", ".", rules=[])
+    setattr(firewall, "optimize-rules", "enable")
+    monkeypatch.setattr(firewall, "optimize_rules", lambda: RuleOptimization([], [], 3))
+
+    # pylint: disable=too-few-public-methods
+    class Network:
+        """
+        Mocks a network
+        """
+
+        firewalls = [firewall]
+
+    assert (
+        "- Changed: b 2\n\n"
+        "## Firewall rule optimizations\n\n"
+        "- Firewall lan-IN: Combined 3 rules into 0, saving 3\n\n"
+        "3 rules saved in total\n\n"
+        "## Firewall rule findings"
+    ) in checks.get_pr_comment(
+        {"apply-difference-only": True, "analyze-firewall-rules": True},
+        root_parser.RootNode(None, [], None, [Network()], None),
+        None,
+        snapshot,
+    ), "Rules saved by optimization shown before findings"
+
 
 # pylint: disable=too-many-locals,too-many-statements
 def test_process_check_run(monkeypatch, capsys):
@@ -0,0 +1,122 @@
+"""
+Test summarizing differences for PR comments
+"""
+from ubiquiti_config_generator.github import comment_summary, deploy_helper
+from ubiquiti_config_generator.rule_optimizer import RuleOptimization
+
+
+def test_get_command_area():
+    """
+    .
+    """
+    for command_key, area in [
+        ("firewall name lan-IN rule 10 action", "Firewall lan-IN"),
+        ("firewall group port-group web port", "Port group web"),
+        ("firewall group address-group admin address", "Address group admin"),
+        ("service nat rule 5000 type", "NAT"),
+        (
+            "service dhcp-server shared-network-name lan subnet 10.0.0.0/24 lease",
+            "DHCP network lan",
+        ),
+        ("interfaces ethernet eth1 vif 10 address", "Interface eth1"),
+        ("system host-name", "System"),
+    ]:
+        assert comment_summary.get_command_area(command_key) == area, area
+
+
+def test_estimate_round_trips():
+    """
+    .
+    """
+    assert comment_summary.estimate_round_trips([], {}) == (
+        0,
+        0,
+    ), "Nothing to deploy"
+    phases = [[], ["a"], ["b"]]
+    assert comment_summary.estimate_round_trips(phases, {}) == (
+        2,
+        7,
+    ), "Empty delete phase still uploaded over SFTP"
+    assert comment_summary.estimate_round_trips(
+        phases, {"router": {"upload-mode": "tar"}}
+    ) == (2, 2), "Every script uploaded in one tar stream"
+    assert comment_summary.estimate_round_trips(
+        phases, {"execution-mode": "session"}
+    ) == (2, 4), "One session script uploaded"
+    assert comment_summary.estimate_round_trips(
+        phases, {"execution-mode": "pipelined", "router": {"upload-mode": "tar"}}
+    ) == (2, 3), "Only the first upload waited on when pipelined"
+    assert comment_summary.estimate_round_trips(
+        [[]], {"execution-mode": "pipelined"}
+    ) == (0, 0), "Nothing run when pipelined without commands"
+
+
+def test_render_summary():
+    """
+    .
+    """
+    differences = deploy_helper.diff_configurations(
+        [f"firewall name lan-IN rule {number} action accept" for number in range(20)]
+        + ["system host-name router"],
+        ["system host-name old-router"],
+    )
+    areas = comment_summary.group_differences(differences)
+    assert [area.name for area in areas] == [
+        "Firewall lan-IN",
+        "System",
+    ], "Areas grouped"
+    assert areas[0].count() == 20 and areas[0].count("added") == 20, "Counted"
+
+    summary = comment_summary.render_summary(areas, (2, 4))
+    assert summary.startswith(
+        "## Summary\n\n"
+        "20 added, 0 removed, 1 changed across 2 areas\n"
+        "Estimated 2 commit phases and 4 router round trips\n"
+    ), "Summary header rendered"
+    assert (
+        "### Firewall lan-IN\n\n<details><summary>20 commands</summary>\n\n" in summary
+    ), "Large area collapsed"
+    assert summary.endswith(
+        "\n</details>\n\n### System\n\n- Changed: system host-name router"
+    ), "Small area not collapsed"
+
+    bounded = comment_summary.render_summary(areas, (2, 4), 600)
+    assert len(bounded) <= 600, "Summary kept within maximum length"
+    assert bounded.count("<details>") == bounded.count("</details>"), "Details closed"
+    assert bounded.endswith("more commands not shown_"), "Omitted commands noted"
+
+
+def test_render_rule_optimizations():
+    """
+    .
+    """
+    assert (
+        comment_summary.render_rule_optimizations([]) == ""
+    ), "Nothing without optimized firewalls"
+    assert comment_summary.render_rule_optimizations(
+        [
+            ("lan-IN", RuleOptimization([], [], 4)),
+            ("wan-IN", RuleOptimization([], [], 2)),
+        ]
+    ) == (
+        "## Firewall rule optimizations\n\n"
+        "- Firewall lan-IN: Combined 4 rules into 0, saving 4\n"
+        "- Firewall wan-IN: Combined 2 rules into 0, saving 2\n\n"
+        "6 rules saved in total"
+    ), "Rules saved listed and totalled"
+
+
+def test_render_rule_findings():
+    """
+    .
+    """
+    assert comment_summary.render_rule_findings([]) == "", "Nothing without findings"
+    assert comment_summary.render_rule_findings(["a", "b"]) == (
+        "## Firewall rule findings\n\n- a\n- b"
+    ), "Findings listed"
+
+    rendered = comment_summary.render_rule_findings(
+        [str(index) for index in range(comment_summary.MAX_RULE_FINDINGS + 5)]
+    )
+    assert rendered.count("\n- ") == comment_summary.MAX_RULE_FINDINGS, "Truncated"
+    assert rendered.endswith("_5 more findings_"), "Findings left out counted"
@@ -2,14 +2,15 @@
 Check config difference works as expected
 """
 
-from ubiquiti_config_generator.github import deploy_helper
+from ubiquiti_config_generator.github import config_difference
+from ubiquiti_config_generator.testing_utils import counter_wrapper
 
 
 def test_atomic_operations():
     """
     .
     """
-    difference = deploy_helper.ConfigDifference()
+    difference = config_difference.ConfigDifference()
 
     difference.add({"a": 1})
     difference.remove({"b": 2})
@@ -36,7 +37,7 @@ def test_compare():
     """
     .
     """
-    diff = deploy_helper.ConfigDifference()
+    diff = config_difference.ConfigDifference()
 
     commands = {"a": 1, "b": 2, "d": 4, "e": 5}
 
@@ -58,3 +59,89 @@ def test_compare():
     assert diff.removed == {"c": 7}, "Removed set"
     assert diff.changed == {"a": 1, "b": 2}, "Changed set"
     assert diff.preserved == {"e": 5}, "Preserved set"
+
+
+def test_ordered_value_set():
+    """
+    .
+    """
+    values = config_difference.OrderedValueSet(["80", "443"])
+    values.append("8080")
+    values.extend(["22"])
+    values += ["53"]
+
+    assert values == ["80", "443", "8080", "22", "53"], "Order preserved"
+    assert "8080" in values and "53" in values, "Appended values found"
+    assert "25" not in values, "Missing value not found"
+
+    diff = config_difference.ConfigDifference()
+    diff.compare_list_commands({"ports": ["80", "443"]}, {"ports": ["443", "22"]})
+    assert isinstance(
+        diff.added["ports"], config_difference.OrderedValueSet
+    ), "Set used"
+    assert diff.added == {"ports": ["80"]}, "Added port"
+    assert diff.preserved == {"ports": ["443"]}, "Preserved port"
+    assert diff.removed == {"ports": ["22"]}, "Removed port"
+
+
+def test_diff_sorted_commands(monkeypatch):
+    """
+    .
+    """
+    previous_commands = [
+        "system host-name router",
+        "firewall group address-group unix address 10.0.0.1",
+        "firewall group address-group unix address 10.0.0.2",
+        "firewall name lan-IN rule 10 action accept",
+        "firewall name lan-IN description 'LAN in'",
+        "service ssh port 22",
+        "service dns forwarding listen-on eth1",
+    ]
+    current_commands = [
+        "firewall name lan-IN rule 10 action drop",
+        "system host-name router",
+        "firewall group address-group unix address 10.0.0.3",
+        "firewall group address-group unix address 10.0.0.1",
+        "firewall name lan-IN description 'LAN in'",
+        "service dns forwarding listen-on eth1",
+        "service dns forwarding listen-on eth2",
+        "interfaces ethernet eth1 description 'LAN'",
+    ]
+
+    sorted_difference = config_difference.diff_sorted_commands(
+        current_commands, previous_commands
+    )
+    index_difference = config_difference.diff_command_indexes(
+        config_difference.index_commands(current_commands),
+        config_difference.index_commands(previous_commands),
+    )
+    for category in ["added", "removed", "changed", "preserved"]:
+        assert list(getattr(sorted_difference, category).items()) == list(
+            getattr(index_difference, category).items()
+        ), ("Same differences in the same order: " + category)
+
+    assert sorted_difference.added == {
+        "firewall group address-group unix address": ["10.0.0.3"],
+        "service dns forwarding listen-on": ["eth2"],
+        "interfaces ethernet eth1 description": "LAN",
+    }, "Added commands found"
+    assert sorted_difference.removed == {
+        "firewall group address-group unix address": ["10.0.0.2"],
+        "service ssh port": "22",
+    }, "Removed commands found"
+    assert sorted_difference.changed == {
+        "firewall name lan-IN rule 10 action": "drop"
+    }, "Changed command found"
+
+    monkeypatch.setattr(config_difference, "SORTED_DIFF_THRESHOLD", 5)
+    diff_sorted = counter_wrapper(config_difference.diff_sorted_commands)
+    monkeypatch.setattr(config_difference, "diff_sorted_commands", diff_sorted)
+    config_difference.diff_configurations(current_commands[:2], previous_commands[:2])
+    assert diff_sorted.counter == 0, "Small configurations indexed"
+    assert (
+        config_difference.diff_configurations(
+            current_commands, previous_commands
+        ).changed
+        == sorted_difference.changed
+    ), "Large configurations sorted"
+    assert diff_sorted.counter == 1, "Large configurations sorted"
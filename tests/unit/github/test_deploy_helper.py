@@ -1,18 +1,25 @@
 """
 Deploy helper functionality testing
 """
+import os
+import shutil
+import subprocess
+
 import paramiko
 import pytest
 
 from ubiquiti_config_generator import root_parser, file_paths
-from ubiquiti_config_generator.github import deploy_helper
+from ubiquiti_config_generator.github import deploy_helper, router_pool
+from ubiquiti_config_generator.messages import db
 from ubiquiti_config_generator.nodes import (
     GlobalSettings,
     ExternalAddresses,
     NAT,
     Network,
     Firewall,
+    Rule,
 )
+from ubiquiti_config_generator.testing_router import FakeRouter
 from ubiquiti_config_generator.testing_utils import counter_wrapper
 
 
@@ -41,6 +48,52 @@ def test_get_command_key():
     ), "With quoted argument"
 
 
+def test_split_command(monkeypatch):
+    """
+    .
+    """
+    split = counter_wrapper(deploy_helper.shlex.split)
+    monkeypatch.setattr(deploy_helper.shlex, "split", split)
+
+    assert deploy_helper.split_command("set  firewall name test") == [
+        "set",
+        "firewall",
+        "name",
+        "test",
+    ], "Unquoted command split"
+    assert split.counter == 0, "Shlex not needed for unquoted command"
+
+    for command in [
+        "firewall description 'a quoted value'",
+        'firewall description "double \\"quoted\\" value"',
+        "firewall description\tvalue",
+        "firewall description a\\ value",
+    ]:
+        assert deploy_helper.split_command(command) == deploy_helper.shlex.split(
+            command
+        ), "Quoted command split like shlex: " + command
+    assert split.counter == 8, "Shlex used for quoted commands"
+
+
+def test_index_commands():
+    """
+    .
+    """
+    assert deploy_helper.index_commands(
+        [
+            "system host-name router",
+            "group address-group admin address 10.0.0.1",
+            "group address-group admin address 10.0.0.2",
+            "group address-group admin address 10.0.0.3",
+            "firewall name test description 'a firewall'",
+        ]
+    ) == {
+        "system host-name": "router",
+        "group address-group admin address": ["10.0.0.1", "10.0.0.2", "10.0.0.3"],
+        "firewall name test description": "a firewall",
+    }, "Commands indexed by key"
+
+
 def test_compare_commands(monkeypatch):
     """
     .
@@ -210,6 +263,7 @@ def test_get_commands_to_run(monkeypatch):
                 NAT(".", []),
             )
         else:
+            rule = Rule(10, "firewall", ".", action="accept")
             return root_parser.RootNode(
                 GlobalSettings(),
                 [],
@@ -233,8 +287,8 @@ def test_get_commands_to_run(monkeypatch):
                         ".",
                         "10.11.0.0/24",
                         firewalls=[
-                            Firewall("n2f1", "in", "network2", ".", rules=[]),
-                            Firewall("n2f2", "out", "network2", ".", rules=[]),
+                            Firewall("n2f1", "in", "network2", ".", rules=[rule]),
+                            Firewall("n2f2", "out", "network2", ".", rules=[rule]),
                         ],
                         hosts=[],
                         **interface_name
@@ -245,7 +299,7 @@ def test_get_commands_to_run(monkeypatch):
                         ".",
                         "10.12.0.0/24",
                         firewalls=[
-                            Firewall("n3f1", "in", "network3", ".", rules=[]),
+                            Firewall("n3f1", "in", "network3", ".", rules=[rule]),
                             Firewall("n3f2", "in", "network3", ".", rules=[]),
                         ],
                         hosts=[],
@@ -256,7 +310,7 @@ def test_get_commands_to_run(monkeypatch):
             )
 
     @counter_wrapper
-    def get_commands(self):
+    def get_commands(self, network_names=None):
         """
         .
         """
@@ -332,10 +386,7 @@ def test_get_commands_to_run(monkeypatch):
             "delete service nat",
             "delete firewall name n2f1 rule",
             "delete firewall name n2f2 rule",
-            "delete firewall name network2-LOCAL rule",
             "delete firewall name n3f1 rule",
-            "delete firewall name network3-OUT rule",
-            "delete firewall name network3-LOCAL rule",
             "delete service dhcp-server shared-network-name network2 "
             "subnet 10.11.0.0/24 start",
             "delete service dhcp-server shared-network-name network3 "
@@ -348,6 +399,25 @@ def test_get_commands_to_run(monkeypatch):
         ["set firewall port 1", "set firewall port 2", "set firewall port 4"],
     ], "Command to run (full config) correct"
 
+    monkeypatch.setattr(
+        file_paths,
+        "load_yaml_from_file",
+        lambda file_path: {
+            "apply-difference-only": True,
+            "pack-command-phases": True,
+        },
+    )
+    commands = deploy_helper.get_commands_to_run(".", ".")
+    assert commands == [
+        ["delete firewall port 3", "delete nat lorem", "delete address 192.168.0.1"],
+        [
+            "set firewall baz",
+            "set network foo",
+            "set description test",
+            "set firewall port 4",
+        ],
+    ], "Independent phases packed into one commit"
+
 
 def test_generate_bash_commands():
     """
@@ -451,6 +521,134 @@ def test_generate_bash_commands():
     ), "Commands generated as expected"
 
 
+def test_generate_session_script():
+    """
+    .
+    """
+    deploy_config = {
+        "script-cfg-path": "/bin/cmd-wrapper",
+        "auto-rollback-on-failure": False,
+        "reboot-after-minutes": 10,
+        "save-after-commit": True,
+    }
+    script = deploy_helper.generate_session_script(
+        [["set value 1"], [], ["set value 2"]], deploy_config
+    )
+    assert script == "\n".join(
+        [
+            'trap "exit 1" TERM',
+            "export TOP_PID=$$",
+            "",
+            "/bin/cmd-wrapper begin",
+            "",
+            'echo "On phase 0 of 2..."',
+            "/bin/cmd-wrapper set value 1",
+            "",
+            # pylint: disable=line-too-long
+            'sudo sg vyattacfg -c "echo y | /opt/vyatta/sbin/vyatta-config-mgmt.pl --action=commit-confirm --minutes=10"',
+            "if [ $? -ne 0 ]; then",
+            '  echo "Failed to schedule reboot!"',
+            "  kill -s TERM $TOP_PID",
+            "fi",
+            "",
+            "/bin/cmd-wrapper commit",
+            "if [ $? -ne 0 ]; then",
+            '  echo "Failed to commit!"',
+            "  kill -s TERM $TOP_PID",
+            "fi",
+            "",
+            'echo "On phase 1 of 2..."',
+            "/bin/cmd-wrapper set value 2",
+            "",
+            "/bin/cmd-wrapper commit",
+            "if [ $? -ne 0 ]; then",
+            '  echo "Failed to commit!"',
+            "  kill -s TERM $TOP_PID",
+            "fi",
+            "",
+            "/bin/cmd-wrapper save",
+            "if [ $? -ne 0 ]; then",
+            '  echo "Failed to save!"',
+            "  kill -s TERM $TOP_PID",
+            "fi",
+            "",
+            "exit 0",
+            "",
+        ]
+    ), "One session begun, committed after each group, and saved once"
+
+
+def test_compact_script_commands(tmp_path):
+    """
+    .
+    """
+    wrapper = tmp_path / "cmd-wrapper"
+    calls = tmp_path / "calls"
+    wrapper.write_text(
+        "#!/bin/bash\n"
+        f'echo "$#:$*" >> {calls}\n'
+        'if [ "$2" = "bad" ]; then echo "Invalid value"; exit 1; fi\n'
+    )
+    wrapper.chmod(0o755)
+    deploy_config = {
+        "script-cfg-path": str(wrapper),
+        "auto-rollback-on-failure": True,
+        "reboot-after-minutes": None,
+        "save-after-commit": False,
+        "compact-command-scripts": True,
+    }
+    commands = ["set value 1", 'set firewall description "a description"']
+
+    script = deploy_helper.get_script_commands(commands, deploy_config)
+    assert script.count("\n") == 13, "Fixed size, plus a line per command"
+    assert "check_command" in script, "Commands checked"
+    deploy_config["auto-rollback-on-failure"] = False
+    assert (
+        "output_file"
+        not in deploy_helper.get_script_commands(commands, deploy_config)
+    ), "Output only kept if rolling back"
+    deploy_config["auto-rollback-on-failure"] = True
+
+    result = subprocess.run(
+        [
+            "bash",
+            "-c",
+            deploy_helper.generate_session_script([commands], deploy_config),
+        ],
+        capture_output=True,
+        check=False,
+    )
+    assert result.returncode == 0, "Script succeeds"
+    assert calls.read_text().splitlines() == [
+        "1:begin",
+        "3:set value 1",
+        "4:set firewall description a description",
+        "1:commit",
+    ], "Quoted arguments passed as in the script"
+
+    calls.unlink()
+    result = subprocess.run(
+        [
+            "bash",
+            "-c",
+            deploy_helper.generate_session_script(
+                [["set bad 1", "set value 2"]], deploy_config
+            ),
+        ],
+        capture_output=True,
+        check=False,
+    )
+    assert result.returncode == 1, "Script fails"
+    assert result.stderr.decode() == (
+        "Failed to execute command: set bad 1\nInvalid value\n"
+    ), "Failure reported"
+    assert calls.read_text().splitlines() == [
+        "1:begin",
+        "3:set bad 1",
+        "1:discard",
+    ], "Changes discarded and nothing else run"
+
+
 def test_router_connection(monkeypatch):
     """
     .
@@ -525,186 +723,549 @@ def test_router_connection(monkeypatch):
     deploy_helper.get_router_connection(config)
 
 
-def test_write_data(monkeypatch):
+def test_router_session(monkeypatch):
     """
     .
     """
+    router = FakeRouter()
+    connect = counter_wrapper(lambda config: router.connect())
+    monkeypatch.setattr(deploy_helper, "get_router_connection", connect)
+    config = {"router": {"address": "router", "user": "admin"}}
+    try:
+        with deploy_helper.router_session(config) as client:
+            assert client.get_transport().is_active(), "Connected"
+        assert not client.get_transport(), "Connection closed when not reused"
+
+        config["reuse-router-connection"] = True
+        with deploy_helper.router_session(config) as client:
+            pass
+        with deploy_helper.router_session(config) as second_client:
+            assert second_client is client, "Connection reused"
+        assert client.get_transport().is_active(), "Shared connection left open"
+        assert connect.counter == 2, "Connected once for each mode"
+    finally:
+        router_pool.close_router_pools()
+        router.close()
 
-    # pylint: disable=too-few-public-methods,unused-argument
-    class FakeFile:
+
+def test_run_command():
+    """
+    .
+    """
+
+    # pylint: disable=too-few-public-methods,no-self-use
+    class FakeSession:
         """
-        Fake SFTP file
+        Fake session
         """
 
-        called = []
+        command = None
 
-        def writable(self):
+        def exec_command(self, command):
             """
             .
             """
-            self.called.append("writable")
+            self.command = command
 
-        def write(self, data):
-            """
-            .
-            """
-            self.called.append("write")
+    # pylint: disable=too-few-public-methods,unused-argument
+    class FakeTransport:
+        """
+        Fake transport
+        """
 
-        def flush(self):
+        @counter_wrapper
+        def open_session(self):
             """
             .
             """
-            self.called.append("flush")
+            return FakeSession()
 
-        def close(self):
-            """
-            .
-            """
-            self.called.append("close")
+    class FakeClient:
+        """
+        Fake client
+        """
 
-        def read(self):
+        @counter_wrapper
+        def get_transport(self):
             """
             .
             """
-            self.called.append("read")
-            return "foo".encode()
+            return FakeTransport()
 
-    class FailSFTP:
-        """
-        Will fail to return file
-        """
+    assert (
+        deploy_helper.run_router_command(FakeClient(), "something").command
+        == "something"
+    ), "Command returned"
 
-        # pylint: disable=no-self-use
-        def file(self, path, mode, buffer):
-            """
-            Opens file
-            """
-            return None
 
-    # pylint: disable=no-self-use,too-few-public-methods
-    class FakeSFTP:
-        """
-        Fake SFTP client
-        """
+def test_get_changed_networks():
+    """
+    .
+    """
+    assert deploy_helper.get_changed_networks(
+        [
+            "networks/internal/hosts/laptop.yaml",
+            "networks/lab/config.yaml",
+            "networks/internal/firewalls/internal-IN/1.yaml",
+            "nat/5000.yaml",
+            "global_settings.yaml",
+            "networks/README.md",
+        ]
+    ) == {"internal", "lab"}, "Changed networks found"
 
-        def file(self, path, mode, buffer):
-            """
-            Opens file
-            """
-            return FakeFile()
 
-        def open(self, path):
-            """
-            .
-            """
-            return FakeFile()
+def test_get_ruled_firewall_names():
+    """
+    .
+    """
+    root_node = root_parser.RootNode.create_from_configs("sample_router_config")
+    ruled_firewalls = [
+        "administrative-IN",
+        "administrative-OUT",
+        "internal-IN",
+        "internal-OUT",
+        "untrusted-OUT",
+    ]
+    assert (
+        deploy_helper.get_ruled_firewall_names(root_node) == ruled_firewalls
+    ), "Firewalls without rules skipped"
 
-        @counter_wrapper
-        def close(self):
-            """
-            .
-            """
+    snapshot = deploy_helper.create_command_snapshot(
+        "abc", root_node, root_node.get_commands()[1]
+    )
+    assert (
+        deploy_helper.get_snapshot_ruled_firewall_names(snapshot) == ruled_firewalls
+    ), "Snapshot firewalls without rules skipped"
 
-    class FakeClient:
-        """
-        Fake client
-        """
 
-        def __init__(self, client):
-            self.client = client
+def test_get_commands_to_run_changed_files(monkeypatch, tmp_path):
+    """
+    .
+    """
+    previous_path = str(tmp_path / "previous")
+    current_path = str(tmp_path / "current")
+    shutil.copytree("sample_router_config", previous_path)
+    shutil.copytree("sample_router_config", current_path)
 
-        def open_sftp(self):
-            """
-            .
-            """
-            return self.client
+    firewall_path = os.path.join(
+        current_path, "networks", "internal", "firewalls", "internal-IN", "config.yaml"
+    )
+    with open(firewall_path) as firewall_file:
+        firewall_config = firewall_file.read()
+    with open(firewall_path, "w") as firewall_file:
+        firewall_file.write(firewall_config.replace("drop", "reject"))
+
+    host_path = os.path.join(current_path, "networks", "internal", "hosts")
+    with open(os.path.join(host_path, "laptop.yaml")) as host_file:
+        host_config = host_file.read()
+    with open(os.path.join(host_path, "laptop.yaml"), "w") as host_file:
+        host_file.write(host_config.replace("10.0.12.101", "10.0.12.111"))
+
+    load_yaml = file_paths.load_yaml_from_file
+    deploy_config = {"apply-difference-only": True, "verify-changed-file-plan": False}
+    monkeypatch.setattr(
+        file_paths,
+        "load_yaml_from_file",
+        lambda file_path: deploy_config
+        if file_path == "deploy.yaml"
+        else load_yaml(file_path),
+    )
 
-    with pytest.raises(ValueError):
-        deploy_helper.write_data_to_router_file(FakeClient(FailSFTP()), "file", "data")
+    full_commands = deploy_helper.get_commands_to_run(current_path, previous_path)
 
-    with pytest.raises(ValueError):
-        deploy_helper.write_data_to_router_file(FakeClient(FakeSFTP()), "file", "data")
-
-    assert FakeFile.called == ["writable"], "Writable called, but failed"
-
-    FakeFile.writable = lambda self: self.called.append("writable") or True
-    assert not deploy_helper.write_data_to_router_file(
-        FakeClient(FakeSFTP()), "file", "data"
-    ), "Fails due to data mismatch"
-    assert FakeFile.called == [
-        "writable",
-        "writable",
-        "write",
-        "flush",
-        "close",
-        "read",
-    ], "Functions called in right order"
-    assert FakeSFTP.close.counter == 1, "Close called"
-
-    assert deploy_helper.write_data_to_router_file(
-        FakeClient(FakeSFTP()), "file", "foo"
-    ), "Successful emulated write"
-    assert FakeFile.called == [
-        "writable",
-        "writable",
-        "write",
-        "flush",
-        "close",
-        "read",
-        "writable",
-        "write",
-        "flush",
-        "close",
-        "read",
-    ], "Functions called in right order"
-    assert FakeSFTP.close.counter == 2, "Close called"
+    load_firewalls = counter_wrapper(Network._load_firewalls)
+    monkeypatch.setattr(Network, "_load_firewalls", load_firewalls)
+    changed_files = [
+        "networks/internal/firewalls/internal-IN/config.yaml",
+        "networks/internal/hosts/laptop.yaml",
+    ]
+    assert (
+        deploy_helper.get_commands_to_run(
+            current_path, previous_path, changed_files=changed_files
+        )
+        == full_commands
+    ), "Same commands from changed files"
+    assert load_firewalls.counter == 2, "Only changed network firewalls loaded"
+    assert (
+        "set firewall name internal-IN default-action reject" in full_commands[2]
+    ), "Changed firewall included"
 
+    stored = []
+    monkeypatch.setattr(db, "store_command_snapshot", stored.append)
+    full_commands = deploy_helper.get_commands_to_run(
+        current_path, previous_path, current_revision="def"
+    )
+    assert [snapshot.revision for snapshot in stored] == ["def"], "Snapshot stored"
 
-def test_run_command():
+    previous_snapshot = deploy_helper.create_command_snapshot(
+        "abc",
+        root_parser.RootNode.create_from_configs(previous_path),
+        root_parser.RootNode.create_from_configs(previous_path).get_commands()[1],
+    )
+    assert previous_snapshot.firewalls[0] == "administrative-IN", "Firewalls stored"
+    monkeypatch.setattr(
+        root_parser.RootNode,
+        "create_from_configs",
+        counter_wrapper(root_parser.RootNode.create_from_configs),
+    )
+    assert (
+        deploy_helper.get_commands_to_run(
+            current_path, previous_path, previous_snapshot=previous_snapshot
+        )
+        == full_commands
+    ), "Same commands from previous snapshot"
+    assert (
+        root_parser.RootNode.create_from_configs.counter == 1
+    ), "Previous configuration not loaded"
+
+    deploy_config["verify-changed-file-plan"] = True
+    assert (
+        deploy_helper.get_commands_to_run(
+            current_path, previous_path, changed_files=["global_settings.yaml"]
+        )
+        == full_commands
+    ), "Full commands used when verifying"
+
+
+def test_get_commands_to_run_pinned_rules(monkeypatch, tmp_path):
     """
     .
     """
+    previous_path = str(tmp_path / "previous")
+    current_path = str(tmp_path / "current")
+    shutil.copytree("sample_router_config", previous_path)
+    shutil.copytree("sample_router_config", current_path)
+
+    # Sorted before the existing host, so its rules are numbered first
+    with open(
+        os.path.join(current_path, "networks", "untrusted", "hosts", "alarm.yaml"),
+        "w",
+    ) as host_file:
+        host_file.write(
+            "---\n"
+            "address: 10.200.0.5\n"
+            'mac: "ab:12:bc:23:cd:35"\n'
+            "connections:\n"
+            '  - description: "Allow alarm access from admin addresses"\n'
+            "    allow: True\n"
+            "    source:\n"
+            "      address: 10.10.0.0/23\n"
+            "    destination:\n"
+            "      address: 10.200.0.5\n"
+            "...\n"
+        )
 
-    # pylint: disable=too-few-public-methods,no-self-use
-    class FakeSession:
+    load_yaml = file_paths.load_yaml_from_file
+    deploy_config = {"apply-difference-only": True, "pin-rule-numbers": False}
+    monkeypatch.setattr(
+        file_paths,
+        "load_yaml_from_file",
+        lambda file_path: deploy_config
+        if file_path == "deploy.yaml"
+        else load_yaml(file_path),
+    )
+
+    previous_node = root_parser.RootNode.create_from_configs(previous_path)
+    previous_snapshot = deploy_helper.create_command_snapshot(
+        "abc", previous_node, previous_node.get_commands()[1]
+    )
+
+    shifted_commands = deploy_helper.get_commands_to_run(
+        current_path, previous_path, previous_snapshot=previous_snapshot
+    )
+    deploy_config["pin-rule-numbers"] = True
+    assert (
+        deploy_helper.get_commands_to_run(current_path, previous_path)
+        == shifted_commands
+    ), "Rules not pinned without the deployed rule numbers"
+
+    pinned_commands = deploy_helper.get_commands_to_run(
+        current_path, previous_path, previous_snapshot=previous_snapshot
+    )
+    assert sum([len(phase) for phase in pinned_commands]) < sum(
+        [len(phase) for phase in shifted_commands]
+    ), "Fewer commands with pinned rule numbers"
+    assert not pinned_commands[0], "Nothing deleted"
+
+    changed_files = ["networks/untrusted/hosts/alarm.yaml"]
+    deploy_config["pin-rule-numbers"] = False
+    unpinned_changed_commands = deploy_helper.get_commands_to_run(
+        current_path, previous_path, changed_files=changed_files
+    )
+    deploy_config["pin-rule-numbers"] = True
+    assert (
+        deploy_helper.get_commands_to_run(
+            current_path,
+            previous_path,
+            changed_files=changed_files,
+            previous_snapshot=previous_snapshot,
+        )
+        == unpinned_changed_commands
+    ), "Rules not pinned when comparing against the regenerated changed networks"
+
+    deploy_config["apply-difference-only"] = False
+    full_commands = deploy_helper.get_commands_to_run(
+        current_path, previous_path, previous_snapshot=previous_snapshot
+    )
+    assert not [
+        command
+        for command in full_commands[0]
+        if command.startswith("delete firewall name") and command.endswith(" rule")
+    ], "Firewall rules not deleted wholesale"
+
+
+def test_get_live_commands():
+    """
+    .
+    """
+    with open(
+        os.path.join("tests", "unit", "resources", "show_configuration_commands.txt")
+    ) as output_file:
+        output = output_file.read()
+
+    # pylint: disable=too-few-public-methods
+    class FakeChannel:
         """
-        Fake session
+        Fake channel
         """
 
-        command = None
+        exit_status = 0
 
-        def exec_command(self, command):
+        def recv_exit_status(self):
             """
             .
             """
-            self.command = command
+            return self.exit_status
 
-    # pylint: disable=too-few-public-methods,unused-argument
-    class FakeTransport:
+    # pylint: disable=too-few-public-methods
+    class FakeOutput:
         """
-        Fake transport
+        Fake output stream
         """
 
-        @counter_wrapper
-        def open_session(self):
+        channel = FakeChannel()
+
+        def __init__(self, text: str):
+            self.text = text
+
+        def read(self):
             """
             .
             """
-            return FakeSession()
+            return self.text.encode()
 
+    # pylint: disable=too-few-public-methods
     class FakeClient:
         """
         Fake client
         """
 
-        @counter_wrapper
-        def get_transport(self):
+        command = None
+
+        def exec_command(self, command):
             """
             .
             """
-            return FakeTransport()
+            self.command = command
+            return (None, FakeOutput(output), FakeOutput("Invalid command"))
 
+    client = FakeClient()
+    live_commands = deploy_helper.get_live_commands(client, {})
     assert (
-        deploy_helper.run_router_command(FakeClient(), "something").command
-        == "something"
-    ), "Command returned"
+        client.command
+        == "/opt/vyatta/bin/vyatta-op-cmd-wrapper show configuration commands"
+    ), "Configuration shown"
+    assert live_commands[0] == "firewall all-ping enable", "Set removed"
+    assert (
+        "firewall group port-group web description 'Website ports'" in live_commands
+    ), "Quoting kept"
+    assert deploy_helper.parse_live_commands(
+        "set system host-name router\n# comment\n\nset service ssh port 22\n"
+    ) == ["system host-name router", "service ssh port 22"], "Only set lines parsed"
+
+    FakeChannel.exit_status = 1
+    with pytest.raises(ValueError, match="Invalid command"):
+        deploy_helper.get_live_commands(client, {})
+
+
+def test_diff_live_commands():
+    """
+    .
+    """
+    previous = {
+        "system host-name": "router",
+        "firewall group address-group unix address": ["10.0.0.1", "10.0.0.2"],
+        "firewall name lan-IN default-action": "drop",
+    }
+    current = {
+        "system host-name": "router",
+        "firewall group address-group unix address": ["10.0.0.1", "10.0.0.3"],
+    }
+    live = {
+        "system host-name": "edge",
+        "firewall group address-group unix address": ["10.0.0.2", "10.0.0.9"],
+        "firewall name lan-IN default-action": "drop",
+        "service ssh port": "22",
+    }
+
+    difference, drift = deploy_helper.diff_live_commands(current, previous, live)
+    assert difference.added == {
+        "system host-name": "router",
+        "firewall group address-group unix address": ["10.0.0.1", "10.0.0.3"],
+    }, "Missing values added"
+    assert difference.removed == {
+        "firewall group address-group unix address": ["10.0.0.2"],
+        "firewall name lan-IN default-action": "drop",
+    }, "Only managed values removed"
+    assert drift.changed == {"system host-name": "edge"}, "Changed value drifted"
+    assert drift.added == {
+        "firewall group address-group unix address": ["10.0.0.9"]
+    }, "Manual value drifted"
+    assert drift.removed == {
+        "firewall group address-group unix address": ["10.0.0.1"]
+    }, "Missing value drifted"
+
+
+def test_get_commands_to_run_live(monkeypatch, tmp_path, capsys):
+    """
+    .
+    """
+    current_path = str(tmp_path / "current")
+    shutil.copytree("sample_router_config", current_path)
+    host_path = os.path.join(current_path, "networks", "internal", "hosts")
+    with open(os.path.join(host_path, "laptop.yaml")) as host_file:
+        host_config = host_file.read()
+    with open(os.path.join(host_path, "laptop.yaml"), "w") as host_file:
+        host_file.write(host_config.replace("10.0.12.101", "10.0.12.111"))
+
+    load_yaml = file_paths.load_yaml_from_file
+    deploy_config = {"apply-difference-only": True}
+    monkeypatch.setattr(
+        file_paths,
+        "load_yaml_from_file",
+        lambda file_path: deploy_config
+        if file_path == "deploy.yaml"
+        else load_yaml(file_path),
+    )
+
+    with open(
+        os.path.join("tests", "unit", "resources", "show_configuration_commands.txt")
+    ) as output_file:
+        live_commands = deploy_helper.parse_live_commands(output_file.read())
+
+    commands = deploy_helper.get_commands_to_run(
+        current_path, "sample_router_config", live_commands=live_commands
+    )
+    all_commands = [command for phase in commands for command in phase]
+    assert (
+        "delete firewall group address-group unix address 10.0.12.101" in commands[0]
+    ), "Previous value deleted"
+    assert not [
+        command for command in commands[0] if "10.0.12.250" in command
+    ], "Manual value preserved"
+    assert not [
+        command for command in all_commands if "login user admin" in command
+    ], "Manual setting preserved"
+    assert (
+        "set firewall name internal-IN default-action drop" in all_commands
+    ), "Missing value restored"
+    assert (
+        "set firewall name untrusted-OUT rule 30 action drop" in all_commands
+    ), "Drifted value restored"
+    assert (
+        "set firewall name administrative-IN rule 1 log disable" not in all_commands
+    ), "Live value not applied again"
+    assert (
+        capsys.readouterr().out
+        == "Router configuration has drifted from the previous in 3 keys\n"
+    ), "Drift reported"
+
+    logs = []
+    monkeypatch.setattr(
+        db,
+        "add_deployment_log",
+        lambda log: logs.append((log.revision1, log.revision2, log.message)) or True,
+    )
+    deploy_config["verify-changed-file-plan"] = True
+    assert (
+        deploy_helper.get_commands_to_run(
+            current_path,
+            "sample_router_config",
+            changed_files=["networks/internal/hosts/laptop.yaml"],
+            live_commands=live_commands,
+            deployment_revisions=("abc", "def"),
+        )
+        == commands
+    ), "Full plan verified against the live configuration"
+    assert logs[-1] == (
+        "abc",
+        "def",
+        "Router configuration has drifted from the previous in 3 keys",
+    ), "Drift recorded in the deployment log"
+
+
+def test_is_configuration_unchanged(monkeypatch, tmp_path):
+    """
+    .
+    """
+    current_path = str(tmp_path / "current")
+    shutil.copytree("sample_router_config", current_path)
+    with open(os.path.join(current_path, "global_settings.yaml"), "a") as settings:
+        settings.write("# A comment\n")
+
+    create = counter_wrapper(root_parser.RootNode.create_from_configs)
+    monkeypatch.setattr(root_parser.RootNode, "create_from_configs", create)
+    assert deploy_helper.is_configuration_unchanged(
+        current_path, "sample_router_config", ["README.md"]
+    ), "Only documentation changed"
+    assert create.counter == 0, "Configuration not loaded"
+
+    assert deploy_helper.is_configuration_unchanged(
+        current_path, "sample_router_config", ["global_settings.yaml"]
+    ), "Comment does not change configuration"
+    assert create.counter == 2, "Both configurations loaded"
+
+    with open(os.path.join(current_path, "global_settings.yaml")) as settings:
+        global_settings = settings.read()
+    with open(os.path.join(current_path, "global_settings.yaml"), "w") as settings:
+        settings.write(global_settings.replace("router", "edge-router"))
+    assert not deploy_helper.is_configuration_unchanged(
+        current_path, "sample_router_config"
+    ), "Host name changed"
+
+
+def test_get_inverse_commands():
+    """
+    .
+    """
+    previous_commands = {
+        "system host-name": "router",
+        "system name-server": ["1.1.1.1", "8.8.8.8"],
+        "firewall name lan-IN rule 10 action": "accept",
+        "firewall name lan-IN rule 10 description": "Allow LAN",
+        "firewall name lan-IN rule 20 action": "drop",
+        "service nat rule 5000 type": "masquerade",
+    }
+    assert deploy_helper.get_inverse_commands(
+        [
+            [
+                "delete system name-server 8.8.8.8",
+                "delete firewall name lan-IN rule 10",
+            ],
+            [
+                "set system host-name changed",
+                "set system name-server 9.9.9.9",
+                "set system name-server 1.1.1.1",
+                "set firewall name lan-IN rule 10 action accept",
+                "set firewall name lan-IN rule 30 action reject",
+            ],
+        ],
+        previous_commands,
+    ) == [
+        "delete system name-server 9.9.9.9",
+        "delete firewall name lan-IN rule 30 action reject",
+        "set system name-server 8.8.8.8",
+        "set firewall name lan-IN rule 10 action accept",
+        "set firewall name lan-IN rule 10 description 'Allow LAN'",
+        "set system host-name router",
+    ], "Additions deleted, then removals and changes set back"
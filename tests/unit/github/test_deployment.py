@@ -7,45 +7,103 @@ import pytest
 from ubiquiti_config_generator.github import api, deployment, deploy_helper
 from ubiquiti_config_generator.github.deployment_metadata import DeployMetadata
 from ubiquiti_config_generator.messages import db
+from ubiquiti_config_generator.messages.command_snapshot import CommandSnapshot
+from ubiquiti_config_generator.messages.deployment import Deployment
 from ubiquiti_config_generator.messages.log import Log
+from ubiquiti_config_generator.testing_router import FakeRouter
 from ubiquiti_config_generator.testing_utils import counter_wrapper
 
 
-def test_log_command_output(monkeypatch, capsys):
+def test_command_output_logger(monkeypatch, capsys):
     """
     .
     """
-    messages = [
-        "a message",
-        "a failure",
-        "details about failure",
-        "more details about failure",
-    ]
+    batches = []
 
     # pylint: disable=unused-argument
-    @counter_wrapper
-    def add_log(log: Log, cursor=None) -> bool:
+    def add_logs(logs, cursor=None) -> bool:
         """
         .
         """
-        assert (
-            log.message == messages[add_log.counter - 1]
-        ), f"Message {add_log.counter} logged is correct"
-        return add_log.counter < 4
+        batches.append([log.message for log in logs])
+        return len(batches) < 3
+
+    monkeypatch.setattr(db, "add_deployment_logs", add_logs)
+
+    output_logger = deployment.CommandOutputLogger("beforesha", "aftersha", 2, 60)
+    output_logger.add(b"a message\r\na fail")
+    assert not batches, "Nothing logged before the batch is full"
+    output_logger.add(b"ure\n\nmore output\n")
+    assert batches == [
+        ["a message", "a failure", "more output"]
+    ], "Full batch logged"
+
+    output_logger.add(b"waiting\n")
+    output_logger.flush_if_due()
+    assert len(batches) == 1, "Batch not logged before it is due"
+    output_logger.batch_seconds = 0
+    output_logger.flush_if_due()
+    assert batches[1:] == [["waiting"]], "Due batch logged"
+    assert output_logger.succeeded(), "No failures yet"
+
+    output_logger.add(b"Commit failed\nunfinished")
+    output_logger.add(b"details about failure", True)
+    output_logger.finish()
+    assert batches[2:] == [
+        ["Commit failed", "unfinished", "details about failure"]
+    ], "Remaining output logged when finished"
+    assert not output_logger.succeeded(), "Failures found"
+    assert output_logger.has_errors, "Errors found"
+    assert output_logger.has_failures, "Failed commit found"
+    assert (
+        capsys.readouterr().out == "Failed to add deployment execution log in DB\n"
+    ), "Single DB failure printed"
 
-    monkeypatch.setattr(db, "add_deployment_log", add_log)
 
-    deployment.log_command_output(
-        "beforesha",
-        "aftersha",
-        "a message\na failure\n",
-        "details about failure\nmore details about failure\n",
+def test_stream_command_output(monkeypatch):
+    """
+    .
+    """
+    batches = []
+    monkeypatch.setattr(
+        db,
+        "add_deployment_logs",
+        lambda logs, cursor=None: batches.append([log.message for log in logs])
+        or True,
     )
-    assert add_log.counter == 4, "Four logs added"
-    printed = capsys.readouterr()
-    assert (
-        printed.out == "Failed to add deployment execution log in DB\n"
-    ), "Single DB failure printed"
+
+    # pylint: disable=unused-argument
+    def run_script(router, arguments, stdin):
+        """
+        .
+        """
+        return (
+            0,
+            "".join([f"set value {index}\n" for index in range(5000)]),
+            "warning\n",
+        )
+
+    router = FakeRouter()
+    router.command_handlers["bash"] = run_script
+    try:
+        client = router.connect()
+        output_logger = deployment.CommandOutputLogger("before", "after")
+        assert (
+            deployment.stream_command_output(
+                client.exec_command("bash /tmp/script.sh")[1].channel, output_logger
+            )
+            == 0
+        ), "Exit status returned"
+    finally:
+        router.close()
+
+    messages = [message for batch in batches for message in batch]
+    assert [message for message in messages if message != "warning"] == [
+        f"set value {index}" for index in range(5000)
+    ], "Every output line logged in order"
+    assert messages.count("warning") == 1, "Errors logged"
+    assert len(batches) > 1, "Output logged in batches as it arrives"
+    assert not output_logger.succeeded(), "Error output fails the command"
 
 
 def test_fail_deployment(monkeypatch, capsys):
@@ -76,7 +134,7 @@ def test_fail_deployment(monkeypatch, capsys):
     assert printed.out == "", "Nothing printed"
 
 
-def test_send_file_to_router(monkeypatch, capsys):
+def test_add_command_file(monkeypatch):
     """
     .
     """
@@ -99,32 +157,17 @@ def test_send_file_to_router(monkeypatch, capsys):
 
     monkeypatch.setattr(deploy_helper, "generate_bash_commands", get_commands)
     monkeypatch.setattr(db, "add_deployment_log", add_log)
-    monkeypatch.setattr(
-        deploy_helper, "write_data_to_router_file", lambda *args, **kwargs: False
-    )
-
-    with pytest.raises(ValueError):
-        deployment.send_file_to_router(
-            "before", "after", None, ["commands"], {}, "/tmp/foo.sh"
-        )
 
+    router_files = {}
+    deployment.add_command_file(
+        "before", "after", router_files, ["commands"], {}, "/tmp/foo.sh"
+    )
+    assert router_files == {"/tmp/foo.sh": "commands"}, "File added"
     assert get_commands.counter == 1, "Commands generated"
     assert add_log.counter == 1, "Log added"
-    printed = capsys.readouterr()
-    assert printed.out == "Failed to write /tmp/foo.sh to router\n", "Error printed"
-
-    monkeypatch.setattr(
-        deploy_helper, "write_data_to_router_file", lambda *args, **kwargs: True
-    )
-
-    deployment.send_file_to_router(
-        "before", "after", None, ["commands"], {}, "/tmp/foo.sh"
-    )
-    assert get_commands.counter == 2, "Commands generated"
-    assert add_log.counter == 2, "Log added"
 
 
-def test_send_aggregate_file_to_router(monkeypatch, capsys):
+def test_add_aggregate_file(monkeypatch):
     """
     .
     """
@@ -138,108 +181,167 @@ def test_send_aggregate_file_to_router(monkeypatch, capsys):
             log.message == "Adding combined command set /tmp/aggregate.sh to router"
         ), "Log message correct"
 
-    @counter_wrapper
-    def write_router_data(connection, file_name, file_data):
-        """
-        .
-        """
-        assert file_data == (
-            'echo "On file 0 of 2..."\n'
-            "$(which vbash) /tmp/commands1.sh $$\n"
-            'echo "On file 1 of 2..."\n'
-            "$(which vbash) /tmp/commands2.sh $$\n\n"
-            "exit 0\n"
-        ), "File data correct"
-        return write_router_data.counter == 2
-
     monkeypatch.setattr(db, "add_deployment_log", add_log)
-    monkeypatch.setattr(deploy_helper, "write_data_to_router_file", write_router_data)
-
-    with pytest.raises(ValueError):
-        deployment.send_aggregate_file_to_router(
-            "before",
-            "after",
-            None,
-            ["/tmp/commands1.sh", "/tmp/commands2.sh"],
-            "/tmp/aggregate.sh",
-        )
-
-    assert add_log.counter == 1, "Deployment log added"
-    assert write_router_data.counter == 1, "Attempted to write data to router"
-    printed = capsys.readouterr()
-    assert (
-        printed.out == "Failed to create aggregated command file on router\n"
-    ), "Error message printed"
 
-    deployment.send_aggregate_file_to_router(
+    router_files = {}
+    deployment.add_aggregate_file(
         "before",
         "after",
-        None,
+        router_files,
         ["/tmp/commands1.sh", "/tmp/commands2.sh"],
         "/tmp/aggregate.sh",
     )
-    assert add_log.counter == 2, "Deployment log added"
-    assert write_router_data.counter == 2, "Attempted to write data to router"
-    printed = capsys.readouterr()
-    assert printed.out == "", "No errors printed"
+    assert router_files == {
+        "/tmp/aggregate.sh": (
+            'echo "On file 0 of 2..."\n'
+            "$(which vbash) /tmp/commands1.sh $$\n"
+            'echo "On file 1 of 2..."\n'
+            "$(which vbash) /tmp/commands2.sh $$\n\n"
+            "exit 0\n"
+        )
+    }, "File data correct"
+    assert add_log.counter == 1, "Deployment log added"
 
 
-def test_send_config_files_to_router(monkeypatch):
+def test_send_config_files_to_router(monkeypatch, capsys):
     """
     .
     """
+    monkeypatch.setattr(db, "add_deployment_log", lambda *args, **kwargs: True)
+    monkeypatch.setattr(
+        deploy_helper,
+        "generate_bash_commands",
+        lambda commands, deploy_config: "\n".join(commands),
+    )
+    metadata = DeployMetadata(
+        "bef123",
+        "afe321",
+        "",
+        "/status",
+        {"router": {"command-file-path": "/tmp"}},
+    )
+    # Send eleven, to ensure the padding is correct for multiple-digit numbers
+    command_groups = [["command" + str(x)] for x in range(11)]
+
+    router = FakeRouter()
+    try:
+        client = router.connect()
+        open_sftp = counter_wrapper(client.open_sftp)
+        monkeypatch.setattr(client, "open_sftp", open_sftp)
+        assert (
+            deployment.send_config_files_to_router(client, metadata, command_groups)
+            == "/tmp/bef123..afe321.sh"
+        ), "Aggregate file returned"
+
+        assert open_sftp.counter == 1, "Single SFTP session used"
+        assert len(router.files) == 12, "Command and aggregate files sent"
+        assert router.read_file("/tmp/bef123..afe321-010.sh") == (
+            "command10"
+        ), "File name padded"
+        assert not router.reads, "Files not read back"
+        assert router.commands == [
+            "sha256sum -- "
+            + " ".join(
+                [f"/tmp/bef123..afe321-{str(x).rjust(3, '0')}.sh" for x in range(11)]
+                + ["/tmp/bef123..afe321.sh"]
+            )
+        ], "Files verified with one command"
+
+        router.command_handlers["sha256sum"] = lambda router, arguments, stdin: (
+            0,
+            "",
+            "",
+        )
+        with pytest.raises(ValueError):
+            deployment.send_config_files_to_router(client, metadata, [["command"]])
+        assert capsys.readouterr().out == (
+            "Failed to write /tmp/bef123..afe321-000.sh, "
+            "/tmp/bef123..afe321.sh to router\n"
+        ), "Failed files printed"
+    finally:
+        router.close()
 
-    # pylint: disable=unused-argument,too-many-arguments
-    @counter_wrapper
-    def send_file(
-        before, after, router_connection, commands, deploy_config, file_name,
-    ):
-        """
-        .
-        """
-        command_number = send_file.counter - 1
-        assert commands == [f"command{command_number}"], "Command group correct"
-        assert file_name == (
-            "/tmp/bef123..afe321-0"
-            + ("0" if command_number < 10 else "")
-            + f"{command_number}.sh"
-        ), "File name correct"
-
-    @counter_wrapper
-    def send_aggregate_file(
-        before, after, router_connection, file_names, aggregate_file_name
-    ):
-        """
-        .
-        """
-        assert aggregate_file_name == "/tmp/bef123..afe321.sh", "Aggregate file correct"
 
-    monkeypatch.setattr(deployment, "send_file_to_router", send_file)
+def test_send_config_files_to_router_as_tar(monkeypatch):
+    """
+    .
+    """
+    monkeypatch.setattr(db, "add_deployment_log", lambda *args, **kwargs: True)
     monkeypatch.setattr(
-        deployment, "send_aggregate_file_to_router", send_aggregate_file
+        deploy_helper,
+        "generate_bash_commands",
+        lambda commands, deploy_config: "\n".join(commands),
+    )
+    metadata = DeployMetadata(
+        "bef123",
+        "afe321",
+        "",
+        "/status",
+        {"router": {"command-file-path": "/tmp", "upload-mode": "tar"}},
     )
 
-    assert (
-        deployment.send_config_files_to_router(
-            None,
-            DeployMetadata(
-                "bef123",
-                "afe321",
-                "",
-                "/status",
-                {"router": {"command-file-path": "/tmp"}},
-            ),
-            [
-                ["command" + str(x)]
-                # Send eleven, to ensure the padding is correct for multiple-digit numbers
-                for x in range(11)
-            ],
-        )
-        == "/tmp/bef123..afe321.sh"
+    router = FakeRouter()
+    try:
+        client = router.connect()
+        open_sftp = counter_wrapper(client.open_sftp)
+        monkeypatch.setattr(client, "open_sftp", open_sftp)
+        assert (
+            deployment.send_config_files_to_router(
+                client, metadata, [["command0"], ["command1"]]
+            )
+            == "/tmp/bef123..afe321.sh"
+        ), "Aggregate file returned"
+
+        assert open_sftp.counter == 0, "No SFTP session used"
+        assert len(router.commands) == 1, "Files sent with one command"
+        assert router.commands[0].startswith("tar -xzf - -C / && "), "Tar extracted"
+        assert sorted(router.files.keys()) == [
+            "/tmp/bef123..afe321-000.sh",
+            "/tmp/bef123..afe321-001.sh",
+            "/tmp/bef123..afe321.sh",
+        ], "Command and aggregate files extracted"
+        assert router.read_file("/tmp/bef123..afe321-001.sh") == (
+            "command1"
+        ), "File contents extracted"
+    finally:
+        router.close()
+
+
+def test_send_config_files_to_router_single_session(monkeypatch):
+    """
+    .
+    """
+    monkeypatch.setattr(db, "add_deployment_log", lambda *args, **kwargs: True)
+    monkeypatch.setattr(
+        deploy_helper,
+        "generate_session_script",
+        lambda command_groups, deploy_config: str(command_groups),
+    )
+    metadata = DeployMetadata(
+        "bef123",
+        "afe321",
+        "",
+        "/status",
+        {"router": {"command-file-path": "/tmp"}, "execution-mode": "session"},
     )
 
-    assert send_file.counter == 11, "Eleven command files sent"
-    assert send_aggregate_file.counter == 1, "Aggregate file sent"
+    router = FakeRouter()
+    try:
+        client = router.connect()
+        assert (
+            deployment.send_config_files_to_router(
+                client, metadata, [["command0"], ["command1"]]
+            )
+            == "/tmp/bef123..afe321.sh"
+        ), "Session script returned"
+        assert list(router.files.keys()) == [
+            "/tmp/bef123..afe321.sh"
+        ], "Only the session script sent"
+        assert router.read_file("/tmp/bef123..afe321.sh") == str(
+            [["command0"], ["command1"]]
+        ), "Every command group in the script"
+    finally:
+        router.close()
 
 
 def test_load_execute_config(monkeypatch):
@@ -273,13 +375,8 @@ def test_load_execute_config(monkeypatch):
         A fake file
         """
 
-        def read(self):
-            """
-            .
-            """
-            return "".encode()
+        channel = None
 
-    # pylint: disable=too-few-public-methods
     class FailRouter:
         """
         Fake router
@@ -292,7 +389,11 @@ def test_load_execute_config(monkeypatch):
             """
             raise paramiko.SSHException("Failed to execute")
 
-    # pylint: disable=too-few-public-methods
+        def close(self):
+            """
+            .
+            """
+
     class SuccessRouter:
         """
         Fake router
@@ -304,6 +405,11 @@ def test_load_execute_config(monkeypatch):
             """
             return (FakeFile(), FakeFile(), FakeFile())
 
+        def close(self):
+            """
+            .
+            """
+
     def get_fail_router(*args, **kwargs):
         """
         .
@@ -334,6 +440,7 @@ def test_load_execute_config(monkeypatch):
         """
         .
         """
+        return 0
 
     monkeypatch.setattr(db, "add_deployment_log", generic_fail)
     monkeypatch.setattr(deployment, "fail_deployment", fail_deployment)
@@ -352,7 +459,7 @@ def test_load_execute_config(monkeypatch):
         deployment, "send_config_files_to_router", fail_send_config_files
     )
     monkeypatch.setattr(deployment, "fail_deployment", fail_deployment)
-    monkeypatch.setattr(deployment, "log_command_output", log_output)
+    monkeypatch.setattr(deployment, "stream_command_output", log_output)
 
     assert not deployment.load_and_execute_config_changes(
         [], DeployMetadata("abc", "def", "/app", "/status", {}), "abc123"
@@ -403,6 +510,15 @@ def test_load_execute_config(monkeypatch):
     assert fail_deployment.counter == 4, "Deployment did not fail"
     assert log_output.counter == 1, "Output logged"
 
+    monkeypatch.setattr(
+        deployment, "stream_command_output", lambda *args, **kwargs: 1
+    )
+    assert not deployment.load_and_execute_config_changes(
+        [],
+        DeployMetadata("abc", "def", "/app", "/status", {"execution-mode": "session"}),
+        "abc123",
+    ), "Failed exit status of the script fails the deployment"
+
 
 def test_handle_deployment(monkeypatch, capsys):
     """
@@ -507,3 +623,216 @@ def test_handle_deployment(monkeypatch, capsys):
     assert setup_repos.counter == 2, "Repos set up"
     assert get_commands.counter == 2, "Commands retrieved"
     assert load_execute.counter == 2, "Attempted to run commands"
+
+
+def test_handle_unchanged_deployment(monkeypatch):
+    """
+    .
+    """
+    deploy_config = {
+        "git": {
+            "diff-config-folder": "/diff",
+            "config-folder": "/config",
+            "webhook-url": "/webhook",
+        },
+        "apply-difference-only": True,
+        "skip-unchanged-deployments": True,
+        "store-revision-commands": True,
+    }
+    form = {
+        "deployment": {
+            "statuses_url": "/statuses",
+            "ref": "fed",
+            "payload": {"previous_commit": "abc"},
+        },
+        "action": "created",
+        "repository": {"clone_url": "/clone"},
+    }
+
+    states = []
+    stored = []
+    deployed = []
+    # pylint: disable=unused-argument
+    monkeypatch.setattr(
+        api, "update_deployment_state", lambda *args: states.append(args[-1])
+    )
+    monkeypatch.setattr(api, "setup_config_repo", lambda *args, **kwargs: None)
+    monkeypatch.setattr(db, "update_deployment_status", lambda *args, **kwargs: True)
+    monkeypatch.setattr(deploy_helper, "has_configuration_changes", lambda *args: False)
+    monkeypatch.setattr(deploy_helper, "is_configuration_unchanged", lambda *args: True)
+    monkeypatch.setattr(
+        db,
+        "get_command_snapshot",
+        lambda revision: CommandSnapshot(revision, ["a 1"], {"a": "1"}, [], []),
+    )
+    monkeypatch.setattr(db, "store_command_snapshot", stored.append)
+    monkeypatch.setattr(db, "mark_command_snapshot_deployed", deployed.append)
+
+    @counter_wrapper
+    def connect(*args, **kwargs):
+        """
+        .
+        """
+
+    monkeypatch.setattr(deploy_helper, "get_router_connection", connect)
+    assert deployment.handle_deployment(
+        form, deploy_config, "abc123"
+    ), "Unchanged deployment succeeds"
+    assert states == ["in_progress", "success"], "Deployment marked successful"
+    assert connect.counter == 0, "Router not connected to"
+    assert [snapshot.revision for snapshot in stored] == [
+        "fed"
+    ], "Deployed commands stored for new revision"
+    assert deployed == ["fed"], "New revision commands marked deployed"
+
+
+def test_get_deployed_revision(monkeypatch):
+    """
+    .
+    """
+    deploy_config = {"store-revert-commands": True}
+    statuses = {("abc", "bcd"): "reverted", ("bcd", "cde"): "success"}
+    monkeypatch.setattr(
+        db,
+        "get_deployment",
+        lambda before, after: Deployment(
+            before, after, statuses.get((before, after), "nonexistent"), 0, 0
+        ),
+    )
+    monkeypatch.setattr(
+        db,
+        "get_last_successful_deployment",
+        lambda: Deployment("bcd", "abc", "success", 0, 0),
+    )
+    assert (
+        deployment.get_deployed_revision("bcd", deploy_config) == "abc"
+    ), "Reverted to revision deployed"
+    assert (
+        deployment.get_deployed_revision("bcd", {}) == "bcd"
+    ), "Nothing reverted without revert commands"
+
+    monkeypatch.setattr(
+        db,
+        "get_last_successful_deployment",
+        lambda: Deployment("bcd", "cde", "success", 0, 0),
+    )
+    assert (
+        deployment.get_deployed_revision("cde", deploy_config) == "cde"
+    ), "Previous commit deployed without a revert"
+
+
+def test_get_router_deploy_configs():
+    """
+    .
+    """
+    deploy_config = {"router": {"address": "router", "user": "admin"}}
+    assert deployment.get_router_deploy_configs(deploy_config) == [
+        deploy_config
+    ], "Single router used"
+
+    deploy_config["routers"] = [
+        {"name": "main", "address": "main"},
+        {"address": "office", "user": "office-admin"},
+    ]
+    router_configs = deployment.get_router_deploy_configs(deploy_config)
+    assert [config["router"] for config in router_configs] == [
+        {"name": "main", "address": "main", "user": "admin"},
+        {"address": "office", "user": "office-admin"},
+    ], "Each router overrides the router settings"
+    assert [
+        deployment.get_router_name(config["router"]) for config in router_configs
+    ] == ["main", "office"], "Routers named by address without a name"
+
+
+def test_run_on_routers(monkeypatch, capsys):
+    """
+    .
+    """
+    statuses = []
+    monkeypatch.setattr(
+        db,
+        "update_deployment_router_status",
+        lambda *args: statuses.append(args[2:]),
+    )
+    monkeypatch.setattr(db, "add_deployment_log", lambda *args: True)
+
+    metadata = DeployMetadata("abc", "def", "/app", "/status", {"router": {}})
+    run = counter_wrapper(lambda router_metadata: True)
+    assert deployment.run_on_routers(metadata, run), "Single router succeeds"
+    assert run.counter == 1, "Run once"
+    assert not statuses, "No router status for a single router"
+
+    def run_router(router_metadata: DeployMetadata) -> bool:
+        """
+        .
+        """
+        address = router_metadata.deployment_configuration["router"]["address"]
+        if address == "broken":
+            raise paramiko.SSHException("Connection lost")
+
+        return address != "failing"
+
+    metadata.deployment_configuration["routers"] = [
+        {"address": "main"},
+        {"address": "failing"},
+        {"address": "broken"},
+    ]
+    metadata.deployment_configuration["max-parallel-routers"] = 2
+    assert not deployment.run_on_routers(
+        metadata, run_router
+    ), "Fails if any router fails"
+    assert sorted(statuses) == [
+        ("broken", "failure"),
+        ("broken", "in_progress"),
+        ("failing", "failure"),
+        ("failing", "in_progress"),
+        ("main", "in_progress"),
+        ("main", "success"),
+    ], "Status of each router recorded"
+    assert (
+        "Failed to deploy to router broken: Connection lost" in capsys.readouterr().out
+    ), "Error printed"
+
+    # A router failing to plan fails only itself, leaving GitHub to the caller
+    states = []
+    monkeypatch.setattr(
+        api, "update_deployment_state", lambda *args: states.append(args[-2])
+    )
+    monkeypatch.setattr(db, "get_command_snapshot", lambda revision: None)
+
+    def read_live_commands(deploy_config: dict) -> list:
+        """
+        .
+        """
+        if deploy_config["router"]["address"] == "failing":
+            raise paramiko.SSHException("Connection refused")
+
+        return []
+
+    monkeypatch.setattr(deployment, "read_live_commands", read_live_commands)
+    monkeypatch.setattr(deploy_helper, "get_commands_to_run", lambda *args: [])
+    monkeypatch.setattr(
+        deployment, "load_and_execute_config_changes", lambda *args: True
+    )
+    metadata.deployment_configuration.update(
+        {
+            "routers": [{"address": "main"}, {"address": "failing"}],
+            "plan-against-live-config": True,
+            "apply-difference-only": True,
+            "git": {"diff-config-folder": "/diff", "config-folder": "/config"},
+        }
+    )
+    statuses.clear()
+    assert not deployment.run_on_routers(
+        metadata,
+        lambda router_metadata: deployment.deploy_to_router(
+            router_metadata, "abc123", None, None
+        ),
+    ), "Fails if a router fails to plan"
+    assert sorted(statuses) == [
+        ("failing", "failure"),
+        ("failing", "in_progress"),
+        ("main", "in_progress"),
+        ("main", "success"),
+    ], "Planning failure recorded for its router"
+    assert not states, "GitHub deployment state left to the caller"
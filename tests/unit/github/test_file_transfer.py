@@ -0,0 +1,97 @@
+"""
+File transfer testing
+"""
+import hashlib
+import io
+import tarfile
+
+from ubiquiti_config_generator import testing_router
+from ubiquiti_config_generator.github import file_transfer
+from ubiquiti_config_generator.testing_router import FakeRouter
+
+
+def test_write_files_to_router():
+    """
+    .
+    """
+    router = FakeRouter()
+    try:
+        client = router.connect()
+        assert (
+            file_transfer.write_files_to_router(
+                client, {"/tmp/first.sh": "first", "/tmp/second.sh": "second"}
+            )
+            == []
+        ), "Files written"
+        assert router.read_file("/tmp/first.sh") == "first", "First file written"
+        assert router.read_file("/tmp/second.sh") == "second", "Second file written"
+        assert not router.reads, "Files not read back"
+        assert router.commands == [
+            "sha256sum -- /tmp/first.sh /tmp/second.sh"
+        ], "Files checksummed together"
+
+        assert file_transfer.get_remote_checksums(
+            client, ["/tmp/first.sh", "/tmp/missing.sh"]
+        ) == {
+            "/tmp/first.sh": hashlib.sha256(b"first").hexdigest()
+        }, "Missing file has no checksum"
+
+        # pylint: disable=unused-argument
+        def corrupt_checksum(router, arguments, stdin):
+            """
+            .
+            """
+            router.files["/tmp/second.sh"] = bytearray(b"corrupted")
+            return testing_router.sha256sum(router, arguments, stdin)
+
+        router.command_handlers["sha256sum"] = corrupt_checksum
+        assert file_transfer.write_files_to_router(
+            client, {"/tmp/first.sh": "first", "/tmp/second.sh": "second"}
+        ) == ["/tmp/second.sh"], "Corrupted file found"
+    finally:
+        router.close()
+
+
+def test_write_files_to_router_as_tar():
+    """
+    .
+    """
+    files = {"/tmp/first.sh": "first", "/tmp/second.sh": "second"}
+    router = FakeRouter()
+    try:
+        client = router.connect()
+        assert (
+            file_transfer.write_files_to_router_as_tar(client, files) == []
+        ), "Files written"
+        assert router.read_file("/tmp/first.sh") == "first", "First file written"
+        assert router.read_file("/tmp/second.sh") == "second", "Second file written"
+        assert router.commands == [
+            "tar -xzf - -C / && sha256sum -- /tmp/first.sh /tmp/second.sh | sha256sum"
+        ], "Files extracted and checked in one command"
+
+        # pylint: disable=unused-argument
+        def corrupt_checksum(router, arguments, stdin):
+            """
+            .
+            """
+            router.files["/tmp/second.sh"] = bytearray(b"corrupted")
+            return testing_router.sha256sum(router, arguments, stdin)
+
+        router.command_handlers["sha256sum"] = corrupt_checksum
+        assert file_transfer.write_files_to_router_as_tar(client, files) == [
+            "/tmp/first.sh",
+            "/tmp/second.sh",
+        ], "Every file failed when the manifest does not match"
+    finally:
+        router.close()
+
+
+def test_pack_files():
+    """
+    .
+    """
+    with tarfile.open(
+        fileobj=io.BytesIO(file_transfer.pack_files({"/tmp/first.sh": "first"}))
+    ) as archive:
+        assert archive.getnames() == ["tmp/first.sh"], "Paths relative to root"
+        assert archive.extractfile("tmp/first.sh").read() == b"first", "Data packed"
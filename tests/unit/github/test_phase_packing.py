@@ -0,0 +1,60 @@
+"""
+Test packing command phases into commits
+"""
+from ubiquiti_config_generator.github import phase_packing
+
+
+def test_get_command_resources():
+    """
+    .
+    """
+    assert phase_packing.get_command_resources(
+        "set firewall group address-group admin address 10.0.0.1"
+    ) == ({"address-group admin"}, set()), "Group definition provides group"
+    assert phase_packing.get_command_resources(
+        "set firewall name lan-IN rule 10 source group port-group web"
+    ) == ({"firewall lan-IN"}, {"port-group web"}), "Rule provides and requires"
+    assert phase_packing.get_command_resources(
+        "set interfaces ethernet eth1 vif 10 firewall in name lan-IN"
+    ) == (set(), {"firewall lan-IN"}), "Interface binding requires firewall"
+    assert phase_packing.get_command_resources(
+        "set service nat rule 5000 description 'group address-group x'"
+    ) == (set(), set()), "Quoted description not a group reference"
+    assert phase_packing.get_command_resources("set system host-name router") == (
+        set(),
+        set(),
+    ), "Unrelated command has no resources"
+
+
+def test_pack_phases():
+    """
+    .
+    """
+    assert phase_packing.pack_phases([]) == [], "No phases packs to nothing"
+
+    phases = [
+        ["delete firewall name lan-IN rule"],
+        ["set firewall group address-group admin address 10.0.0.1"],
+        ["set system host-name router"],
+        ["set firewall name lan-IN rule 10 source group address-group admin"],
+        ["set firewall name lan-IN rule 20 action accept"],
+        ["set interfaces ethernet eth1 firewall in name lan-IN"],
+        ["set service dhcp-server shared-network-name lan"],
+    ]
+    assert phase_packing.pack_phases(phases) == [
+        ["delete firewall name lan-IN rule"],
+        [
+            "set firewall group address-group admin address 10.0.0.1",
+            "set system host-name router",
+            "set firewall name lan-IN rule 20 action accept",
+            "set service dhcp-server shared-network-name lan",
+        ],
+        ["set firewall name lan-IN rule 10 source group address-group admin"],
+        ["set interfaces ethernet eth1 firewall in name lan-IN"],
+    ], "Phases packed by dependency"
+
+    assert phase_packing.pack_phases(
+        [[], ["set system host-name router"], ["set system ntp server x"]]
+    ) == [
+        ["set system host-name router", "set system ntp server x"]
+    ], "Empty delete phase dropped"
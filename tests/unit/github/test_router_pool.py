@@ -0,0 +1,114 @@
+"""
+Test the shared router connection pool
+"""
+import paramiko
+import pytest
+
+from ubiquiti_config_generator.github import router_pool
+from ubiquiti_config_generator.testing_router import FakeRouter
+from ubiquiti_config_generator.testing_utils import counter_wrapper
+
+
+def test_connection_reused(monkeypatch):
+    """
+    .
+    """
+    keepalives = []
+    monkeypatch.setattr(paramiko.Transport, "set_keepalive", keepalives.append)
+    router = FakeRouter()
+    connect = counter_wrapper(router.connect)
+    pool = router_pool.RouterConnectionPool(connect, 30)
+    try:
+        with pool.connection() as client:
+            client.exec_command("sha256sum -- /missing")[1].read()
+        with pool.connection() as second_client:
+            assert second_client is client, "Same client handed out"
+
+        assert connect.counter == 1, "Connected once"
+        assert pool.connections == 1, "Single connection counted"
+        assert keepalives == [30], "Keepalive set"
+    finally:
+        pool.discard()
+        router.close()
+
+
+def test_reconnect_after_drop():
+    """
+    .
+    """
+    router = FakeRouter()
+    pool = router_pool.RouterConnectionPool(router.connect)
+    try:
+        first_client = pool.get_client()
+        router.close()
+        first_client.get_transport().join(5)
+
+        with pool.connection() as client:
+            assert client is not first_client, "Dropped connection replaced"
+            stdout = client.exec_command("sha256sum -- /missing")[1]
+            assert stdout.channel.recv_exit_status() == 1, "New connection works"
+
+        assert pool.connections == 2, "Connected again"
+    finally:
+        pool.discard()
+        router.close()
+
+
+def test_failed_connection_discarded():
+    """
+    .
+    """
+    router = FakeRouter()
+    pool = router_pool.RouterConnectionPool(router.connect)
+    try:
+        with pytest.raises(paramiko.SSHException):
+            with pool.connection() as client:
+                router.close()
+                client.get_transport().join(5)
+                client.exec_command("sha256sum")
+
+        assert pool.client is None, "Broken connection discarded"
+
+        with pytest.raises(paramiko.SSHException):
+            with pool.connection():
+                raise paramiko.SSHException("Command failed")
+
+        assert pool.client is not None, "Working connection kept"
+    finally:
+        pool.discard()
+        router.close()
+
+
+def test_get_router_pool():
+    """
+    .
+    """
+    config = {"router": {"address": "router", "user": "admin", "keepalive-seconds": 5}}
+    try:
+        pool = router_pool.get_router_pool(config, lambda config: None)
+        assert pool.keepalive_seconds == 5, "Keepalive configured"
+        assert (
+            router_pool.get_router_pool(config, lambda config: None) is pool
+        ), "Pool shared for the same router"
+        assert (
+            router_pool.get_router_pool(
+                {"router": {"address": "other", "user": "admin"}},
+                lambda config: None,
+            )
+            is not pool
+        ), "Different routers have different pools"
+
+        connected_configs = []
+        rotated_config = {"router": {**config["router"], "password": "rotated"}}
+        rotated_pool = router_pool.get_router_pool(
+            rotated_config, connected_configs.append
+        )
+        assert rotated_pool is not pool, "Different credentials have different pools"
+        rotated_pool.connect()
+        assert connected_configs == [
+            rotated_config
+        ], "Pool connects with its own credentials"
+    finally:
+        router_pool.close_router_pools()
+
+    assert not router_pool.ROUTER_POOLS, "Pools closed"
@@ -4,9 +4,11 @@ Test the DB functionality
 import os
 from os import path
 import sqlite3
+import time
 
 from ubiquiti_config_generator.messages import db
 from ubiquiti_config_generator.messages.check import Check
+from ubiquiti_config_generator.messages.command_snapshot import CommandSnapshot
 from ubiquiti_config_generator.messages.deployment import Deployment
 from ubiquiti_config_generator.messages.log import Log
 from ubiquiti_config_generator.testing_utils import counter_wrapper
@@ -286,6 +288,34 @@ def test_deployment_logs(monkeypatch):
         remove_db_file(db_file)
 
 
+def test_add_deployment_logs():
+    """
+    .
+    """
+    logs = [
+        Log(
+            revision1="bcd123",
+            revision2="cde234",
+            message=message,
+            utc_unix_timestamp=1611608732,
+        )
+        for message in ["ipsum", "lorem"]
+    ]
+
+    db_file = get_test_db_file()
+    try:
+        db.initialize_db(db_file)
+        cursor = db.get_cursor(db_file)
+        assert db.add_deployment_logs([], cursor), "No logs added"
+        assert db.add_deployment_logs(logs, cursor), "Logs added"
+        assert not cursor.connection.in_transaction, "Logs committed"
+        assert (
+            db.get_deployment_logs("bcd123", "cde234", db.get_cursor(db_file)) == logs
+        ), "Logs retrieved from another connection"
+    finally:
+        remove_db_file(db_file)
+
+
 def test_missing_entries():
     """
     .
@@ -410,3 +440,134 @@ def test_update_deployment(monkeypatch):
         assert db.get_deployment("abc123", "cba123") == deployment, "Deployment updated"
     finally:
         remove_db_file(db_file)
+
+
+def test_get_last_successful_deployment():
+    """
+    .
+    """
+    db_file = get_test_db_file()
+    try:
+        cursor = db.initialize_db(db_file)
+        assert (
+            db.get_last_successful_deployment(cursor) is None
+        ), "No deployment without any"
+
+        db.create_deployment(
+            Deployment("abc", "bcd", "success", 1611608700.0, 1611608710.0), cursor
+        )
+        db.create_deployment(
+            Deployment("bcd", "cde", "success", 1611608800.0, 1611608810.0), cursor
+        )
+        db.create_deployment(
+            Deployment("cde", "def", "failure", 1611608900.0, 1611608910.0), cursor
+        )
+        assert db.get_last_successful_deployment(cursor) == Deployment(
+            "bcd", "cde", "success", 1611608800.0, 1611608810.0
+        ), "Latest successful deployment found"
+    finally:
+        remove_db_file(db_file)
+
+
+def test_command_snapshot():
+    """
+    .
+    """
+    snapshot = CommandSnapshot(
+        "abc123",
+        ["system host-name router", "firewall name lan-IN description 'LAN in'"],
+        {
+            "system host-name": "router",
+            "firewall name lan-IN description": "LAN in",
+        },
+        ["lan-IN"],
+        ["lan"],
+        time.time(),
+        {"lan-IN": [(10, '{"action": "accept"}')]},
+    )
+    old_snapshot = CommandSnapshot("123abc", [], {}, [], [], time.time() - 1000)
+
+    db_file = get_test_db_file()
+    try:
+        cursor = db.initialize_db(db_file)
+        assert db.store_command_snapshot(snapshot, cursor), "Snapshot stored"
+        assert db.store_command_snapshot(old_snapshot, cursor), "Old snapshot stored"
+        assert not db.get_command_snapshot(
+            "abc123", cursor
+        ), "Snapshot not used before it is deployed"
+
+        assert db.mark_command_snapshot_deployed("abc123", cursor), "Marked deployed"
+        assert not db.mark_command_snapshot_deployed(
+            "missing", cursor
+        ), "Missing snapshot not marked"
+        assert db.get_command_snapshot("abc123", cursor) == snapshot, "Snapshot loaded"
+
+        assert db.mark_command_snapshot_deployed(
+            "abc123", cursor, deployed=False
+        ), "Marked not deployed"
+        assert not db.get_command_snapshot("abc123", cursor), "Reverted snapshot unused"
+        db.mark_command_snapshot_deployed("abc123", cursor)
+
+        assert db.prune_command_snapshots(500, cursor) == 1, "Old snapshot pruned"
+        db.mark_command_snapshot_deployed("123abc", cursor)
+        assert not db.get_command_snapshot("123abc", cursor), "Pruned snapshot gone"
+        assert db.get_command_snapshot("abc123", cursor), "New snapshot kept"
+    finally:
+        remove_db_file(db_file)
+
+
+def test_revert_commands():
+    """
+    .
+    """
+    db_file = get_test_db_file()
+    try:
+        cursor = db.initialize_db(db_file)
+        assert (
+            db.get_revert_commands("abc123", "cba321", cursor) is None
+        ), "No commands stored"
+        assert db.store_revert_commands(
+            "abc123", "cba321", ["delete system domain-name example.com"], cursor
+        ), "Commands stored"
+        assert db.store_revert_commands(
+            "abc123", "cba321", ["set system host-name router"], cursor
+        ), "Commands replaced"
+        assert db.get_revert_commands("abc123", "cba321", cursor) == [
+            "set system host-name router"
+        ], "Commands loaded"
+        assert (
+            db.get_revert_commands("cba321", "abc123", cursor) is None
+        ), "Commands stored for the deployment only"
+    finally:
+        remove_db_file(db_file)
+
+
+def test_deployment_router_status():
+    """
+    .
+    """
+    db_file = get_test_db_file()
+    try:
+        cursor = db.initialize_db(db_file)
+        assert not db.get_deployment_router_statuses(
+            "abc123", "cba321", cursor
+        ), "No routers deployed to"
+        assert db.update_deployment_router_status(
+            "abc123", "cba321", "office", "in_progress", cursor
+        ), "Status added"
+        assert db.update_deployment_router_status(
+            "abc123", "cba321", "main", "in_progress", cursor
+        ), "Status added for another router"
+        assert db.update_deployment_router_status(
+            "abc123", "cba321", "office", "success", cursor
+        ), "Status updated"
+        assert db.get_deployment_router_statuses("abc123", "cba321", cursor) == {
+            "main": "in_progress",
+            "office": "success",
+        }, "Status of each router loaded"
+
+        cursor.execute("SELECT * FROM deployment_router WHERE router = 'office'")
+        row = cursor.fetchone()
+        assert row["ended_at"] >= row["started_at"], "Completion time recorded"
+    finally:
+        remove_db_file(db_file)
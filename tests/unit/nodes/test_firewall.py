@@ -196,3 +196,40 @@ def test_commands(monkeypatch):
         "firewall name firewall1 default-action accept",
         "firewall name firewall1 description 'Description'",
     ], "Description command is quoted"
+
+
+def test_commands_cached(monkeypatch):
+    """
+    .
+    """
+    firewall = Firewall("firewall1", "in", "network1", ".", rules=[])
+    firewall.add_rule({"action": "drop", "config_path": "."})
+
+    generate = counter_wrapper(Rule._generate_commands)
+    monkeypatch.setattr(Rule, "_generate_commands", generate)
+
+    ordered_commands, command_list = firewall.commands()
+    assert firewall.commands() == (
+        ordered_commands,
+        command_list,
+    ), "Cached commands are the same"
+    assert generate.counter == 1, "Rule commands generated once"
+
+    command_list.append("mutated")
+    assert "mutated" not in firewall.commands()[1], "Cache not mutated by callers"
+
+    setattr(firewall, "default-action", "drop")
+    assert (
+        "firewall name firewall1 default-action drop" in firewall.commands()[1]
+    ), "Firewall attribute change regenerates commands"
+    assert generate.counter == 1, "Unchanged rule still cached"
+
+    firewall.rules[0].action = "reject"
+    assert (
+        "firewall name firewall1 rule 10 action reject" in firewall.commands()[1]
+    ), "Rule attribute change regenerates commands"
+    assert generate.counter == 2, "Changed rule regenerated"
+
+    firewall.add_rule({"action": "accept", "config_path": "."})
+    assert len(firewall.commands()[0]) == 3, "Added rule included in commands"
+    assert generate.counter == 3, "Only the new rule is generated"
@@ -62,3 +62,22 @@ def test_command():
         "firewall group port-group printer-ports description "
         "'Ports for printer connections'",
     ], "Description port group correct"
+
+
+def test_command_cache():
+    """
+    .
+    """
+    group = PortGroup("web-ports", [80])
+    assert group.commands() == [
+        "firewall group port-group web-ports port 80"
+    ], "Initial commands"
+
+    group.add_port(443)
+    assert group.commands() == [
+        "firewall group port-group web-ports port 80",
+        "firewall group port-group web-ports port 443",
+    ], "Adding a port regenerates commands"
+
+    group.add_ports([8080])
+    assert len(group.commands()) == 3, "Adding ports regenerates commands"
@@ -2,7 +2,8 @@
 Tests validatable object
 """
 
-from ubiquiti_config_generator.nodes.validatable import Validatable
+from ubiquiti_config_generator.nodes.validatable import hash_commands, Validatable
+from ubiquiti_config_generator.testing_utils import counter_wrapper
 
 
 # pylint: disable=protected-access
@@ -104,3 +105,57 @@ def test_equals():
     valid2.stuff = 123
     assert valid == valid2, "Is equal, with correct value"
     assert [valid] == [valid2], "Is equal in list as well"
+
+
+def test_cached_commands():
+    """
+    .
+    """
+    obj = Validatable({}, [])
+
+    @counter_wrapper
+    def generate():
+        """
+        .
+        """
+        return ["command"]
+
+    assert obj._cached_commands(generate) == ["command"], "Commands generated"
+    assert obj._cached_commands(generate) == ["command"], "Commands cached"
+    assert generate.counter == 1, "Commands only generated once"
+
+    obj.some_attribute = "value"
+    obj._cached_commands(generate)
+    assert generate.counter == 2, "Setting attribute regenerates commands"
+
+    obj._private = "value"
+    obj._cached_commands(generate)
+    assert generate.counter == 2, "Private attributes do not regenerate commands"
+
+    obj.mark_changed()
+    obj._cached_commands(generate)
+    assert generate.counter == 3, "Marking changed regenerates commands"
+
+
+def test_content_hash(monkeypatch):
+    """
+    .
+    """
+    obj = Validatable({}, [])
+
+    @counter_wrapper
+    def commands():
+        """
+        .
+        """
+        return ([["command"]], ["command"])
+
+    monkeypatch.setattr(obj, "commands", commands, raising=False)
+    content_hash = obj.content_hash()
+    assert content_hash == hash_commands(["command"]), "Flat list hashed"
+    assert obj.content_hash() == content_hash, "Hash reused"
+    assert commands.counter == 1, "Commands only generated once"
+
+    obj.some_attribute = "value"
+    assert obj.content_hash() == content_hash, "Same commands have same hash"
+    assert commands.counter == 2, "Changing node regenerates hash"
@@ -0,0 +1,133 @@
+"""
+Tests the address group registry
+"""
+
+from ubiquiti_config_generator import root_parser
+from ubiquiti_config_generator.address_groups import AddressGroupRegistry
+from ubiquiti_config_generator.nodes import (
+    ExternalAddresses,
+    GlobalSettings,
+    Host,
+    NAT,
+    Network,
+)
+
+
+def make_root() -> root_parser.RootNode:
+    """
+    .
+    """
+    nat = NAT(".", [])
+    network = Network(
+        "network",
+        nat,
+        ".",
+        "10.0.0.0/24",
+        **{"interface-name": "eth0", "firewalls": [], "hosts": []}
+    )
+    for name, address, groups in [
+        ("server", "10.0.0.5", ["servers", "unix"]),
+        ("desktop", "10.0.0.6", ["unix"]),
+    ]:
+        network.hosts.append(
+            Host(
+                name,
+                network,
+                ".",
+                address,
+                **{"mac": "ab:cd:ef:12:34:56", "address-groups": groups}
+            )
+        )
+
+    firewall = network.firewalls_by_direction["in"]
+    for address in ["servers", "unix", "10.0.0.6", "printers", "lab"]:
+        firewall.add_rule({"source": {"address": address}, "config_path": "."})
+    nat.add_rule(
+        {
+            "type": "destination",
+            "destination": {"address": "external-addresses"},
+            "inside-address": {"address": "10.0.0.5"},
+            "config_path": ".",
+        }
+    )
+
+    return root_parser.RootNode(
+        GlobalSettings(**{"firewall/group/address-group/lab/address": "10.1.0.1"}),
+        [],
+        ExternalAddresses(["1.2.3.4"]),
+        [network],
+        nat,
+    )
+
+
+def test_registry():
+    """
+    .
+    """
+    root_node = make_root()
+    registry = root_node.address_groups
+    assert registry is root_node.address_groups, "Registry built once"
+    assert registry.members == {
+        "external-addresses": ["1.2.3.4"],
+        "servers": ["10.0.0.5"],
+        "unix": ["10.0.0.5", "10.0.0.6"],
+    }, "Members indexed"
+    assert registry.commands() == [
+        "firewall group address-group servers address 10.0.0.5",
+        "firewall group address-group unix address 10.0.0.5",
+        "firewall group address-group unix address 10.0.0.6",
+    ], "Commands in host order"
+
+    assert registry.is_defined("lab"), "Global settings group defined"
+    assert registry.is_defined("external-addresses"), "External addresses defined"
+    assert not registry.is_defined("printers"), "Printers not defined"
+    assert list(registry.undefined_groups().keys()) == [
+        "printers"
+    ], "Undefined group found"
+
+    firewall = root_node.networks[0].firewalls_by_direction["in"]
+    assert registry.rules_for_group("unix") == [firewall.rules[1]], "Rule for group"
+    assert [
+        str(rule)
+        for rule in registry.rules_affected_by_host(root_node.networks[0].hosts[1])
+    ] == [
+        "Firewall network-IN rule 30",
+        "Firewall network-IN rule 20",
+    ], "Rules using address and group affected by desktop"
+    assert [
+        str(rule)
+        for rule in registry.rules_affected_by_host(root_node.networks[0].hosts[0])
+    ] == [
+        "NAT rule 10",
+        "Firewall network-IN rule 10",
+        "Firewall network-IN rule 20",
+    ], "Rules using address and groups affected by server"
+
+
+def test_undefined_group_consistency():
+    """
+    .
+    """
+    root_node = make_root()
+    assert not root_node.address_groups_consistent(), "Undefined group inconsistent"
+    assert (
+        "Firewall network-IN rule 40 uses undefined address group printers"
+        in root_node.validation_failures()
+    ), "Validation failure added to rule"
+
+    firewall = root_node.networks[0].firewalls_by_direction["in"]
+    firewall.rules = firewall.rules[:3]
+    assert (
+        not root_node.address_groups_consistent()
+    ), "Registry not rebuilt automatically"
+    root_node.refresh_address_groups()
+    assert root_node.address_groups_consistent(), "No undefined groups after refresh"
+
+
+def test_empty_registry():
+    """
+    .
+    """
+    registry = AddressGroupRegistry.from_configuration(None, None, None, None)
+    assert registry.commands() == [], "No commands"
+    assert registry.undefined_groups() == {}, "No undefined groups"
@@ -0,0 +1,172 @@
+"""
+Tests grouping commands into trees and diffing them
+"""
+
+from ubiquiti_config_generator import command_tree, root_parser
+from ubiquiti_config_generator.github import deploy_helper
+from ubiquiti_config_generator.nodes import (
+    ExternalAddresses,
+    GlobalSettings,
+    Host,
+    NAT,
+    Network,
+    PortGroup,
+)
+
+
+def make_root(network_names=("lan", "lab"), ports=None) -> root_parser.RootNode:
+    """
+    .
+    """
+    nat = NAT(".", [])
+    networks = []
+    for index, name in enumerate(network_names):
+        network = Network(
+            name,
+            nat,
+            ".",
+            "10.{0}.0.0/24".format(index),
+            **{"interface-name": "eth{0}".format(index), "firewalls": [], "hosts": []}
+        )
+        network.hosts.append(
+            Host(
+                "server",
+                network,
+                ".",
+                "10.{0}.0.5".format(index),
+                **{"mac": "ab:cd:ef:12:34:56"}
+            )
+        )
+        firewall = network.firewalls_by_direction["in"]
+        for port in ports or [22, 80, 443]:
+            firewall.add_rule(
+                {
+                    "action": "accept",
+                    "destination": {"port": port},
+                    "config_path": ".",
+                }
+            )
+        networks.append(network)
+
+    nat.add_rule(
+        {
+            "type": "masquerade",
+            "outbound-interface": "eth0",
+            "number": 5000,
+            "config_path": ".",
+        }
+    )
+
+    return root_parser.RootNode(
+        GlobalSettings(**{"system/host-name": "router"}),
+        [PortGroup("web", [80, 443])],
+        ExternalAddresses(["1.2.3.4"]),
+        networks,
+        nat,
+    )
+
+
+def test_build_tree():
+    """
+    .
+    """
+    root_node = make_root()
+    command_list = root_node.get_commands()[1]
+    tree = root_node.get_command_tree(command_list)
+
+    assert tree.flatten() == command_list, "Tree contains commands in order"
+    assert [child.name for child in tree.children()] == [
+        "port-group/web",
+        "nat/rule/5000",
+        "network/lan",
+        "network/lab",
+    ], "Root children found"
+
+    lan_in = tree.children()[2].children()[0]
+    assert lan_in.name == "firewall/lan-IN", "Firewall is network child"
+    assert lan_in.namespace == "firewall name lan-IN ", "Firewall has namespace"
+    assert [rule.name for rule in lan_in.children()] == [
+        "firewall/lan-IN/rule/10",
+        "firewall/lan-IN/rule/20",
+        "firewall/lan-IN/rule/30",
+    ], "Rules are firewall children"
+
+    mismatched = root_node.get_command_tree(["something else"])
+    assert mismatched.items == ["something else"], "Mismatched commands in root"
+
+
+def test_prune_identical_subtrees():
+    """
+    .
+    """
+    previous = make_root().get_command_tree()
+    current_root = make_root()
+    rule = current_root.networks[1].firewalls_by_direction["in"].rules[1]
+    rule.destination = {"port": 8080}
+    current = current_root.get_command_tree()
+
+    (
+        current_commands,
+        previous_commands,
+        namespaces,
+    ) = command_tree.prune_identical_subtrees(current, previous)
+    assert (
+        "firewall name lab-IN rule 20 destination port 8080" in current_commands
+    ), "Changed rule compared"
+    assert (
+        "firewall name lab-IN rule 20 destination port 80" in previous_commands
+    ), "Previous rule compared"
+    assert "firewall name lan-IN " in namespaces, "Unchanged firewall skipped"
+    assert "firewall name lab-IN rule 10 " in namespaces, "Unchanged rule skipped"
+    assert not any(
+        [command.startswith("firewall name lan-IN ") for command in current_commands]
+    ), "Skipped commands not compared"
+
+    difference = deploy_helper.diff_command_trees(current, previous)
+    full_difference = deploy_helper.diff_configurations(
+        current.flatten(), previous.flatten()
+    )
+    for category in ["added", "removed", "changed"]:
+        assert getattr(difference, category) == getattr(
+            full_difference, category
+        ), "Same {0} commands as full diff".format(category)
+
+    assert difference.changed == {
+        "firewall name lab-IN rule 20 destination port": "8080"
+    }, "Only the changed rule differs"
+
+
+def test_namespace_collision(monkeypatch):
+    """
+    .
+    """
+    assert command_tree.has_namespace_collision(
+        ["firewall name lan-IN rule 10 action drop"], ["firewall name lan-IN "]
+    ), "Command in skipped namespace collides"
+    assert not command_tree.has_namespace_collision(
+        ["firewall name lan-INSIDE default-action drop"], ["firewall name lan-IN "]
+    ), "Namespace must match whole names"
+    assert not command_tree.has_namespace_collision(["a b c"], []), "Nothing skipped"
+
+    # Both networks have a firewall with the same name, so skipping the unchanged one
+    # would change how the other is compared
+    def make_duplicate_root() -> root_parser.RootNode:
+        root_node = make_root()
+        root_node.networks[1].firewalls_by_direction["in"].name = "lan-IN"
+        return root_node
+
+    previous = make_duplicate_root().get_command_tree()
+    current_root = make_duplicate_root()
+    current_root.networks[1].firewalls_by_direction["in"].rules[0].action = "drop"
+    current = current_root.get_command_tree()
+
+    original_diff = deploy_helper.diff_configurations
+    diffed = []
+
+    def diff_configurations(current_commands, previous_commands):
+        diffed.append(len(current_commands))
+        return original_diff(current_commands, previous_commands)
+
+    monkeypatch.setattr(deploy_helper, "diff_configurations", diff_configurations)
+    deploy_helper.diff_command_trees(current, previous)
+    assert diffed == [len(current.flatten())], "Collision compares everything"
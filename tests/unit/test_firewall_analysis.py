@@ -0,0 +1,292 @@
+"""
+Tests firewall rule coverage analysis
+"""
+
+from ubiquiti_config_generator import firewall_analysis, root_parser
+from ubiquiti_config_generator.nodes import (
+    ExternalAddresses,
+    Firewall,
+    GlobalSettings,
+    Host,
+    NAT,
+    Network,
+    PortGroup,
+    Rule,
+)
+
+
+def make_firewall(rules: list) -> Firewall:
+    """
+    .
+    """
+    return Firewall(
+        "firewall",
+        "in",
+        "network",
+        ".",
+        rules=[
+            Rule(number, "firewall", ".", **properties) for number, properties in rules
+        ],
+    )
+
+
+def test_address_to_interval():
+    """
+    .
+    """
+    assert firewall_analysis.address_to_interval("10.0.0.1") == (
+        167772161,
+        167772161,
+    ), "Single address"
+    assert firewall_analysis.address_to_interval("10.0.0.0/24") == (
+        167772160,
+        167772415,
+    ), "Network"
+    assert firewall_analysis.address_to_interval("10.0.0.1-10.0.0.3") == (
+        167772161,
+        167772163,
+    ), "Range"
+    assert firewall_analysis.address_to_interval("a-group") is None, "Not address"
+
+
+def test_single_rule_coverage():
+    """
+    .
+    """
+    firewall = make_firewall(
+        [
+            (10, {"action": "drop", "source": {"address": "10.0.0.0/24"}}),
+            (20, {"action": "accept", "source": {"address": "10.0.0.5"}}),
+            (
+                30,
+                {
+                    "action": "drop",
+                    "protocol": "tcp",
+                    "source": {"address": "10.0.0.0/25", "port": 80},
+                },
+            ),
+            (40, {"action": "accept", "source": {"address": "10.0.1.5"}}),
+            (
+                50,
+                {
+                    "action": "accept",
+                    "destination": {"port": "web"},
+                    "source": {"address": "10.0.1.5"},
+                },
+            ),
+            (60, {"action": "accept", "destination": {"port": 443}}),
+        ]
+    )
+    analysis = firewall_analysis.analyze_firewall(firewall, {"web": [80, 443]}, {})
+
+    assert [finding.rule_number for finding in analysis.shadowed] == [
+        20
+    ], "Rule 20 shadowed"
+    assert [
+        (finding.rule_number, finding.covering_rules) for finding in analysis.redundant
+    ] == [(30, [10]), (50, [40])], "Rules 30 and 50 redundant"
+    assert not analysis.unreachable, "Nothing unreachable"
+    assert analysis.messages() == [
+        "Firewall firewall rule 20 is shadowed by rule 10, "
+        "which has a different action",
+        "Firewall firewall rule 30 is redundant with rule 10, "
+        "which has the same action",
+        "Firewall firewall rule 50 is redundant with rule 40, "
+        "which has the same action",
+    ], "Messages correct"
+
+
+def test_union_coverage():
+    """
+    .
+    """
+    firewall = make_firewall(
+        [
+            (10, {"action": "accept", "protocol": "tcp", "destination": {"port": 22}}),
+            (20, {"action": "drop", "protocol": "udp", "destination": {"port": 22}}),
+            (
+                30,
+                {
+                    "action": "accept",
+                    "protocol": "tcp_udp",
+                    "destination": {"port": 22},
+                },
+            ),
+            (40, {"action": "drop", "state": {"new": "enable"}}),
+            (50, {"action": "drop", "state": {"new": "enable", "invalid": "enable"}}),
+        ]
+    )
+    analysis = firewall_analysis.analyze_firewall(firewall, {}, {})
+
+    assert [
+        (finding.rule_number, finding.covering_rules)
+        for finding in analysis.unreachable
+    ] == [(30, [10, 20])], "Rule 30 covered by the union of 10 and 20"
+    assert not analysis.shadowed, "Nothing shadowed"
+    assert not analysis.redundant, "Partial state coverage is not redundant"
+
+
+def test_groups():
+    """
+    .
+    """
+    firewall = make_firewall(
+        [
+            (10, {"action": "accept", "source": {"address": "printers"}}),
+            (20, {"action": "drop", "source": {"address": "10.0.0.5"}}),
+            (30, {"action": "drop", "source": {"address": "10.0.0.6"}}),
+            (40, {"action": "drop", "source": {"address": "unknown"}}),
+            (50, {"action": "drop", "source": {"address": "unknown"}}),
+            (60, {"action": "drop", "destination": {"port": "missing"}}),
+        ]
+    )
+    analysis = firewall_analysis.analyze_firewall(
+        firewall, {}, {"printers": ["10.0.0.5", "10.0.0.10"]}
+    )
+
+    assert [(finding.rule_number, finding.kind) for finding in analysis.findings] == [
+        (20, "shadowed"),
+        (50, "redundant"),
+    ], "Groups resolved to members"
+
+
+def test_analyze_configuration():
+    """
+    .
+    """
+    network = Network(
+        "network",
+        NAT(".", []),
+        ".",
+        "10.0.0.0/24",
+        **{"interface-name": "eth0", "firewalls": [], "hosts": []}
+    )
+    network.hosts.append(
+        Host(
+            "host",
+            network,
+            ".",
+            "10.0.0.5",
+            **{"mac": "ab:cd:ef:12:34:56", "address-groups": ["servers"]}
+        )
+    )
+    firewall = network.firewalls_by_direction["in"]
+    firewall.add_rule(
+        {"action": "drop", "source": {"address": "servers"}, "config_path": "."}
+    )
+    firewall.add_rule(
+        {"action": "accept", "source": {"address": "10.0.0.5"}, "config_path": "."}
+    )
+    firewall.add_rule(
+        {
+            "action": "accept",
+            "destination": {"address": "external-addresses", "port": "web"},
+            "config_path": ".",
+        }
+    )
+    firewall.add_rule(
+        {
+            "action": "accept",
+            "destination": {"address": "1.2.3.4", "port": 80},
+            "config_path": ".",
+        }
+    )
+
+    root_node = root_parser.RootNode(
+        GlobalSettings(),
+        [PortGroup("web", [80, 443])],
+        ExternalAddresses(["1.2.3.4"]),
+        [network],
+        NAT(".", []),
+    )
+    analyses = firewall_analysis.analyze_configuration(root_node)
+    assert [analysis.firewall_name for analysis in analyses] == [
+        "network-IN",
+        "network-OUT",
+        "network-LOCAL",
+    ], "All firewalls analyzed"
+    assert [
+        (finding.rule_number, finding.kind) for finding in analyses[0].findings
+    ] == [(20, "shadowed"), (40, "redundant")], "Configuration groups resolved"
+
+
+def test_rules_matching_everything():
+    """
+    .
+    """
+    firewall = make_firewall(
+        [(number, {"action": "accept"}) for number in range(1, 4)]
+        + [
+            (10, {"action": "drop", "source": {"address": "10.0.0.0/8"}}),
+            (20, {"action": "drop", "destination": {"port": 443}}),
+        ]
+    )
+    analysis = firewall_analysis.analyze_firewall(firewall, {}, {})
+    assert [
+        (finding.rule_number, finding.kind, finding.covering_rules)
+        for finding in analysis.findings
+    ] == [
+        (2, firewall_analysis.REDUNDANT, [1]),
+        (3, firewall_analysis.REDUNDANT, [1]),
+        (10, firewall_analysis.SHADOWED, [1]),
+        (20, firewall_analysis.SHADOWED, [1]),
+    ], "Rules matching everything cover every later rule"
+
+
+def test_rules_disabling_states():
+    """
+    .
+    """
+    firewall = make_firewall(
+        [
+            (
+                10,
+                {
+                    "action": "accept",
+                    "protocol": "tcp",
+                    "destination": {"port": 22},
+                    "state": {"established": "enable"},
+                },
+            ),
+            (
+                20,
+                {
+                    "action": "drop",
+                    "protocol": "tcp",
+                    "destination": {"port": 22},
+                    "state": {"new": "disable"},
+                },
+            ),
+            (30, {"action": "drop", "protocol": "tcp", "destination": {"port": 22}}),
+        ]
+    )
+    analysis = firewall_analysis.analyze_firewall(firewall, {}, {})
+    assert [
+        (finding.rule_number, finding.kind, finding.covering_rules)
+        for finding in analysis.findings
+    ] == [
+        (30, firewall_analysis.REDUNDANT, [20]),
+    ], "Rule enabling no states matches every state"
+
+
+def test_unknown_protocols():
+    """
+    .
+    """
+    firewall = make_firewall(
+        [
+            (10, {"action": "accept", "protocol": "icmp"}),
+            (20, {"action": "drop", "protocol": "gre"}),
+            (30, {"action": "drop", "protocol": "icmp"}),
+            (40, {"action": "drop"}),
+            (50, {"action": "accept", "protocol": "esp"}),
+        ]
+    )
+    analysis = firewall_analysis.analyze_firewall(firewall, {}, {})
+    assert [
+        (finding.rule_number, finding.kind, finding.covering_rules)
+        for finding in analysis.findings
+    ] == [
+        (30, firewall_analysis.SHADOWED, [10]),
+        (50, firewall_analysis.SHADOWED, [40]),
+    ], "Unknown protocols only cover themselves, and are covered by every protocol"
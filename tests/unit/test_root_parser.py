@@ -4,6 +4,11 @@ Tests the root parser
 
 # pylint: disable=protected-access
 
+import os
+import shutil
+
+import yaml
+
 from ubiquiti_config_generator import (
     root_parser,
     file_paths,
@@ -335,3 +340,31 @@ def test_get_commands(monkeypatch):
         "network2-command2",
         "network2-command3",
     ], "Command list correct"
+
+
+def test_content_hash(tmp_path):
+    """
+    .
+    """
+    config_path = str(tmp_path / "config")
+    shutil.copytree("sample_router_config", config_path)
+    original_hash = root_parser.RootNode.create_from_configs(config_path).content_hash()
+
+    host_path = os.path.join(
+        config_path, "networks", "internal", "hosts", "laptop.yaml"
+    )
+    host_config = file_paths.load_yaml_from_file(host_path)
+    with open(host_path, "w") as host_file:
+        yaml.dump(host_config, host_file, default_flow_style=True)
+    assert (
+        root_parser.RootNode.create_from_configs(config_path).content_hash()
+        == original_hash
+    ), "Formatting does not change hash"
+
+    host_config["address"] = "10.0.12.111"
+    with open(host_path, "w") as host_file:
+        yaml.dump(host_config, host_file)
+    assert (
+        root_parser.RootNode.create_from_configs(config_path).content_hash()
+        != original_hash
+    ), "Configuration change changes hash"
@@ -0,0 +1,486 @@
+"""
+Test the simulated router
+"""
+import os
+import shlex
+import shutil
+
+import pytest
+
+from ubiquiti_config_generator import root_parser, file_paths
+from ubiquiti_config_generator.github import api, deploy_helper, deployment
+from ubiquiti_config_generator.messages import db
+from ubiquiti_config_generator.messages.deployment import Deployment
+from ubiquiti_config_generator.router_simulator import RouterSimulator
+from ubiquiti_config_generator.testing_utils import counter_wrapper
+
+
+def get_config_commands(config_path: str):
+    """
+    The distinct commands of a configuration, split into tokens to compare them
+    regardless of quoting
+    """
+    return {
+        tuple(shlex.split(command))
+        for command in root_parser.RootNode.create_from_configs(
+            config_path
+        ).get_commands()[1]
+    }
+
+
+def get_running_commands(simulator: RouterSimulator):
+    """
+    The commands running on the simulated router, split into tokens
+    """
+    return {tuple(shlex.split(command)) for command in simulator.get_commands()}
+
+
+@pytest.fixture(name="simulator")
+def fixture_simulator(tmp_path):
+    """
+    A simulator with the sample configuration running
+    """
+    root_node = root_parser.RootNode.create_from_configs("sample_router_config")
+    simulator = RouterSimulator(str(tmp_path / "router"))
+    simulator.load_commands(root_node.get_commands()[1])
+    yield simulator
+    simulator.close()
+
+
+def test_wrapper(simulator):
+    """
+    .
+    """
+    assert simulator.run_wrapper(["set", "system", "host-name", "simulated"]) == (
+        1,
+        "Not in a configuration session",
+    ), "Session needed to set"
+
+    simulator.run_wrapper(["begin"])
+    simulator.run_wrapper(["set", "system", "host-name", "simulated"])
+    simulator.run_wrapper(["set", "system", "name-server", "1.1.1.1"])
+    simulator.run_wrapper(["set", "system", "name-server", "8.8.8.8"])
+    assert simulator.session["system host-name"] == ["simulated"], "Value replaced"
+    assert simulator.session["system name-server"] == [
+        "1.1.1.1",
+        "8.8.8.8",
+    ], "Multiple values kept"
+    assert simulator.running["system host-name"] == [
+        "router"
+    ], "Running configuration unchanged before commit"
+
+    assert simulator.run_wrapper(["delete", "firewall", "name", "missing"]) == (
+        1,
+        "Nothing to delete (the specified node does not exist)",
+    ), "Missing node not deleted"
+    assert simulator.run_wrapper(["delete", "firewall", "group"]) == (
+        0,
+        "",
+    ), "Groups deleted"
+    assert not [
+        key for key in simulator.session if key.startswith("firewall group ")
+    ], "Everything under the path deleted"
+
+    status, output = simulator.run_wrapper(["commit"])
+    assert status == 1, "Commit fails with missing groups"
+    assert output.startswith("Commit failed, missing "), "Missing groups reported"
+    assert not simulator.commits[-1].succeeded, "Failed commit recorded"
+
+    simulator.run_wrapper(["discard"])
+    simulator.run_wrapper(["set", "system", "host-name", "simulated"])
+    assert simulator.run_wrapper(["commit"]) == (0, ""), "Commit succeeds"
+    assert simulator.running["system host-name"] == ["simulated"], "Value committed"
+    assert simulator.commits[-1].commands == 1, "Commands in commit counted"
+    assert simulator.saved != simulator.running, "Not saved yet"
+    simulator.run_wrapper(["save"])
+    assert simulator.saved == simulator.running, "Saved"
+
+
+DEPLOYMENT_FORM = {
+    "deployment": {
+        "statuses_url": "/statuses",
+        "ref": "fed",
+        "payload": {"previous_commit": "abc"},
+    },
+    "action": "created",
+    "repository": {"clone_url": "/clone"},
+}
+
+
+def create_changed_config(tmp_path) -> str:
+    """
+    Copies the sample configuration with a host's address changed, returning
+    its path
+    """
+    current_path = str(tmp_path / "current")
+    shutil.copytree("sample_router_config", current_path)
+    host_path = os.path.join(current_path, "networks", "internal", "hosts")
+    with open(os.path.join(host_path, "laptop.yaml")) as host_file:
+        host_config = host_file.read()
+    with open(os.path.join(host_path, "laptop.yaml"), "w") as host_file:
+        host_file.write(host_config.replace("10.0.12.101", "10.0.12.111"))
+
+    return current_path
+
+
+def get_deploy_config(current_path: str, deploy_options: dict) -> dict:
+    """
+    The deployment configuration from the sample configuration to a changed one
+    """
+    return {
+        "git": {
+            "diff-config-folder": current_path,
+            "config-folder": "sample_router_config",
+            "webhook-url": "/webhook",
+        },
+        "apply-difference-only": True,
+        "pack-command-phases": True,
+        "auto-rollback-on-failure": True,
+        "reboot-after-minutes": 10,
+        "save-after-commit": False,
+        "store-revert-commands": True,
+        "store-revision-commands": True,
+        "revision-commands-max-age-days": 30,
+        "skip-unchanged-deployments": True,
+        **deploy_options,
+    }
+
+
+def patch_deployment(monkeypatch, deploy_config: dict, connect):
+    """
+    Patches out everything but the router, returning the deployment states sent
+    to GitHub and the revert commands stored
+    """
+    load_yaml = file_paths.load_yaml_from_file
+    monkeypatch.setattr(
+        file_paths,
+        "load_yaml_from_file",
+        lambda file_path: deploy_config
+        if file_path == "deploy.yaml"
+        else load_yaml(file_path),
+    )
+    monkeypatch.setattr(deploy_helper, "get_router_connection", connect)
+    states = []
+    monkeypatch.setattr(
+        api, "update_deployment_state", lambda *args: states.append(args[5])
+    )
+    monkeypatch.setattr(api, "setup_config_repo", lambda *args, **kwargs: None)
+    monkeypatch.setattr(db, "update_deployment_status", lambda *args: True)
+    monkeypatch.setattr(db, "add_deployment_log", lambda *args: True)
+    monkeypatch.setattr(db, "add_deployment_logs", lambda *args: True)
+    monkeypatch.setattr(db, "create_deployment", lambda *args: True)
+    monkeypatch.setattr(db, "get_last_successful_deployment", lambda: None)
+    # The sample configuration was deployed, so its commands are stored
+    previous_node = root_parser.RootNode.create_from_configs("sample_router_config")
+    previous_snapshot = deploy_helper.create_command_snapshot(
+        "abc", previous_node, previous_node.get_commands()[1]
+    )
+    monkeypatch.setattr(
+        db,
+        "get_command_snapshot",
+        lambda revision: previous_snapshot if revision == "abc" else None,
+    )
+    monkeypatch.setattr(db, "store_command_snapshot", lambda *args: True)
+    monkeypatch.setattr(
+        db, "mark_command_snapshot_deployed", lambda *args, **kwargs: True
+    )
+    monkeypatch.setattr(db, "prune_command_snapshots", lambda *args: 0)
+    revert_commands = {}
+    monkeypatch.setattr(
+        db,
+        "store_revert_commands",
+        lambda before, after, commands: revert_commands.update(
+            {(before, after): commands}
+        ),
+    )
+
+    return states, revert_commands
+
+
+@pytest.mark.parametrize(
+    "deploy_options",
+    [
+        {"apply-difference-only": True},
+        {"apply-difference-only": False},
+        {"execution-mode": "session", "compact-command-scripts": True},
+        {"plan-against-live-config": True, "router": {"upload-mode": "tar"}},
+        {"execution-mode": "pipelined"},
+    ],
+)
+def test_simulated_deployment(monkeypatch, tmp_path, simulator, deploy_options):
+    """
+    .
+    """
+    current_path = create_changed_config(tmp_path)
+    deploy_config = get_deploy_config(
+        current_path,
+        {
+            "script-cfg-path": simulator.cfg_wrapper_path,
+            **deploy_options,
+            "router": {
+                "command-file-path": simulator.directory,
+                **deploy_options.get("router", {}),
+            },
+        },
+    )
+    states, revert_commands = patch_deployment(
+        monkeypatch, deploy_config, lambda config: simulator.connect()
+    )
+    create_from_configs = counter_wrapper(root_parser.RootNode.create_from_configs)
+    monkeypatch.setattr(
+        root_parser.RootNode, "create_from_configs", create_from_configs
+    )
+
+    assert deployment.handle_deployment(
+        DEPLOYMENT_FORM, deploy_config, "abc123"
+    ), "Deployment succeeds"
+    assert (
+        create_from_configs.counter == 2
+    ), "Configurations loaded once for comparing and planning"
+    assert states == ["in_progress", "success"], "Deployment marked successful"
+    assert get_running_commands(simulator) == get_config_commands(
+        current_path
+    ), "Router configuration matches the new configuration"
+    assert simulator.commits, "Changes committed"
+    assert all([commit.succeeded for commit in simulator.commits]), "Commits succeed"
+    assert simulator.reboot_minutes == 10, "Reboot scheduled"
+
+    deployed_snapshots = {}
+    monkeypatch.setattr(
+        db,
+        "mark_command_snapshot_deployed",
+        lambda revision, deployed=True: deployed_snapshots.update({revision: deployed}),
+    )
+    assert deployment.revert_deployment(
+        "abc", "fed", revert_commands[("abc", "fed")], deploy_config
+    ), "Revert succeeds"
+    assert deployed_snapshots == {"fed": False}, "Reverted revision not deployed"
+    assert get_running_commands(simulator) == get_config_commands(
+        "sample_router_config"
+    ), "Router configuration matches the previous configuration"
+
+    # The next deployment is from the reverted revision, but the router is back
+    # at the one before it, so plans from that
+    monkeypatch.setattr(
+        db,
+        "get_last_successful_deployment",
+        lambda: Deployment("fed", "abc", "success", 0, 0),
+    )
+    monkeypatch.setattr(
+        db,
+        "get_deployment",
+        lambda before, after: Deployment(before, after, "reverted", 0, 0),
+    )
+    repositories = []
+    monkeypatch.setattr(
+        api, "setup_config_repo", lambda token, repos: repositories.extend(repos)
+    )
+    assert deployment.handle_deployment(
+        {
+            **DEPLOYMENT_FORM,
+            "deployment": {
+                **DEPLOYMENT_FORM["deployment"],
+                "ref": "edc",
+                "payload": {"previous_commit": "fed"},
+            },
+        },
+        deploy_config,
+        "abc123",
+    ), "Deployment after the revert succeeds"
+    assert [repository.revision for repository in repositories] == [
+        "edc",
+        "abc",
+    ], "Previous configuration checked out at the reverted to revision"
+    assert get_running_commands(simulator) == get_config_commands(
+        current_path
+    ), "Reverted changes applied again"
+
+
+@pytest.mark.parametrize("plan_against_live_config", [False, True])
+def test_simulated_multiple_routers(monkeypatch, tmp_path, plan_against_live_config):
+    """
+    .
+    """
+    root_node = root_parser.RootNode.create_from_configs("sample_router_config")
+    simulators = {}
+    for name in ["main", "office", "lab"]:
+        simulators[name] = RouterSimulator(str(tmp_path / name))
+        simulators[name].load_commands(root_node.get_commands()[1])
+
+    current_path = create_changed_config(tmp_path)
+    deploy_config = get_deploy_config(
+        current_path,
+        {
+            "plan-against-live-config": plan_against_live_config,
+            # Each simulator puts its own wrapper first in the path
+            "script-cfg-path": "vyatta-cfg-cmd-wrapper",
+            "router": {"user": "admin"},
+            "routers": [
+                {
+                    "name": name,
+                    "address": name,
+                    "command-file-path": simulator.directory,
+                }
+                for name, simulator in simulators.items()
+            ],
+            "max-parallel-routers": 2,
+        },
+    )
+    states, revert_commands = patch_deployment(
+        monkeypatch,
+        deploy_config,
+        lambda config: simulators[config["router"]["address"]].connect(),
+    )
+    get_commands_to_run = counter_wrapper(deploy_helper.get_commands_to_run)
+    monkeypatch.setattr(deploy_helper, "get_commands_to_run", get_commands_to_run)
+    router_statuses = []
+    monkeypatch.setattr(
+        db,
+        "update_deployment_router_status",
+        lambda *args: router_statuses.append(args[2:]),
+    )
+
+    try:
+        assert deployment.handle_deployment(
+            DEPLOYMENT_FORM, deploy_config, "abc123"
+        ), "Deployment succeeds"
+        assert states == ["in_progress", "success"], "Deployment marked successful"
+        for name, simulator in simulators.items():
+            assert get_running_commands(simulator) == get_config_commands(
+                current_path
+            ), f"Router {name} configuration matches the new configuration"
+
+        assert get_commands_to_run.counter == (
+            3 if plan_against_live_config else 1
+        ), "Planned once, unless planning against each router"
+        assert sorted(router_statuses) == sorted(
+            [(name, "in_progress") for name in simulators]
+            + [(name, "success") for name in simulators]
+        ), "Status of each router recorded"
+        assert bool(revert_commands) != (
+            plan_against_live_config
+        ), "Revert commands only stored for a shared plan"
+    finally:
+        for simulator in simulators.values():
+            simulator.close()
+
+
+def test_simulated_failure(monkeypatch, simulator):
+    """
+    .
+    """
+    deploy_config = {
+        "auto-rollback-on-failure": True,
+        "reboot-after-minutes": None,
+        "save-after-commit": False,
+        "script-cfg-path": simulator.cfg_wrapper_path,
+        "execution-mode": "session",
+        "router": {"command-file-path": simulator.directory},
+    }
+    monkeypatch.setattr(
+        deploy_helper, "get_router_connection", lambda config: simulator.connect()
+    )
+    monkeypatch.setattr(db, "add_deployment_log", lambda *args: True)
+    logs = []
+    monkeypatch.setattr(
+        db,
+        "add_deployment_logs",
+        lambda batch: logs.extend([log.message for log in batch]) or True,
+    )
+    monkeypatch.setattr(deployment, "fail_deployment", lambda *args: None)
+
+    assert not deployment.load_and_execute_config_changes(
+        [
+            ["set system host-name changed"],
+            ["delete firewall name missing", "set system domain-name changed"],
+        ],
+        deployment.DeployMetadata("abc", "def", "/app", "/status", deploy_config),
+        "abc123",
+    ), "Deployment fails"
+    assert (
+        "Failed to execute command: delete firewall name missing" in logs
+    ), "Failure logged"
+    assert simulator.running["system host-name"] == ["changed"], "First phase committed"
+    assert "system domain-name" not in simulator.running, "Second phase discarded"
+    assert [commit.commands for commit in simulator.commits] == [
+        1
+    ], "Only the first phase committed"
+
+
+def test_pipelined_phases(monkeypatch, simulator):
+    """
+    .
+    """
+    deploy_config = {
+        "auto-rollback-on-failure": True,
+        "reboot-after-minutes": None,
+        "save-after-commit": False,
+        "script-cfg-path": simulator.cfg_wrapper_path,
+        "execution-mode": "pipelined",
+        "router": {"command-file-path": simulator.directory},
+    }
+    monkeypatch.setattr(
+        deploy_helper, "get_router_connection", lambda config: simulator.connect()
+    )
+    logs = []
+    monkeypatch.setattr(
+        db, "add_deployment_log", lambda log: logs.append(log.message) or True
+    )
+    monkeypatch.setattr(db, "add_deployment_logs", lambda *args: True)
+    monkeypatch.setattr(deployment, "fail_deployment", lambda *args: None)
+
+    # Record the files already uploaded when each phase commits
+    uploaded_at_commit = []
+    commit = simulator.commit
+
+    def record_commit():
+        uploaded_at_commit.append(
+            sorted([os.path.basename(file_path) for file_path in simulator.files])
+        )
+        return commit()
+
+    monkeypatch.setattr(simulator, "commit", record_commit)
+
+    metadata = deployment.DeployMetadata("abc", "def", "/app", "/status", deploy_config)
+    assert deployment.load_and_execute_config_changes(
+        [
+            ["set system host-name changed"],
+            [],
+            ["set system domain-name changed"],
+            ["set system time-zone UTC"],
+        ],
+        metadata,
+        "abc123",
+    ), "Deployment succeeds"
+    assert uploaded_at_commit[0] == [
+        "abc..def-000.sh",
+        "abc..def-001.sh",
+    ], "Next phase uploaded before the first commits"
+    assert [commit.commands for commit in simulator.commits] == [
+        1,
+        1,
+        1,
+    ], "Each non-empty phase committed separately"
+    assert simulator.running["system time-zone"] == ["UTC"], "Last phase committed"
+    assert "Running phase 2 of 3" in logs, "Phases logged"
+
+    simulator.files.clear()
+    simulator.commits.clear()
+    assert not deployment.load_and_execute_config_changes(
+        [
+            ["set system host-name again"],
+            ["delete firewall name missing"],
+            ["set system domain-name again"],
+            ["set system time-zone GMT"],
+        ],
+        metadata,
+        "abc123",
+    ), "Deployment fails"
+    assert simulator.running["system host-name"] == ["again"], "First phase committed"
+    assert simulator.running["system domain-name"] == [
+        "changed"
+    ], "Phases after the failure not run"
+    assert (
+        "abc..def-003.sh" not in simulator.files
+    ), "Phases after the next not uploaded"
+    assert "Cancelled 2 remaining phases" in logs, "Cancelled phases logged"
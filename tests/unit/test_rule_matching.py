@@ -0,0 +1,133 @@
+"""
+Tests matching firewall rules by content
+"""
+
+from ubiquiti_config_generator import rule_matching
+from ubiquiti_config_generator.nodes import Firewall
+
+
+def make_firewall(rules: list) -> Firewall:
+    """
+    .
+    """
+    firewall = Firewall("firewall", "in", "network", ".", **{"auto-increment": 10})
+    for rule in rules:
+        firewall.add_rule(dict(rule, config_path="."))
+
+    return firewall
+
+
+def test_match_sequences():
+    """
+    .
+    """
+    assert rule_matching.match_sequences(["a", "new", "b", "c"], ["a", "b", "c"]) == {
+        0: 0,
+        2: 1,
+        3: 2,
+    }, "Insertion matched"
+    assert rule_matching.match_sequences(
+        ["a", "c", "b", "d"], ["a", "b", "c", "d"]
+    ) == {0: 0, 2: 1, 3: 3}, "Moved rule left unmatched"
+    assert rule_matching.match_sequences([], ["a"]) == {}, "Nothing to match"
+
+
+def test_pin_rule_numbers():
+    """
+    .
+    """
+    previous = make_firewall(
+        [{"description": "a"}, {"description": "b"}, {"description": "c"}]
+    )
+    current = make_firewall(
+        [
+            {"description": "a"},
+            {"description": "new"},
+            {"description": "b"},
+            {"description": "c"},
+        ]
+    )
+    assert [rule.number for rule in current.rules] == [
+        10,
+        20,
+        30,
+        40,
+    ], "Rules shifted by insertion"
+
+    assert (
+        rule_matching.pin_rule_numbers(
+            current, rule_matching.get_rule_contents(previous)
+        )
+        == 3
+    ), "Three rules renumbered"
+    assert [rule.number for rule in current.rules] == [
+        10,
+        15,
+        20,
+        30,
+    ], "Unchanged rules keep their numbers"
+    assert (
+        rule_matching.pin_rule_numbers(
+            current, rule_matching.get_rule_contents(previous)
+        )
+        == 0
+    ), "Pinning is stable"
+
+    current.rules[1].number = 20
+    current.rules[2].number = 30
+    current.rules[3].number = 40
+    current.add_rule({"description": "explicit", "number": 25, "config_path": "."})
+    assert (
+        rule_matching.pin_rule_numbers(
+            current, rule_matching.get_rule_contents(previous)
+        )
+        == 2
+    ), "Rules renumbered around explicit rule"
+    assert [rule.number for rule in current.rules] == [
+        10,
+        20,
+        27,
+        30,
+        25,
+    ], "Matched number before explicit rule not used"
+
+
+def test_pin_rule_numbers_out_of_order():
+    """
+    .
+    """
+    previous = make_firewall([{"description": "a", "number": 10}, {"description": "b"}])
+    current = make_firewall(
+        [
+            {"description": "a", "number": 10},
+            {"description": "new"},
+            {"description": "b"},
+            {"description": "c", "number": 21},
+        ]
+    )
+    assert [rule.number for rule in current.rules] == [10, 20, 30, 21], "Numbered"
+    assert (
+        rule_matching.pin_rule_numbers(
+            current, rule_matching.get_rule_contents(previous)
+        )
+        == 0
+    ), "Matched number before explicit rule not used"
+    assert [rule.number for rule in current.rules] == [
+        10,
+        20,
+        30,
+        21,
+    ], "Current numbers kept"
+
+
+def test_get_stale_rule_numbers():
+    """
+    .
+    """
+    previous = make_firewall(
+        [{"description": "a"}, {"description": "b"}, {"description": "c"}]
+    )
+    current = make_firewall([{"description": "a"}, {"description": "changed"}])
+    assert rule_matching.get_stale_rule_numbers(
+        current, rule_matching.get_rule_contents(previous)
+    ) == [20, 30], "Changed and removed rules are stale"
@@ -0,0 +1,154 @@
+"""
+Tests firewall rule optimization
+"""
+
+from ubiquiti_config_generator import rule_optimizer
+from ubiquiti_config_generator.nodes import Firewall, Rule
+
+
+def make_rule(number: int, **kwargs) -> Rule:
+    """
+    .
+    """
+    return Rule(number, "firewall", ".", **kwargs)
+
+
+def test_merge_source_addresses():
+    """
+    .
+    """
+    rules = [
+        make_rule(
+            number,
+            action="accept",
+            protocol="tcp",
+            source={"address": address},
+            destination={"address": "10.0.0.5", "port": 443},
+        )
+        for number, address in [
+            (10, "10.1.0.1"),
+            (20, "10.1.0.2"),
+            (30, "10.1.0.3"),
+            (40, "10.1.0.2"),
+        ]
+    ]
+
+    optimization = rule_optimizer.optimize_rules("firewall", rules)
+    assert optimization.rules_saved == 3, "Four rules combined into one"
+    assert optimization.summary() == "Combined 4 rules into 1, saving 3", "Summary"
+    assert optimization.group_commands == [
+        "firewall group address-group firewall-10-source-address address 10.1.0.1",
+        "firewall group address-group firewall-10-source-address address 10.1.0.2",
+        "firewall group address-group firewall-10-source-address address 10.1.0.3",
+        "firewall group address-group firewall-10-source-address "
+        "description 'Generated for firewall firewall'",
+    ], "Group created with unique addresses"
+
+    rule_base = "firewall name firewall rule 10 "
+    assert optimization.rules[0].commands() == [
+        rule_base + "action accept",
+        rule_base + "description 'Combined rules 10, 20, 30, 40'",
+        rule_base + "protocol tcp",
+        rule_base + "source group address-group firewall-10-source-address",
+        rule_base + "destination address 10.0.0.5",
+        rule_base + "destination port 443",
+    ], "Merged rule uses group"
+    assert getattr(rules[0], "source") == {
+        "address": "10.1.0.1"
+    }, "Original rule unchanged"
+
+
+def test_merge_preserves_ordering():
+    """
+    .
+    """
+    rules = [
+        make_rule(30, action="accept", destination={"port": 80}),
+        make_rule(10, action="accept", destination={"port": 22}),
+        make_rule(20, action="drop", destination={"port": 23}),
+        make_rule(40, action="accept", destination={"port": 443}),
+        make_rule(50, action="accept", destination={"port": "web"}),
+        make_rule(60, action="accept", destination={"address": "10.0.0.0/24"}),
+        make_rule(70, action="accept", destination={"address": "10.1.0.0/24"}),
+    ]
+
+    optimization = rule_optimizer.optimize_rules("firewall", rules)
+    assert [rule.number for rule in optimization.rules] == [
+        10,
+        20,
+        30,
+        50,
+        60,
+        70,
+    ], "Only adjacent rules with the same action merged"
+    assert optimization.group_commands == [
+        "firewall group port-group firewall-30-destination-port port 80",
+        "firewall group port-group firewall-30-destination-port port 443",
+        "firewall group port-group firewall-30-destination-port "
+        "description 'Generated for firewall firewall'",
+    ], "Port group created"
+    assert optimization.rules_saved == 1, "One rule saved"
+
+
+def test_firewall_optimization():
+    """
+    .
+    """
+    firewall = Firewall("firewall", "in", "network", ".", rules=[])
+    for address in ["10.0.0.1", "10.0.0.2"]:
+        firewall.add_rule(
+            {
+                "action": "accept",
+                "description": "Allow host",
+                "source": {"address": address},
+                "config_path": ".",
+            }
+        )
+
+    assert len(firewall.commands()[0]) == 3, "Rules not optimized by default"
+
+    setattr(firewall, "optimize-rules", "enable")
+    ordered_commands, command_list = firewall.commands()
+    group_base = "firewall group address-group firewall-10-source-address "
+    assert ordered_commands == [
+        [
+            "firewall name firewall default-action accept",
+            group_base + "address 10.0.0.1",
+            group_base + "address 10.0.0.2",
+            group_base + "description 'Generated for firewall firewall'",
+        ],
+        [
+            "firewall name firewall rule 10 action accept",
+            "firewall name firewall rule 10 description 'Allow host'",
+            "firewall name firewall rule 10 source group address-group "
+            "firewall-10-source-address",
+        ],
+    ], "Optimized rules used in commands"
+    assert len(command_list) == 7, "All commands listed"
+    assert len(firewall.rules) == 2, "Firewall rules are not replaced"
+
+    optimization = firewall.optimize_rules()
+    assert firewall.optimize_rules() is optimization, "Optimization reused"
+    setattr(firewall, "description", "Changed")
+    assert firewall.optimize_rules() is not optimization, "Optimized again once changed"
+
+
+def test_get_group_name():
+    """
+    .
+    """
+    assert (
+        rule_optimizer.get_group_name("lan-IN", 10, ("source", "address"))
+        == "lan-IN-10-source-address"
+    ), "Short names kept"
+
+    long_name = rule_optimizer.get_group_name(
+        "administrative-IN", 10, ("source", "address")
+    )
+    assert (
+        len(long_name) <= rule_optimizer.MAX_GROUP_NAME_LENGTH
+    ), "Long names shortened"
+    assert long_name.startswith("administrative-IN-10-"), "Readable prefix kept"
+    assert long_name != rule_optimizer.get_group_name(
+        "administrative-IN", 10, ("source", "port")
+    ), "Shortened names stay unique"
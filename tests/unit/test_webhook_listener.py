@@ -43,6 +43,37 @@ def test_authenticate(monkeypatch):
         webhook_listener.authenticate(credentials) == "username"
     ), "User authenticates"
 
+    with pytest.raises(HTTPException):
+        webhook_listener.authenticate_revert(credentials)
+
+
+def test_authenticate_revert(monkeypatch):
+    """
+    .
+    """
+    config = {"revert": {"user": "", "pass": ""}}
+    monkeypatch.setattr(file_paths, "load_yaml_from_file", lambda path: config)
+
+    # pylint: disable=too-few-public-methods
+    class Credentials:
+        """
+        Mocks credentials
+        """
+
+        username = ""
+        password = ""
+
+    credentials = Credentials()
+    with pytest.raises(HTTPException):
+        webhook_listener.authenticate_revert(credentials)
+
+    config["revert"] = {"user": "deployer", "pass": "password"}
+    credentials.username = "deployer"
+    credentials.password = "password"
+    assert (
+        webhook_listener.authenticate_revert(credentials) == "deployer"
+    ), "Revert user authenticates"
+
 
 def test_run_listener(monkeypatch):
     """
@@ -248,3 +279,43 @@ def test_render_deployment(monkeypatch):
     assert (
         webhook_listener.render_deployment("abc", "cba") == "deployment page"
     ), "Correct return value"
+
+
+def test_run_revert(monkeypatch):
+    """
+    .
+    """
+    monkeypatch.setattr(db, "get_last_successful_deployment", lambda: None)
+    with pytest.raises(HTTPException):
+        webhook_listener.run_revert("abc", "cba")
+
+    monkeypatch.setattr(
+        db,
+        "get_last_successful_deployment",
+        lambda: Deployment("abc", "cba", "success", 1611608700.0, 1611608710.0),
+    )
+    with pytest.raises(HTTPException):
+        webhook_listener.run_revert("bcd", "abc")
+
+    monkeypatch.setattr(db, "get_revert_commands", lambda *args: None)
+    with pytest.raises(HTTPException):
+        webhook_listener.run_revert("abc", "cba")
+
+    monkeypatch.setattr(
+        db, "get_revert_commands", lambda *args: ["set system host-name router"]
+    )
+    monkeypatch.setattr(
+        file_paths, "load_yaml_from_file", lambda file_path: {"deploy": "config"}
+    )
+    reverts = []
+    monkeypatch.setattr(
+        deployment,
+        "revert_deployment",
+        lambda *args: reverts.append(args) or True,
+    )
+    assert webhook_listener.run_revert("abc", "cba") == {
+        "status": "success"
+    }, "Revert succeeds"
+    assert reverts == [
+        ("abc", "cba", ["set system host-name router"], {"deploy": "config"})
+    ], "Stored commands reverted"
@@ -0,0 +1,149 @@
+"""
+An index of address groups, their members, and the rules referring to them
+"""
+from typing import Dict, List, Tuple, Union
+
+from ubiquiti_config_generator import type_checker
+from ubiquiti_config_generator.nodes import (
+    ExternalAddresses,
+    GlobalSettings,
+    Host,
+    NAT,
+    NATRule,
+    Network,
+    Rule,
+)
+
+EXTERNAL_ADDRESSES_GROUP = "external-addresses"
+GLOBAL_GROUP_PREFIX = "firewall/group/address-group/"
+
+AnyRule = Union[Rule, NATRule]
+
+
+class AddressGroupRegistry:
+    """
+    Maps address groups to the addresses in them and the rules using them,
+    so lookups in either direction do not require walking every host and rule
+    """
+
+    def __init__(self):
+        # Group name -> member addresses, in the order the hosts were loaded
+        self.members: Dict[str, List[str]] = {}
+        # Group name -> the hosts adding addresses to it
+        self.hosts: Dict[str, List[Host]] = {}
+        # Each group and address added by a host, in the order they were added
+        self.host_memberships: List[Tuple[str, str]] = []
+        # Group name -> rules which match on the group
+        self.references: Dict[str, List[AnyRule]] = {}
+        # Address -> rules which match on the address directly
+        self.address_references: Dict[str, List[AnyRule]] = {}
+        # Groups defined outside of hosts, e.g. in global settings
+        self.external_groups: List[str] = []
+
+    @classmethod
+    def from_configuration(
+        cls,
+        global_settings: GlobalSettings,
+        external_addresses: ExternalAddresses,
+        networks: List[Network],
+        nat: NAT,
+    ) -> "AddressGroupRegistry":
+        """
+        Builds the registry for a loaded configuration
+        """
+        registry = cls()
+
+        if external_addresses is not None:
+            registry.external_groups.append(EXTERNAL_ADDRESSES_GROUP)
+            registry.members[EXTERNAL_ADDRESSES_GROUP] = list(
+                external_addresses.addresses
+            )
+
+        for setting in global_settings.attributes() if global_settings else []:
+            if setting.startswith(GLOBAL_GROUP_PREFIX):
+                group = setting[len(GLOBAL_GROUP_PREFIX) :].split("/")[0]
+                if group not in registry.external_groups:
+                    registry.external_groups.append(group)
+
+        for network in networks or []:
+            for host in network.hosts:
+                registry.add_host(host)
+            for firewall in network.firewalls:
+                for rule in firewall.rules:
+                    registry.add_rule(rule)
+
+        for rule in nat.rules if nat else []:
+            registry.add_rule(rule)
+
+        return registry
+
+    def add_host(self, host: Host) -> None:
+        """
+        Add a host's address to its address groups
+        """
+        for group in getattr(host, "address-groups", []):
+            self.members.setdefault(group, []).append(host.address)
+            self.hosts.setdefault(group, []).append(host)
+            self.host_memberships.append((group, host.address))
+
+    def add_rule(self, rule: AnyRule) -> None:
+        """
+        Index the addresses and groups a rule refers to
+        """
+        for connection in [
+            type_checker.SOURCE,
+            type_checker.DESTINATION,
+            "inside-address",
+        ]:
+            address = getattr(rule, connection, {}).get(type_checker.ADDRESS)
+            if address is None:
+                continue
+
+            # Same distinction the rules make when generating commands
+            if type_checker.is_ip_address(address) or type_checker.is_cidr(address):
+                self.address_references.setdefault(address, []).append(rule)
+            else:
+                self.references.setdefault(address, []).append(rule)
+
+    def is_defined(self, group: str) -> bool:
+        """
+        Does an address group exist
+        """
+        return group in self.members or group in self.external_groups
+
+    def undefined_groups(self) -> Dict[str, List[AnyRule]]:
+        """
+        Groups used by rules that are never defined, with the rules using them
+        """
+        return {
+            group: rules
+            for group, rules in self.references.items()
+            if not self.is_defined(group)
+        }
+
+    def rules_for_group(self, group: str) -> List[AnyRule]:
+        """
+        Rules that refer to an address group
+        """
+        return self.references.get(group, [])
+
+    def rules_affected_by_host(self, host: Host) -> List[AnyRule]:
+        """
+        Rules whose matches would change if the host's address changed
+        That is, rules using its address directly or any of its address groups
+        """
+        rules = list(self.address_references.get(host.address, []))
+        for group in getattr(host, "address-groups", []):
+            rules.extend(self.rules_for_group(group))
+
+        # A rule may use the host more than once, but only report it once
+        return list({id(rule): rule for rule in rules}.values())
+
+    def commands(self) -> List[str]:
+        """
+        Commands to create the address groups defined by hosts
+        """
+        return [
+            "firewall group address-group {0} address {1}".format(group, address)
+            for group, address in self.host_memberships
+        ]
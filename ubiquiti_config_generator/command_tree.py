@@ -0,0 +1,297 @@
+"""
+Groups the flat list of configuration commands by the nodes generating them,
+so identical parts of two configurations can be skipped when diffing
+"""
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple, Union
+
+from ubiquiti_config_generator.nodes import Firewall, Network
+from ubiquiti_config_generator.nodes.validatable import hash_commands, Validatable
+
+
+@dataclass
+class CommandTree:
+    """
+    The commands for a node, with the commands of its children nested in it
+    """
+
+    name: str
+    content_hash: str
+    # Commands and child trees, in the order the commands are generated
+    items: List[Union[str, "CommandTree"]] = field(default_factory=list)
+    # The prefix of every command in this tree, if it can be skipped as a whole
+    namespace: Optional[str] = None
+
+    def children(self) -> List["CommandTree"]:
+        """
+        The trees nested in this one
+        """
+        return [item for item in self.items if isinstance(item, CommandTree)]
+
+    def flatten(self) -> List[str]:
+        """
+        Every command in this tree, in generated order
+        """
+        commands = []
+        for item in self.items:
+            if isinstance(item, CommandTree):
+                commands.extend(item.flatten())
+            else:
+                commands.append(item)
+
+        return commands
+
+
+class CommandMismatch(Exception):
+    """
+    The commands do not line up with the nodes expected to generate them
+    """
+
+
+def get_namespace(prefix: str, commands: List[str]) -> Optional[str]:
+    """
+    Returns the prefix if every command starts with it
+    Only trees with a namespace can be skipped, since it guarantees no other
+    node sets the same keys
+    """
+    return prefix if all([command.startswith(prefix) for command in commands]) else None
+
+
+def take(commands: List[str], position: int, expected: List[str]) -> int:
+    """
+    Checks the next commands are the expected ones, returning the new position
+    """
+    end = position + len(expected)
+    if commands[position:end] != expected:
+        raise CommandMismatch()
+
+    return end
+
+
+def node_tree(
+    name: str, node: Validatable, commands: List[str], prefix: str
+) -> CommandTree:
+    """
+    A tree for a node with no children
+    """
+    return CommandTree(
+        name, node.content_hash(), list(commands), get_namespace(prefix, commands)
+    )
+
+
+def build_firewall_tree(firewall: Firewall) -> CommandTree:
+    """
+    A tree for a firewall, with its rules as children
+    """
+    commands = firewall.commands()[1]
+    name = "firewall/" + firewall.name
+    prefix = "firewall name {0} ".format(firewall.name)
+    tree = CommandTree(
+        name, firewall.content_hash(), [], get_namespace(prefix, commands)
+    )
+
+    rule_commands = [rule.commands() for rule in firewall.rules]
+    position = len(commands) - sum([len(rule) for rule in rule_commands])
+
+    try:
+        if position < 0:
+            raise CommandMismatch()
+
+        tree.items.extend(commands[:position])
+        for rule, rule_command_list in zip(firewall.rules, rule_commands):
+            next_position = take(commands, position, rule_command_list)
+            tree.items.append(
+                node_tree(
+                    name + "/rule/" + str(rule.number),
+                    rule,
+                    rule_command_list,
+                    prefix + "rule {0} ".format(rule.number),
+                )
+            )
+            position = next_position
+        if position != len(commands):
+            raise CommandMismatch()
+    # Optimized rules are replaced with others, so cannot be matched up
+    except CommandMismatch:
+        tree.items = list(commands)
+
+    return tree
+
+
+def build_network_tree(network: Network) -> CommandTree:
+    """
+    A tree for a network, with its firewalls as children
+    Its own commands include interfaces, which other networks may also set
+    """
+    commands = network.commands()[1]
+    tree = CommandTree("network/" + network.name, network.content_hash())
+
+    firewall_trees = [build_firewall_tree(firewall) for firewall in network.firewalls]
+    # Each firewall is followed by the command binding it to the interface,
+    # and each host has an IP address and MAC address mapping at the end
+    position = (
+        len(commands)
+        - sum([len(firewall.flatten()) + 1 for firewall in firewall_trees])
+        - len(network.hosts) * 2
+    )
+    if position < 0:
+        raise CommandMismatch()
+
+    tree.items.extend(commands[:position])
+    for firewall_tree in firewall_trees:
+        position = take(commands, position, firewall_tree.flatten())
+        if position >= len(commands):
+            raise CommandMismatch()
+
+        tree.items.append(firewall_tree)
+        tree.items.append(commands[position])
+        position += 1
+    tree.items.extend(commands[position:])
+
+    return tree
+
+
+def build_tree(
+    root_node, command_list: List[str], networks: Optional[List[Network]] = None
+) -> CommandTree:
+    """
+    Builds the tree of a root node, given its flat list of commands
+    Only the given networks are expected in the commands, if provided
+    If the commands do not line up with the nodes, nothing can be skipped, so
+    all commands are put directly in the root
+    """
+    tree = CommandTree("root", hash_commands(command_list))
+    subtrees = [
+        node_tree(
+            "port-group/" + group.name,
+            group,
+            group.commands(),
+            "firewall group port-group {0} ".format(group.name),
+        )
+        for group in root_node.port_groups
+    ]
+
+    try:
+        position = take(
+            command_list,
+            0,
+            root_node.external_addresses.commands()
+            if root_node.external_addresses
+            else [],
+        )
+        tree.items.extend(command_list[:position])
+        for subtree in subtrees:
+            position = take(command_list, position, subtree.flatten())
+            tree.items.append(subtree)
+
+        start = position
+        position = take(command_list, position, root_node.address_groups.commands())
+        position = take(
+            command_list,
+            position,
+            root_node.global_settings.commands() if root_node.global_settings else [],
+        )
+        tree.items.extend(command_list[start:position])
+
+        for rule in root_node.nat.rules if root_node.nat else []:
+            rule_commands = rule.commands()
+            position = take(command_list, position, rule_commands)
+            tree.items.append(
+                node_tree(
+                    "nat/rule/" + str(rule.number),
+                    rule,
+                    rule_commands,
+                    "service nat rule {0} ".format(rule.number),
+                )
+            )
+
+        for network in root_node.networks if networks is None else networks:
+            network_tree = build_network_tree(network)
+            position = take(command_list, position, network_tree.flatten())
+            tree.items.append(network_tree)
+
+        if position != len(command_list):
+            raise CommandMismatch()
+    except CommandMismatch:
+        tree.items = list(command_list)
+
+    return tree
+
+
+def get_unique_children(tree: CommandTree) -> Dict[str, CommandTree]:
+    """
+    Children of a tree by name, leaving out any names used more than once
+    since they cannot be matched up between trees
+    """
+    children = {}
+    duplicates = set()
+    for child in tree.children():
+        if child.name in children:
+            duplicates.add(child.name)
+        children[child.name] = child
+
+    return {name: child for name, child in children.items() if name not in duplicates}
+
+
+def prune_identical_subtrees(
+    current: CommandTree, previous: CommandTree
+) -> Tuple[List[str], List[str], List[str]]:
+    """
+    Flattens two versions of a tree, skipping subtrees that are identical in both
+    Returns the remaining current and previous commands, and the namespaces skipped
+    """
+    if (
+        current.namespace is not None
+        and current.namespace == previous.namespace
+        and current.content_hash == previous.content_hash
+    ):
+        return ([], [], [current.namespace])
+
+    current_children = get_unique_children(current)
+    previous_children = get_unique_children(previous)
+    matched = {
+        name: prune_identical_subtrees(child, previous_children[name])
+        for name, child in current_children.items()
+        if name in previous_children
+    }
+
+    current_commands = []
+    for item in current.items:
+        if isinstance(item, str):
+            current_commands.append(item)
+        elif item.name in matched:
+            current_commands.extend(matched[item.name][0])
+        else:
+            current_commands.extend(item.flatten())
+
+    previous_commands = []
+    for item in previous.items:
+        if isinstance(item, str):
+            previous_commands.append(item)
+        elif item.name in matched:
+            previous_commands.extend(matched[item.name][1])
+        else:
+            previous_commands.extend(item.flatten())
+
+    namespaces = [namespace for result in matched.values() for namespace in result[2]]
+    return (current_commands, previous_commands, namespaces)
+
+
+def has_namespace_collision(commands: List[str], namespaces: List[str]) -> bool:
+    """
+    Do any commands fall under a skipped namespace, e.g. from duplicate names,
+    in which case the skipped commands would have affected the diff of those
+    """
+    if not namespaces:
+        return False
+
+    namespace_set = set(namespaces)
+    lengths = {len(namespace.split()) for namespace in namespace_set}
+    longest = max(lengths)
+    for command in commands:
+        tokens = command.split(" ", longest)
+        for length in lengths:
+            if " ".join(tokens[:length]) + " " in namespace_set:
+                return True
+
+    return False
@@ -0,0 +1,483 @@
+"""
+Finds firewall rules which can never match a packet, since rules with lower
+numbers already match everything they would
+
+Each rule is treated as a box of match sets - protocols, connection states,
+and source/destination addresses and ports. Every dimension is coordinate
+compressed into cells, so a match set becomes a bitmask of cells, and the rules
+containing each cell are in turn a bitmask of rules. Finding every earlier rule
+which fully covers a rule is then a handful of integer operations per distinct
+match set, rather than comparing each pair of rules.
+"""
+import bisect
+from dataclasses import dataclass, field
+import ipaddress
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from ubiquiti_config_generator import root_parser, type_checker
+from ubiquiti_config_generator.nodes import Firewall, Rule
+
+SHADOWED = "shadowed"
+REDUNDANT = "redundant"
+UNREACHABLE = "unreachable"
+
+# Protocols are bucketed by what a rule could distinguish between
+PROTOCOL_CELLS = {type_checker.TCP: 1, type_checker.UDP: 2, "other": 4}
+PROTOCOLS = {
+    type_checker.TCP: PROTOCOL_CELLS[type_checker.TCP],
+    type_checker.UDP: PROTOCOL_CELLS[type_checker.UDP],
+    type_checker.TCP_UDP: PROTOCOL_CELLS[type_checker.TCP]
+    | PROTOCOL_CELLS[type_checker.UDP],
+    type_checker.ALL: sum(PROTOCOL_CELLS.values()),
+    type_checker.IP: sum(PROTOCOL_CELLS.values()),
+}
+
+STATES = [
+    type_checker.NEW,
+    type_checker.ESTABLISHED,
+    type_checker.RELATED,
+    type_checker.INVALID,
+]
+
+# IPv6 addresses are placed after the IPv4 address space
+IPV6_OFFSET = 2**32
+ADDRESS_SPACE = (0, IPV6_OFFSET + 2**128 - 1)
+PORT_SPACE = (0, 65535)
+
+DIMENSIONS = [
+    "protocol",
+    "state",
+    "source address",
+    "source port",
+    "destination address",
+    "destination port",
+]
+
+Interval = Tuple[int, int]
+
+
+@dataclass
+class MatchSet:
+    """
+    What a rule matches in one dimension - numeric intervals, plus the names of
+    any groups that could not be resolved to values
+    """
+
+    intervals: List[Interval] = field(default_factory=list)
+    unresolved: List[str] = field(default_factory=list)
+    matches_all: bool = False
+
+
+@dataclass
+class RuleFinding:
+    """
+    A rule that can never take effect
+    """
+
+    rule_number: int
+    kind: str
+    covering_rules: List[int]
+
+    def message(self, firewall_name: str) -> str:
+        """
+        Describes the finding
+        """
+        rules = ", ".join([str(number) for number in self.covering_rules])
+        if self.kind == SHADOWED:
+            reason = f"is shadowed by rule {rules}, which has a different action"
+        elif self.kind == REDUNDANT:
+            reason = f"is redundant with rule {rules}, which has the same action"
+        else:
+            reason = f"is unreachable, since rules {rules} match everything it does"
+
+        return f"Firewall {firewall_name} rule {self.rule_number} {reason}"
+
+
+@dataclass
+class FirewallAnalysis:
+    """
+    The findings for a single firewall
+    """
+
+    firewall_name: str
+    findings: List[RuleFinding] = field(default_factory=list)
+
+    def _of_kind(self, kind: str) -> List[RuleFinding]:
+        """
+        Findings of a given kind
+        """
+        return [finding for finding in self.findings if finding.kind == kind]
+
+    @property
+    def shadowed(self) -> List[RuleFinding]:
+        """
+        Rules covered by an earlier rule with a different action
+        """
+        return self._of_kind(SHADOWED)
+
+    @property
+    def redundant(self) -> List[RuleFinding]:
+        """
+        Rules covered by an earlier rule with the same action
+        """
+        return self._of_kind(REDUNDANT)
+
+    @property
+    def unreachable(self) -> List[RuleFinding]:
+        """
+        Rules covered by a combination of earlier rules
+        """
+        return self._of_kind(UNREACHABLE)
+
+    def messages(self) -> List[str]:
+        """
+        Descriptions of all findings
+        """
+        return [finding.message(self.firewall_name) for finding in self.findings]
+
+
+def address_to_interval(address: str) -> Optional[Interval]:
+    """
+    Converts an address, network or range of addresses to an interval
+    """
+
+    def to_int(ip_address) -> int:
+        """
+        Places an address in the shared address space
+        """
+        return int(ip_address) + (IPV6_OFFSET if ip_address.version == 6 else 0)
+
+    try:
+        if "-" in address:
+            start, end = address.split("-", 1)
+            return (
+                to_int(ipaddress.ip_address(start)),
+                to_int(ipaddress.ip_address(end)),
+            )
+
+        network = ipaddress.ip_network(address, strict=False)
+        return (to_int(network.network_address), to_int(network.broadcast_address))
+    except ValueError:
+        return None
+
+
+def get_address_match(
+    address: Optional[str], address_groups: Dict[str, List[str]]
+) -> MatchSet:
+    """
+    Gets what an address, network or address group matches
+    """
+    if address is None:
+        return MatchSet(matches_all=True)
+
+    interval = address_to_interval(address)
+    if interval:
+        return MatchSet([interval])
+
+    if address not in address_groups:
+        return MatchSet(unresolved=["address-group " + address])
+
+    intervals = [address_to_interval(member) for member in address_groups[address]]
+    if None in intervals:
+        return MatchSet(unresolved=["address-group " + address])
+
+    return MatchSet(intervals)
+
+
+def get_port_match(port, port_groups: Dict[str, List[int]]) -> MatchSet:
+    """
+    Gets what a port or port group matches
+    """
+    if port is None:
+        return MatchSet(matches_all=True)
+
+    if type_checker.is_number(port):
+        return MatchSet([(int(port), int(port))])
+
+    if port not in port_groups:
+        return MatchSet(unresolved=["port-group " + port])
+
+    return MatchSet([(int(member), int(member)) for member in port_groups[port]])
+
+
+class Dimension:
+    """
+    A coordinate-compressed dimension of the rule match space
+    """
+
+    def __init__(self, space: Interval, match_sets: Iterable[MatchSet]):
+        match_sets = list(match_sets)
+        boundaries = {space[0]}
+        unresolved = set()
+        for match_set in match_sets:
+            unresolved.update(match_set.unresolved)
+            for start, end in match_set.intervals:
+                boundaries.add(start)
+                if end < space[1]:
+                    boundaries.add(end + 1)
+
+        self.boundaries = sorted(boundaries)
+        # Unresolved groups get a cell of their own after the numeric cells,
+        # so they can only be covered by the same group or by matching everything
+        self.unresolved_cells = {
+            name: len(self.boundaries) + index
+            for index, name in enumerate(sorted(unresolved))
+        }
+        self.full_mask = (1 << (len(self.boundaries) + len(unresolved))) - 1
+
+    def to_mask(self, match_set: MatchSet) -> int:
+        """
+        Converts a match set to a bitmask of the cells it contains
+        """
+        if match_set.matches_all:
+            return self.full_mask
+
+        mask = 0
+        for start, end in match_set.intervals:
+            first_cell = bisect.bisect_right(self.boundaries, start) - 1
+            last_cell = bisect.bisect_right(self.boundaries, end) - 1
+            mask |= ((1 << (last_cell - first_cell + 1)) - 1) << first_cell
+
+        for name in match_set.unresolved:
+            mask |= 1 << self.unresolved_cells[name]
+
+        return mask
+
+
+class CoverageIndex:
+    """
+    Finds which rules fully contain a match set, per dimension
+    """
+
+    def __init__(self, rule_masks: List[List[int]], full_masks: List[int]):
+        self.rule_masks = rule_masks
+        # For each dimension, which rules match everything, and which of the
+        # others contain each cell
+        # Rules matching everything are common, and would otherwise be added to
+        # every cell
+        self.rules_matching_all: List[int] = [0 for _ in DIMENSIONS]
+        self.rules_with_cell: List[Dict[int, int]] = [{} for _ in DIMENSIONS]
+        self._containing: List[Dict[int, int]] = [{} for _ in DIMENSIONS]
+
+        for rule_index, masks in enumerate(rule_masks):
+            for dimension, mask in enumerate(masks):
+                if mask == full_masks[dimension]:
+                    self.rules_matching_all[dimension] |= 1 << rule_index
+                    continue
+
+                cells = self.rules_with_cell[dimension]
+                for cell in iterate_bits(mask):
+                    cells[cell] = cells.get(cell, 0) | (1 << rule_index)
+
+        self.all_rules = (1 << len(rule_masks)) - 1
+
+    def containing(self, dimension: int, mask: int) -> int:
+        """
+        A bitmask of the rules whose match set contains the given one
+        Memoized, since most rules share a small number of distinct match sets
+        """
+        cached = self._containing[dimension].get(mask)
+        if cached is not None:
+            return cached
+
+        rules = self.all_rules
+        cells = self.rules_with_cell[dimension]
+        for cell in iterate_bits(mask):
+            rules &= cells.get(cell, 0)
+            if not rules:
+                break
+
+        rules |= self.rules_matching_all[dimension]
+        self._containing[dimension][mask] = rules
+        return rules
+
+
+def iterate_bits(mask: int) -> Iterable[int]:
+    """
+    The positions of the set bits in a mask
+    """
+    while mask:
+        lowest = mask & -mask
+        yield lowest.bit_length() - 1
+        mask ^= lowest
+
+
+def get_rule_match_sets(
+    rule: Rule, port_groups: Dict[str, List[int]], address_groups: Dict[str, List[str]]
+) -> List[MatchSet]:
+    """
+    Gets what a rule matches, for each dimension other than protocol and state
+    """
+    source = getattr(rule, type_checker.SOURCE, {})
+    destination = getattr(rule, type_checker.DESTINATION, {})
+    return [
+        get_address_match(source.get(type_checker.ADDRESS), address_groups),
+        get_port_match(source.get(type_checker.PORT), port_groups),
+        get_address_match(destination.get(type_checker.ADDRESS), address_groups),
+        get_port_match(destination.get(type_checker.PORT), port_groups),
+    ]
+
+
+def get_state_mask(rule: Rule) -> int:
+    """
+    Gets the connection states a rule matches
+    Like the router, a rule enabling no states matches all of them
+    """
+    all_states = (1 << len(STATES)) - 1
+    if not hasattr(rule, "state"):
+        return all_states
+
+    mask = 0
+    for index, state in enumerate(STATES):
+        if getattr(rule, "state").get(state) == type_checker.ENABLE:
+            mask |= 1 << index
+
+    return mask or all_states
+
+
+def get_protocol_mask(protocol: str, other_protocols: Dict[str, int]) -> int:
+    """
+    Gets the protocols a rule matches
+    Protocols without their own cell are each given a new one after the known
+    cells, so rules for different protocols never cover each other
+    """
+    if protocol in PROTOCOLS:
+        return PROTOCOLS[protocol]
+
+    if protocol not in other_protocols:
+        other_protocols[protocol] = 1 << (len(PROTOCOL_CELLS) + len(other_protocols))
+
+    return other_protocols[protocol]
+
+
+def analyze_firewall(
+    firewall: Firewall,
+    port_groups: Dict[str, List[int]],
+    address_groups: Dict[str, List[str]],
+) -> FirewallAnalysis:
+    """
+    Finds the rules in a firewall which can never take effect
+    """
+    rules = sorted(firewall.rules, key=lambda rule: int(rule.number))
+    rule_match_sets = [
+        get_rule_match_sets(rule, port_groups, address_groups) for rule in rules
+    ]
+
+    dimensions = [
+        Dimension(space, [match_sets[index] for match_sets in rule_match_sets])
+        for index, space in enumerate([ADDRESS_SPACE, PORT_SPACE] * 2)
+    ]
+    other_protocols = {}
+    protocol_masks = [
+        get_protocol_mask(getattr(rule, "protocol", type_checker.ALL), other_protocols)
+        for rule in rules
+    ]
+    # Rules for every protocol also match those given their own cell
+    all_protocols = PROTOCOLS[type_checker.ALL] | sum(other_protocols.values())
+    rule_masks = [
+        [
+            all_protocols
+            if protocol_mask == PROTOCOLS[type_checker.ALL]
+            else protocol_mask,
+            get_state_mask(rule),
+            *[
+                dimension.to_mask(match_set)
+                for dimension, match_set in zip(dimensions, match_sets)
+            ],
+        ]
+        for rule, protocol_mask, match_sets in zip(
+            rules, protocol_masks, rule_match_sets
+        )
+    ]
+
+    index = CoverageIndex(
+        rule_masks,
+        [
+            all_protocols,
+            (1 << len(STATES)) - 1,
+            *[dimension.full_mask for dimension in dimensions],
+        ],
+    )
+    analysis = FirewallAnalysis(firewall.name)
+
+    for rule_index, rule in enumerate(rules):
+        earlier_rules = (1 << rule_index) - 1
+        containing = [
+            index.containing(dimension, mask) & earlier_rules
+            for dimension, mask in enumerate(rule_masks[rule_index])
+        ]
+
+        covering = earlier_rules
+        for rules_containing in containing:
+            covering &= rules_containing
+
+        if covering:
+            first_covering = rules[next(iterate_bits(covering))]
+            same_action = getattr(first_covering, "action", "accept") == getattr(
+                rule, "action", "accept"
+            )
+            analysis.findings.append(
+                RuleFinding(
+                    rule.number,
+                    REDUNDANT if same_action else SHADOWED,
+                    [first_covering.number],
+                )
+            )
+            continue
+
+        covering_union = find_covering_union(index, rule_masks[rule_index], containing)
+        if covering_union:
+            analysis.findings.append(
+                RuleFinding(
+                    rule.number,
+                    UNREACHABLE,
+                    [rules[covering].number for covering in covering_union],
+                )
+            )
+
+    return analysis
+
+
+def find_covering_union(
+    index: CoverageIndex, masks: List[int], containing: List[int]
+) -> List[int]:
+    """
+    Finds earlier rules which together cover a rule, where each contains the rule
+    in every dimension but one, and their union covers that remaining dimension
+
+    This will not find every possible covering combination, but anything it does
+    find is certain to be covered
+    """
+    for dimension, mask in enumerate(masks):
+        candidates = -1
+        for other_dimension, rules_containing in enumerate(containing):
+            if other_dimension != dimension:
+                candidates &= rules_containing
+
+        if candidates <= 0:
+            continue
+
+        union = 0
+        covering = []
+        for candidate in iterate_bits(candidates):
+            candidate_mask = index.rule_masks[candidate][dimension]
+            if candidate_mask & mask and candidate_mask & ~union & mask:
+                union |= candidate_mask
+                covering.append(candidate)
+            if union & mask == mask:
+                return covering
+
+    return []
+
+
+def analyze_configuration(root_node: root_parser.RootNode) -> List[FirewallAnalysis]:
+    """
+    Analyzes every firewall in a configuration
+    """
+    port_groups = {group.name: group.ports for group in root_node.port_groups}
+    address_groups = root_node.address_groups.members
+    return [
+        analyze_firewall(firewall, port_groups, address_groups)
+        for network in root_node.networks
+        for firewall in network.firewalls
+    ]
@@ -234,6 +234,21 @@ def checkout(repo_path: str, sha_or_branch: str) -> None:
         os.chdir(cwd)
 
 
+def get_changed_files(repo_path: str, before: str, after: str) -> List[str]:
+    """
+    Get the files changed between two revisions of a repo
+    """
+    # Without renames, both the old and new paths of a moved file are listed
+    result = subprocess.run(
+        ["git", "diff", "--name-only", "--no-renames", before, after],
+        cwd=repo_path,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return [changed_file for changed_file in result.stdout.splitlines() if changed_file]
+
+
 def summarize_deploy_config_choices(deploy_config: dict) -> str:
     """
     Creates a summary of the deploy configuration, for displaying
@@ -4,14 +4,28 @@ Contains the interactions for GitHub webhooks
 """
 from datetime import datetime, timezone
 import time
-
-from ubiquiti_config_generator import root_parser, file_paths
-from ubiquiti_config_generator.github import deploy_helper, api, push
+from typing import Optional
+
+from ubiquiti_config_generator import (
+    root_parser,
+    file_paths,
+    firewall_analysis,
+    rule_matching,
+)
+from ubiquiti_config_generator.github import (
+    api,
+    comment_summary,
+    deploy_helper,
+    phase_packing,
+    push,
+)
 from ubiquiti_config_generator.github.api import GREEN_CHECK, RED_CROSS
 from ubiquiti_config_generator.github.deployment_metadata import DeployMetadata
 from ubiquiti_config_generator.messages import db
 from ubiquiti_config_generator.messages.check import Check
+from ubiquiti_config_generator.messages.command_snapshot import CommandSnapshot
 from ubiquiti_config_generator.messages.log import Log
+from ubiquiti_config_generator.nodes.validatable import hash_commands
 
 
 def handle_check_suite(form: dict, access_token: str) -> None:
@@ -141,9 +155,20 @@ def process_check_run(deploy_config: dict, form: dict, access_token: str) -> boo
         )
     )
 
+    production_snapshot = (
+        db.get_command_snapshot(deployed_sha)
+        if deploy_config.get("store-revision-commands", False)
+        else None
+    )
+
     try:
-        production_config_node = root_parser.RootNode.create_from_configs(
-            deploy_config["git"]["config-folder"]
+        # The deployed commands are all that is needed from its configuration
+        production_config_node = (
+            root_parser.RootNode.create_from_configs(
+                deploy_config["git"]["config-folder"]
+            )
+            if production_snapshot is None
+            else None
         )
         branch_config_node = root_parser.RootNode.create_from_configs(
             deploy_config["git"]["diff-config-folder"]
@@ -224,7 +249,10 @@ def process_check_run(deploy_config: dict, form: dict, access_token: str) -> boo
     success = True
     if form["check_run"]["pull_requests"]:
         comment = get_pr_comment(
-            deploy_config, branch_config_node, production_config_node
+            deploy_config,
+            branch_config_node,
+            production_config_node,
+            production_snapshot,
         )
         for pull in form["check_run"]["pull_requests"]:
             if not api.add_comment(access_token, pull["url"], comment):
@@ -313,31 +341,89 @@ def finalize_commit_status(
 def get_pr_comment(
     deploy_config: dict,
     branch_config_node: root_parser.RootNode,
-    production_config_node: root_parser.RootNode,
+    production_config_node: Optional[root_parser.RootNode],
+    production_snapshot: Optional[CommandSnapshot] = None,
 ) -> str:
     """
     Gets the comment to add to the PR for the current configurations
+    The stored commands of production are used instead of its node, if provided
     """
-    comment = api.summarize_deploy_config_choices(deploy_config)
-    comment += "\n"
+    comment = api.summarize_deploy_config_choices(deploy_config) + "\n\n"
+
+    if deploy_config.get("skip-unchanged-deployments", False) and (
+        branch_config_node.content_hash()
+        == (
+            production_config_node.content_hash()
+            if production_snapshot is None
+            else hash_commands(production_snapshot.commands)
+        )
+    ):
+        return (comment + "No configuration changes").strip()
+
+    # Rule numbers can only be pinned against those deployed with production
+    if deploy_config.get("pin-rule-numbers", False) and production_snapshot is not None:
+        rule_matching.pin_configuration_rules(
+            branch_config_node, production_snapshot.rules
+        )
+
+    if production_snapshot is not None:
+        differences = deploy_helper.diff_command_indexes(
+            deploy_helper.index_commands(branch_config_node.get_commands()[1]),
+            production_snapshot.index,
+        )
+    else:
+        differences = deploy_helper.diff_command_trees(
+            branch_config_node.get_command_tree(),
+            production_config_node.get_command_tree(),
+        )
 
-    differences = deploy_helper.diff_configurations(
-        branch_config_node.get_commands()[1], production_config_node.get_commands()[1],
+    # Deletions are always run first, in their own phase
+    command_phases = [
+        [f"delete {command_key}" for command_key in differences.removed],
+        *deploy_helper.select_commands_to_run(
+            branch_config_node.get_commands()[0],
+            differences,
+            deploy_config["apply-difference-only"],
+        ),
+    ]
+    if deploy_config.get("pack-command-phases", False):
+        command_phases = phase_packing.pack_phases(command_phases)
+
+    rule_findings = (
+        comment_summary.render_rule_findings(
+            [
+                message
+                for analysis in firewall_analysis.analyze_configuration(
+                    branch_config_node
+                )
+                for message in analysis.messages()
+            ]
+        )
+        if deploy_config.get("analyze-firewall-rules", False)
+        else ""
     )
-    for category in ["added", "removed", "changed"]:
-        commands = getattr(differences, category)
-        if not commands:
-            continue
-
-        comment += f"## Commands {category}:\n\n"
-        for command_key, command_value in commands.items():
-            if isinstance(command_value, list):
-                for each_value in command_value:
-                    comment += f"- {command_key} {each_value}\n"
-            else:
-                comment += f"- {command_key} {command_value}\n"
-
-    return comment.strip()
+
+    rule_optimizations = comment_summary.render_rule_optimizations(
+        [
+            (firewall.name, firewall.optimize_rules())
+            for network in branch_config_node.networks
+            for firewall in network.firewalls
+            if firewall.optimizes_rules()
+        ]
+    )
+
+    sections = [section for section in [rule_optimizations, rule_findings] if section]
+    return (
+        comment
+        + comment_summary.render_summary(
+            comment_summary.group_differences(differences),
+            comment_summary.estimate_round_trips(command_phases, deploy_config),
+            comment_summary.MAX_COMMENT_LENGTH
+            - len(comment)
+            - sum([len(section) + 2 for section in sections]),
+        )
+        + "".join(["\n\n" + section for section in sections])
+    ).strip()
 
 
 def check_trigger_deploy(form: dict, access_token: str):
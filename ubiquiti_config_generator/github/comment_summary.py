@@ -0,0 +1,263 @@
+"""
+Summarizes configuration differences for PR comments, keeping them to a bounded size
+"""
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+from ubiquiti_config_generator.github.deploy_helper import ConfigDifference
+from ubiquiti_config_generator.rule_optimizer import RuleOptimization
+
+# GitHub rejects comments over 65536 characters, so leave room for the rest
+MAX_COMMENT_LENGTH = 60000
+# Areas with more commands than this are collapsed
+DETAILS_THRESHOLD = 10
+# Only this many areas are counted individually in the summary table
+MAX_TABLE_ROWS = 50
+# Only this many firewall rule findings are listed
+MAX_RULE_FINDINGS = 50
+CATEGORIES = ["added", "removed", "changed"]
+
+
+@dataclass
+class AreaSummary:
+    """
+    The differences in one area of the configuration, e.g. a firewall
+    """
+
+    name: str
+    commands: Dict[str, List[str]] = field(
+        default_factory=lambda: {category: [] for category in CATEGORIES}
+    )
+
+    def count(self, category: str = None) -> int:
+        """
+        How many commands are in a category, or in total
+        """
+        categories = [category] if category else CATEGORIES
+        return sum([len(self.commands[each]) for each in categories])
+
+
+def get_command_area(command_key: str) -> str:
+    """
+    Gets the area of the configuration a command key belongs to
+    """
+    tokens = command_key.split(" ")
+    if tokens[:2] == ["firewall", "name"] and len(tokens) > 2:
+        return "Firewall " + tokens[2]
+    if tokens[:3] == ["firewall", "group", "port-group"] and len(tokens) > 3:
+        return "Port group " + tokens[3]
+    if tokens[:3] == ["firewall", "group", "address-group"] and len(tokens) > 3:
+        return "Address group " + tokens[3]
+    if tokens[:2] == ["service", "nat"]:
+        return "NAT"
+    if (
+        tokens[:3] == ["service", "dhcp-server", "shared-network-name"]
+        and len(tokens) > 3
+    ):
+        return "DHCP network " + tokens[3]
+    if tokens[:1] == ["interfaces"] and len(tokens) > 2:
+        return "Interface " + tokens[2]
+
+    return tokens[0].capitalize()
+
+
+def group_differences(differences: ConfigDifference) -> List[AreaSummary]:
+    """
+    Groups the commands in a difference by area, in the order first seen
+    """
+    areas: Dict[str, AreaSummary] = {}
+    for category in CATEGORIES:
+        for command_key, command_value in getattr(differences, category).items():
+            area_name = get_command_area(command_key)
+            area = areas.setdefault(area_name, AreaSummary(area_name))
+            values = (
+                command_value if isinstance(command_value, list) else [command_value]
+            )
+            area.commands[category].extend(
+                [f"{command_key} {value}" for value in values]
+            )
+
+    return list(areas.values())
+
+
+def estimate_upload_round_trips(file_count: int, deploy_config: dict) -> int:
+    """
+    Estimates the router round trips to upload some scripts
+    A tar stream sends and checks them in one command, while SFTP opens a session
+    and each file before checksumming them all at once
+    """
+    if deploy_config.get("router", {}).get("upload-mode", "sftp") == "tar":
+        return 1
+
+    return file_count + 2
+
+
+def estimate_round_trips(
+    command_phases: List[List[str]], deploy_config: dict
+) -> Tuple[int, int]:
+    """
+    Estimates the commits a deployment needs, and the router round trips for them,
+    following the configured execution mode:
+      - files uploads a script for each phase and an aggregate script, then runs it
+      - session uploads one script committing each phase, then runs it
+      - pipelined uploads the first phase, then runs each one while uploading the
+        next, so only its executions are waited on
+    """
+    commits = len([phase for phase in command_phases if phase])
+    if not command_phases:
+        return (0, 0)
+
+    execution_mode = deploy_config.get("execution-mode", "files")
+    if execution_mode == "pipelined":
+        round_trips = (
+            estimate_upload_round_trips(1, deploy_config) + commits if commits else 0
+        )
+    elif execution_mode == "session":
+        round_trips = estimate_upload_round_trips(1, deploy_config) + 1
+    else:
+        round_trips = (
+            estimate_upload_round_trips(len(command_phases) + 1, deploy_config) + 1
+        )
+
+    return (commits, round_trips)
+
+
+class BoundedText:
+    """
+    Joins text parts, refusing any that would exceed a maximum length
+    """
+
+    def __init__(self, max_length: int):
+        self.parts = []
+        self.length = 0
+        self.max_length = max_length
+
+    def add(self, text: str) -> bool:
+        """
+        Adds text if it fits, returning whether it did
+        """
+        if self.length + len(text) > self.max_length:
+            return False
+
+        self.parts.append(text)
+        self.length += len(text)
+        return True
+
+    def text(self) -> str:
+        """
+        The joined text
+        """
+        return "".join(self.parts)
+
+
+def render_summary(
+    areas: List[AreaSummary],
+    phase_estimate: Tuple[int, int],
+    max_length: int = MAX_COMMENT_LENGTH,
+) -> str:
+    """
+    Renders the area summaries, collapsing large areas and truncating
+    the commands listed once the maximum length is reached
+    """
+    totals = {
+        category: sum([area.count(category) for area in areas])
+        for category in CATEGORIES
+    }
+    header = [
+        "## Summary\n\n",
+        "{0} added, {1} removed, {2} changed across {3} areas\n".format(
+            totals["added"], totals["removed"], totals["changed"], len(areas)
+        ),
+        "Estimated {0} commit phases and {1} router round trips\n".format(
+            *phase_estimate
+        ),
+    ]
+    if areas:
+        header.append("\n| Area | Added | Removed | Changed |\n|---|---|---|---|\n")
+        header.extend(
+            [
+                "| {0} | {1} | {2} | {3} |\n".format(
+                    area.name,
+                    area.count("added"),
+                    area.count("removed"),
+                    area.count("changed"),
+                )
+                for area in areas[:MAX_TABLE_ROWS]
+            ]
+        )
+        if len(areas) > MAX_TABLE_ROWS:
+            header.append(
+                "| {0} more areas | | | |\n".format(len(areas) - MAX_TABLE_ROWS)
+            )
+
+    # Reserve room for the note about commands left out
+    text = BoundedText(max_length - 100)
+    for part in header:
+        text.add(part)
+
+    omitted = 0
+    for area in areas:
+        collapsed = area.count() > DETAILS_THRESHOLD
+        lines = [
+            f"- {category.capitalize()}: {command}\n"
+            for category in CATEGORIES
+            for command in area.commands[category]
+        ]
+        opening = f"\n### {area.name}\n\n" + (
+            f"<details><summary>{area.count()} commands</summary>\n\n"
+            if collapsed
+            else ""
+        )
+        closing = "\n</details>\n" if collapsed else ""
+
+        if omitted or not text.add(opening):
+            omitted += len(lines)
+            continue
+
+        # Always leave room to close the details
+        text.max_length -= len(closing)
+        for index, line in enumerate(lines):
+            if not text.add(line):
+                omitted += len(lines) - index
+                break
+        text.max_length += len(closing)
+        text.add(closing)
+
+    text.max_length = max_length
+    if omitted:
+        text.add(f"\n_{omitted} more commands not shown_\n")
+
+    return text.text().strip()
+
+
+def render_rule_optimizations(optimizations: List[Tuple[str, RuleOptimization]]) -> str:
+    """
+    Renders the rules saved in each firewall with optimized rules, if there are any
+    """
+    if not optimizations:
+        return ""
+
+    lines = [
+        f"- Firewall {firewall_name}: {optimization.summary()}\n"
+        for firewall_name, optimization in optimizations
+    ]
+    total_saved = sum([optimization.rules_saved for _, optimization in optimizations])
+    return (
+        "## Firewall rule optimizations\n\n"
+        + "".join(lines)
+        + f"\n{total_saved} rules saved in total"
+    )
+
+
+def render_rule_findings(messages: List[str]) -> str:
+    """
+    Renders the firewall rules which can never take effect, if there are any
+    """
+    if not messages:
+        return ""
+
+    lines = [f"- {message}\n" for message in messages[:MAX_RULE_FINDINGS]]
+    if len(messages) > MAX_RULE_FINDINGS:
+        lines.append(f"\n_{len(messages) - MAX_RULE_FINDINGS} more findings_\n")
+
+    return "## Firewall rule findings\n\n" + "".join(lines).strip()
@@ -0,0 +1,385 @@
+"""
+Compares configurations command by command, summarizing what was added, removed,
+changed or preserved
+"""
+from array import array
+import shlex
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+
+def as_list(value: Optional[Union[str, List[str]]]) -> List[str]:
+    """
+    The values of a command key as a list
+    """
+    if value is None:
+        return []
+
+    return value if isinstance(value, list) else [value]
+
+
+class OrderedValueSet(list):
+    """
+    A list of values that also tracks its members in a set,
+    so checking whether a value is in it does not require a scan
+    """
+
+    def __init__(self, values: Iterable[str] = ()):
+        super().__init__(values)
+        self._members = set(self)
+
+    def __contains__(self, value) -> bool:
+        return value in self._members
+
+    def append(self, value: str) -> None:
+        super().append(value)
+        self._members.add(value)
+
+    def extend(self, values: Iterable[str]) -> None:
+        for value in values:
+            self.append(value)
+
+    def __iadd__(self, values: Iterable[str]) -> "OrderedValueSet":
+        self.extend(values)
+        return self
+
+
+class ConfigDifference:
+    """
+    Calculates and stores differences between configuration commands
+    """
+
+    def __init__(self):
+        # These contain path to the key -> key value
+        # Indexed by command to enable a quick lookup
+        self.removed = {}
+        self.added = {}
+        self.changed = {}
+        self.preserved = {}
+
+    def remove(self, command: dict) -> None:
+        """
+        Add a command that was removed
+        """
+        self.removed.update(command)
+
+    def add(self, command: dict) -> None:
+        """
+        Add a command that was added
+        """
+        self.added.update(command)
+
+    def change(self, command: dict) -> None:
+        """
+        Add a command that was changed
+        """
+        self.changed.update(command)
+
+    def preserve(self, command: dict) -> None:
+        """
+        Add a command that was preserved
+        """
+        self.preserved.update(command)
+
+    def add_or_append_list_value(self, component: dict, key: str, value: str) -> None:
+        """
+        Adds a given value for a key to a command configuration difference
+        """
+        if key not in component:
+            component[key] = OrderedValueSet([value])
+        else:
+            component[key].append(value)
+
+    def compare_commands(
+        self, current_command: Optional[dict], previous_command: Optional[dict]
+    ) -> None:
+        """
+        Compare two commands and add to the appropriate dictionary
+        """
+        is_list = (
+            current_command and isinstance(list(current_command.values())[0], list)
+        ) or (previous_command and isinstance(list(previous_command.values())[0], list))
+
+        if is_list:
+            self.compare_list_commands(current_command, previous_command)
+        else:
+            self.compare_simple_commands(current_command, previous_command)
+
+    def compare_list_commands(
+        self, current_command: Optional[dict], previous_command: Optional[dict]
+    ) -> None:
+        """
+        Compare two commands with list values
+        """
+        command_key = (
+            list(current_command.keys())[0]
+            if current_command
+            else list(previous_command.keys())[0]
+        )
+        # One side may only set the key once
+        current_values = as_list(
+            list(current_command.values())[0] if current_command else None
+        )
+        previous_values = as_list(
+            list(previous_command.values())[0] if previous_command else None
+        )
+
+        # Multi-valued keys such as group members can be large, so avoid list scans
+        current_members = set(current_values)
+        previous_members = set(previous_values)
+
+        for each_value in current_values:
+            if each_value in previous_members:
+                self.add_or_append_list_value(self.preserved, command_key, each_value)
+            else:
+                self.add_or_append_list_value(self.added, command_key, each_value)
+
+        for each_value in previous_values:
+            # Don't need preserved, since already added in current
+            if each_value not in current_members:
+                self.add_or_append_list_value(self.removed, command_key, each_value)
+
+    def compare_simple_commands(
+        self, current_command: Optional[dict], previous_command: Optional[dict]
+    ) -> None:
+        """
+        Compare two commands with single values and add to the appropriate dictionary
+        """
+        if current_command and not previous_command:
+            self.add(current_command)
+        elif not current_command and previous_command:
+            self.remove(previous_command)
+        elif current_command == previous_command:
+            self.preserve(current_command)
+        else:
+            self.change(current_command)
+
+
+# Characters that change how shlex splits a command, other than plain spaces
+SHLEX_SPECIAL_CHARACTERS = frozenset("'\"\\\t\r\n")
+# Configurations with more commands than this are diffed by sorting, not indexing
+SORTED_DIFF_THRESHOLD = 100000
+
+
+def split_command(command: str) -> List[str]:
+    """
+    Splits a command into its tokens, the same as shlex would
+    Most commands have no quoting at all, so avoid shlex for those since it is slow
+    """
+    if SHLEX_SPECIAL_CHARACTERS.isdisjoint(command):
+        return [token for token in command.split(" ") if token]
+
+    return shlex.split(command)
+
+
+def split_command_key(command: str) -> Tuple[str, str]:
+    """
+    Splits a command into its key and value
+    """
+    tokens = split_command(command)
+    return (" ".join(tokens[:-1]), tokens[-1])
+
+
+def index_commands(commands: List[str]) -> Dict[str, Union[str, List[str]]]:
+    """
+    Indexes commands by their key, tokenizing each command only once
+    Keys set more than once have all of their values in a list
+    """
+    commands_by_key = {}
+    for command in commands:
+        command_key, command_value = split_command_key(command)
+        existing_value = commands_by_key.get(command_key, None)
+        # If command already found and it's a list,
+        # add this to it for comparison purposes
+        if isinstance(existing_value, list):
+            existing_value.append(command_value)
+        # Otherwise, if not a list, make it into a list with new value
+        elif command_key in commands_by_key:
+            commands_by_key[command_key] = [existing_value, command_value]
+        else:
+            commands_by_key[command_key] = command_value
+
+    return commands_by_key
+
+
+def diff_configurations(
+    current_commands: List[str], previous_commands: List[str]
+) -> ConfigDifference:
+    """
+    Diff a configuration against its previous, summarizing changes
+    Large configurations are diffed by sorting, which allocates far less
+    """
+    if max(len(current_commands), len(previous_commands)) > SORTED_DIFF_THRESHOLD:
+        return diff_sorted_commands(current_commands, previous_commands)
+
+    return diff_command_indexes(
+        index_commands(current_commands), index_commands(previous_commands)
+    )
+
+
+def diff_command_indexes(
+    current_commands_by_key: Dict[str, Union[str, List[str]]],
+    previous_commands_by_key: Dict[str, Union[str, List[str]]],
+) -> ConfigDifference:
+    """
+    Diff configurations already indexed by command key
+    """
+    difference = ConfigDifference()
+
+    for command, value in current_commands_by_key.items():
+        difference.compare_commands(
+            {command: value},
+            {command: previous_commands_by_key[command]}
+            if command in previous_commands_by_key
+            else None,
+        )
+
+    for command, value in previous_commands_by_key.items():
+        # Lists already had a full diff done in the first pass for the current values
+        # if there was a value for it
+        if command in current_commands_by_key and (
+            isinstance(value, list)
+            or isinstance(current_commands_by_key[command], list)
+        ):
+            continue
+
+        difference.compare_commands(
+            {command: current_commands_by_key[command]}
+            if command in current_commands_by_key
+            else None,
+            {command: value},
+        )
+
+    return difference
+
+
+# pylint: disable=too-few-public-methods
+class KeyInterner:
+    """
+    Assigns each distinct command key an integer, in the order first seen
+    """
+
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.keys: List[str] = []
+
+    def intern(self, command_key: str) -> int:
+        """
+        Gets the integer for a key
+        """
+        key_id = self.ids.get(command_key, None)
+        if key_id is None:
+            key_id = len(self.keys)
+            self.ids[command_key] = key_id
+            self.keys.append(command_key)
+
+        return key_id
+
+
+def sort_commands(
+    commands: List[str], interner: KeyInterner
+) -> Tuple[array, List[str]]:
+    """
+    Tokenizes commands into their interned keys, sorted, and the values in the
+    same order
+    Values for the same key stay in the order they were given
+    """
+    key_ids = array("q")
+    values = []
+    for command in commands:
+        command_key, command_value = split_command_key(command)
+        key_ids.append(interner.intern(command_key))
+        values.append(command_value)
+
+    order = sorted(range(len(key_ids)), key=key_ids.__getitem__)
+    return (
+        array("q", [key_ids[index] for index in order]),
+        [values[index] for index in order],
+    )
+
+
+def get_run_end(key_ids: array, start: int, key_id: int) -> int:
+    """
+    Finds the end of the run of a key in sorted keys
+    """
+    end = start
+    while end < len(key_ids) and key_ids[end] == key_id:
+        end += 1
+
+    return end
+
+
+def compare_sorted_values(
+    difference: ConfigDifference,
+    command_key: str,
+    current_values: List[str],
+    previous_values: List[str],
+) -> None:
+    """
+    Compares the values of a key in two configurations, the same as
+    ConfigDifference.compare_commands would for their indexes
+    """
+    if len(current_values) <= 1 and len(previous_values) <= 1:
+        if not previous_values:
+            difference.added[command_key] = current_values[0]
+        elif not current_values:
+            difference.removed[command_key] = previous_values[0]
+        elif current_values[0] == previous_values[0]:
+            difference.preserved[command_key] = current_values[0]
+        else:
+            difference.changed[command_key] = current_values[0]
+        return
+
+    current_members = set(current_values)
+    previous_members = set(previous_values)
+    for value in current_values:
+        difference.add_or_append_list_value(
+            difference.preserved if value in previous_members else difference.added,
+            command_key,
+            value,
+        )
+
+    for value in previous_values:
+        if value not in current_members:
+            difference.add_or_append_list_value(difference.removed, command_key, value)
+
+
+def diff_sorted_commands(
+    current_commands: List[str], previous_commands: List[str]
+) -> ConfigDifference:
+    """
+    Diff a configuration against its previous by sorting both by key, then
+    walking them together in a single pass
+
+    Current keys are interned first, so sorting by key gives the same order
+    as diffing the indexes of the commands
+    """
+    interner = KeyInterner()
+    current_keys, current_values = sort_commands(current_commands, interner)
+    previous_keys, previous_values = sort_commands(previous_commands, interner)
+
+    difference = ConfigDifference()
+    # Greater than any interned key, for when one side has run out
+    no_key = len(interner.keys)
+    current_index = 0
+    previous_index = 0
+    while current_index < len(current_keys) or previous_index < len(previous_keys):
+        key_id = min(
+            current_keys[current_index]
+            if current_index < len(current_keys)
+            else no_key,
+            previous_keys[previous_index]
+            if previous_index < len(previous_keys)
+            else no_key,
+        )
+        current_end = get_run_end(current_keys, current_index, key_id)
+        previous_end = get_run_end(previous_keys, previous_index, key_id)
+        compare_sorted_values(
+            difference,
+            interner.keys[key_id],
+            current_values[current_index:current_end],
+            previous_values[previous_index:previous_end],
+        )
+        current_index = current_end
+        previous_index = previous_end
+
+    return difference
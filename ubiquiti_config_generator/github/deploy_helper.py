@@ -1,322 +1,713 @@
 """
 Functionality needed for deploying and checking configurations
 """
+from contextlib import contextmanager
 import shlex
-from typing import List, Optional
+from typing import Dict, Iterator, List, Optional, Set, Tuple, Union
 
 import paramiko
 from ubiquiti_config_generator import root_parser, file_paths
-
-
-class ConfigDifference:
-    """
-    Calculates and stores differences between configuration commands
-    """
-
-    def __init__(self):
-        # These contain path to the key -> key value
-        # Indexed by command to enable a quick lookup
-        self.removed = {}
-        self.added = {}
-        self.changed = {}
-        self.preserved = {}
-
-    def remove(self, command: dict) -> None:
-        """
-        Add a command that was removed
-        """
-        self.removed.update(command)
-
-    def add(self, command: dict) -> None:
-        """
-        Add a command that was added
-        """
-        self.added.update(command)
-
-    def change(self, command: dict) -> None:
-        """
-        Add a command that was changed
-        """
-        self.changed.update(command)
-
-    def preserve(self, command: dict) -> None:
-        """
-        Add a command that was preserved
-        """
-        self.preserved.update(command)
-
-    def add_or_append_list_value(self, component: dict, key: str, value: str) -> None:
-        """
-        Adds a given value for a key to a command configuration difference
-        """
-        if key not in component:
-            component[key] = [value]
-        else:
-            component[key].append(value)
-
-    def compare_commands(
-        self, current_command: Optional[dict], previous_command: Optional[dict]
-    ) -> None:
-        """
-        Compare two commands and add to the appropriate dictionary
-        """
-        is_list = (
-            current_command and isinstance(list(current_command.values())[0], list)
-        ) or (previous_command and isinstance(list(previous_command.values())[0], list))
-
-        if is_list:
-            self.compare_list_commands(current_command, previous_command)
-        else:
-            self.compare_simple_commands(current_command, previous_command)
-
-    def compare_list_commands(
-        self, current_command: Optional[dict], previous_command: Optional[dict]
-    ) -> None:
-        """
-        Compare two commands with list values
-        """
-        command_key = (
-            list(current_command.keys())[0]
-            if current_command
-            else list(previous_command.keys())[0]
-        )
-        current_values = list(current_command.values())[0] if current_command else []
-        previous_values = list(previous_command.values())[0] if previous_command else []
-
-        for each_value in current_values:
-            if each_value in previous_values:
-                self.add_or_append_list_value(self.preserved, command_key, each_value)
-            else:
-                self.add_or_append_list_value(self.added, command_key, each_value)
-
-        for each_value in previous_values:
-            # Don't need preserved, since already added in current
-            if each_value not in current_values:
-                self.add_or_append_list_value(self.removed, command_key, each_value)
-
-    def compare_simple_commands(
-        self, current_command: Optional[dict], previous_command: Optional[dict]
-    ) -> None:
-        """
-        Compare two commands with single values and add to the appropriate dictionary
-        """
-        if current_command and not previous_command:
-            self.add(current_command)
-        elif not current_command and previous_command:
-            self.remove(previous_command)
-        elif current_command == previous_command:
-            self.preserve(current_command)
-        else:
-            self.change(current_command)
+from ubiquiti_config_generator.command_tree import (
+    CommandTree,
+    has_namespace_collision,
+    prune_identical_subtrees,
+)
+from ubiquiti_config_generator import rule_matching
+from ubiquiti_config_generator.github import phase_packing, router_pool
+from ubiquiti_config_generator.github.config_difference import (
+    ConfigDifference,
+    OrderedValueSet,
+    as_list,
+    diff_command_indexes,
+    diff_configurations,
+    index_commands,
+    split_command,
+    split_command_key,
+)
+from ubiquiti_config_generator.messages import db
+from ubiquiti_config_generator.messages.command_snapshot import CommandSnapshot
+from ubiquiti_config_generator.messages.log import Log
 
 
 def get_command_key(command: str) -> str:
     """
     Gets the command key, everything except the last space-separated value
     """
-    return " ".join(shlex.split(command)[:-1])
+    return split_command_key(command)[0]
 
 
-def diff_configurations(
-    current_commands: List[str], previous_commands: List[str]
+def diff_command_trees(
+    current_tree: CommandTree, previous_tree: CommandTree
 ) -> ConfigDifference:
     """
-    Diff a configuration against its previous, summarizing changes
-    """
-    current_commands_by_key = {}
-    previous_commands_by_key = {}
-
-    for command in current_commands:
-        command_key = get_command_key(command)
-        command_value = shlex.split(command)[-1]
-        # If command already found and it's a list,
-        # add this to it for comparison purposes
-        if command_key in current_commands_by_key and isinstance(
-            current_commands_by_key[command_key], list
-        ):
-            current_commands_by_key[command_key].append(command_value)
-        # Otherwise, if not a list, make it into a list with new value
-        elif command_key in current_commands_by_key:
-            current_commands_by_key[command_key] = [
-                current_commands_by_key[command_key],
-                command_value,
-            ]
-        else:
-            current_commands_by_key[command_key] = command_value
-
-    for command in previous_commands:
-        command_key = get_command_key(command)
-        command_value = shlex.split(command)[-1]
-        # If command already found and it's a list,
-        # add this to it for comparison purposes
-        if command_key in previous_commands_by_key and isinstance(
-            previous_commands_by_key[command_key], list
-        ):
-            previous_commands_by_key[command_key].append(command_value)
-        # Otherwise, if not a list, make it into a list with new value
-        elif command_key in previous_commands_by_key:
-            previous_commands_by_key[command_key] = [
-                previous_commands_by_key[command_key],
-                command_value,
-            ]
-        else:
-            previous_commands_by_key[command_key] = command_value
+    Diff a configuration against its previous, skipping nodes whose commands are
+    identical in both, so only the changed parts are compared command by command
+    Commands in skipped nodes are not included in the preserved commands
+    """
+    (
+        current_commands,
+        previous_commands,
+        namespaces,
+    ) = prune_identical_subtrees(current_tree, previous_tree)
+
+    # Another node setting the same keys as a skipped one would be compared
+    # differently without the skipped commands, so compare everything instead
+    if has_namespace_collision(current_commands, namespaces) or has_namespace_collision(
+        previous_commands, namespaces
+    ):
+        return diff_configurations(current_tree.flatten(), previous_tree.flatten())
 
-    difference = ConfigDifference()
+    return diff_configurations(current_commands, previous_commands)
 
-    for command, value in current_commands_by_key.items():
-        difference.compare_commands(
-            {command: value},
-            {command: previous_commands_by_key[command]}
-            if command in previous_commands_by_key
-            else None,
+
+def parse_live_commands(output: str) -> List[str]:
+    """
+    Parses the output of "show configuration commands" on the router into commands
+    in the same form as generated ones
+    """
+    return [
+        line.strip()[len("set ") :]
+        for line in output.splitlines()
+        if line.strip().startswith("set ")
+    ]
+
+
+def get_live_commands(client: paramiko.SSHClient, deploy_config: dict) -> List[str]:
+    """
+    Gets the commands of the configuration currently running on the router
+
+    Throws ValueError
+    """
+    # pylint: disable=unused-variable
+    stdin, stdout, stderr = client.exec_command(
+        deploy_config.get("op-cmd-path", "/opt/vyatta/bin/vyatta-op-cmd-wrapper")
+        + " show configuration commands"
+    )
+    output = stdout.read().decode()
+    if stdout.channel.recv_exit_status() != 0:
+        raise ValueError(
+            "Failed to read router configuration: " + stderr.read().decode()
         )
 
-    for command, value in previous_commands_by_key.items():
-        # Lists already had a full diff done in the first pass for the current values
-        # if there was a value for it
-        if isinstance(value, list) and command in current_commands_by_key:
+    return parse_live_commands(output)
+
+
+def get_managed_live_values(
+    live_commands_by_key: Dict[str, Union[str, List[str]]],
+    current_commands_by_key: Dict[str, Union[str, List[str]]],
+    previous_commands_by_key: Dict[str, Union[str, List[str]]],
+) -> Dict[str, Union[str, List[str]]]:
+    """
+    Restricts the live configuration to the values either revision sets,
+    so anything configured manually on the router is left alone
+    """
+    managed = {}
+    for command_key, live_value in live_commands_by_key.items():
+        current_value = current_commands_by_key.get(command_key, None)
+        previous_value = previous_commands_by_key.get(command_key, None)
+        known_values = set(as_list(current_value) + as_list(previous_value))
+        values = [value for value in as_list(live_value) if value in known_values]
+        if not values:
             continue
 
-        difference.compare_commands(
-            {command: current_commands_by_key[command]}
-            if command in current_commands_by_key
-            else None,
-            {command: value},
+        # Keep the shape of the revisions, so values are compared the same way
+        if isinstance(current_value, list) or isinstance(previous_value, list):
+            managed[command_key] = values
+        else:
+            managed[command_key] = values[0]
+
+    return managed
+
+
+def diff_live_commands(
+    current_commands_by_key: Dict[str, Union[str, List[str]]],
+    previous_commands_by_key: Dict[str, Union[str, List[str]]],
+    live_commands_by_key: Dict[str, Union[str, List[str]]],
+) -> Tuple[ConfigDifference, ConfigDifference]:
+    """
+    Three-way diff of the current revision against the live router configuration,
+    using the previous revision to tell which live values are managed here
+
+    Values already live are preserved rather than applied again, values missing
+    from the router are added back, and values only configured on the router are
+    never removed.
+    Also returns how the live configuration drifted from the previous revision.
+    """
+    difference = diff_command_indexes(
+        current_commands_by_key,
+        get_managed_live_values(
+            live_commands_by_key, current_commands_by_key, previous_commands_by_key
+        ),
+    )
+
+    # The router may set several values for a key set once here, or the reverse,
+    # so compare every key set several times by its list of values
+    live_values = {}
+    previous_values = {}
+    for command_key, previous_value in previous_commands_by_key.items():
+        live_value = live_commands_by_key.get(command_key, None)
+        is_list = isinstance(previous_value, list) or isinstance(live_value, list)
+        previous_values[command_key] = (
+            as_list(previous_value) if is_list else previous_value
         )
+        if live_value is not None:
+            live_values[command_key] = as_list(live_value) if is_list else live_value
+
+    return (difference, diff_command_indexes(live_values, previous_values))
+
+
+def plan_against_live_commands(
+    current_commands_by_key: Dict[str, Union[str, List[str]]],
+    previous_commands_by_key: Dict[str, Union[str, List[str]]],
+    live_commands: List[str],
+    deployment_revisions: Optional[Tuple[str, str]] = None,
+) -> ConfigDifference:
+    """
+    Diffs the current configuration against the commands running on the router,
+    reporting any drift from the previous configuration, in the log of the
+    deployment between the given revisions if there is one
+    """
+    difference, drift = diff_live_commands(
+        current_commands_by_key, previous_commands_by_key, index_commands(live_commands)
+    )
+    drift_count = sum(
+        [len(getattr(drift, category)) for category in ["added", "removed", "changed"]]
+    )
+    if drift_count:
+        message = (
+            f"Router configuration has drifted from the previous in {drift_count} keys"
+        )
+        print(message)
+        if deployment_revisions is not None:
+            db.add_deployment_log(
+                Log(
+                    deployment_revisions[0],
+                    message,
+                    revision2=deployment_revisions[1],
+                )
+            )
 
     return difference
 
 
+def get_changed_networks(changed_files: List[str]) -> Set[str]:
+    """
+    Gets the names of networks with changed configuration files
+    The files are relative to the root of the configuration repository
+    """
+    networks = set()
+    for changed_file in changed_files:
+        # Git always separates paths with forward slashes
+        parts = changed_file.split("/")
+        if len(parts) > 2 and parts[0] == file_paths.NETWORK_FOLDER:
+            networks.add(parts[1])
+
+    return networks
+
+
+def has_configuration_changes(changed_files: Optional[List[str]]) -> bool:
+    """
+    Could the changed files change the configuration, which is always assumed
+    if they are not known
+    """
+    return changed_files is None or bool(
+        [file_path for file_path in changed_files if file_path.endswith(".yaml")]
+    )
+
+
+def is_configuration_unchanged(
+    current_config_path: str,
+    previous_config_path: str,
+    changed_files: Optional[List[str]] = None,
+    current_config: Optional[root_parser.RootNode] = None,
+    previous_config: Optional[root_parser.RootNode] = None,
+) -> bool:
+    """
+    Do two configurations generate exactly the same commands
+    If the files changed between them are given and none are configuration,
+    they cannot differ, so nothing needs loading
+    Configurations already loaded are used instead of loading them again
+    """
+    if not has_configuration_changes(changed_files):
+        return True
+
+    current_config = current_config or root_parser.RootNode.create_from_configs(
+        current_config_path
+    )
+    previous_config = previous_config or root_parser.RootNode.create_from_configs(
+        previous_config_path
+    )
+    return current_config.content_hash() == previous_config.content_hash()
+
+
+def get_firewall_names(root_node: root_parser.RootNode) -> List[str]:
+    """
+    Names of every firewall in a configuration
+    """
+    return [
+        firewall.name
+        for network in root_node.networks
+        for firewall in network.firewalls
+    ]
+
+
+def get_ruled_firewall_names(root_node: root_parser.RootNode) -> List[str]:
+    """
+    Names of every firewall in a configuration with at least one rule
+    """
+    return [
+        firewall.name
+        for network in root_node.networks
+        for firewall in network.firewalls
+        if firewall.rules
+    ]
+
+
+def get_snapshot_ruled_firewall_names(snapshot: CommandSnapshot) -> List[str]:
+    """
+    Names of every firewall in a snapshot with at least one rule command
+    """
+    ruled_firewalls = {
+        key_parts[2]
+        for key_parts in (key.split(" ", 4) for key in snapshot.index)
+        if key_parts[:2] == ["firewall", "name"]
+        and len(key_parts) > 3
+        and key_parts[3] == "rule"
+    }
+    return [name for name in snapshot.firewalls if name in ruled_firewalls]
+
+
+def get_dhcp_network_names(root_node: root_parser.RootNode) -> List[str]:
+    """
+    Names of networks with a DHCP address pool
+    """
+    return [
+        network.name
+        for network in root_node.networks
+        if hasattr(network, "stop") and network.stop
+    ]
+
+
+def create_command_snapshot(
+    revision: str,
+    root_node: root_parser.RootNode,
+    command_list: List[str],
+    command_index: Optional[Dict[str, Union[str, List[str]]]] = None,
+) -> CommandSnapshot:
+    """
+    Creates a snapshot of the commands for a revision's configuration
+    """
+    return CommandSnapshot(
+        revision,
+        command_list,
+        command_index if command_index is not None else index_commands(command_list),
+        get_firewall_names(root_node),
+        get_dhcp_network_names(root_node),
+        rules=rule_matching.get_configuration_rules(root_node),
+    )
+
+
+def select_commands_to_run(
+    ordered_commands: List[List[str]],
+    difference: ConfigDifference,
+    apply_diff_only: bool,
+) -> List[List[str]]:
+    """
+    Selects the ordered commands to set, dropping any phases left empty
+    Every command is set, unless only applying the difference
+    """
+    selected_commands = []
+    for command_set in ordered_commands:
+        selected_commands.append([])
+
+        for command in command_set:
+            # Include every command if applying the entire config
+            if not apply_diff_only:
+                selected_commands[-1].append("set " + command)
+                continue
+
+            command_prefix, command_value = split_command_key(command)
+            if isinstance(
+                difference.changed.get(command_prefix, None), list
+            ) or isinstance(difference.added.get(command_prefix, None), list):
+                should_include = command_value in difference.added.get(
+                    command_prefix, []
+                ) or command_value in difference.changed.get(command_prefix, [])
+            else:
+                # or the command's value is new or changed
+                should_include = (
+                    command_prefix in difference.changed
+                    or command_prefix in difference.added
+                )
+
+            # the command's value changed
+            if should_include:
+                selected_commands[-1].append("set " + command)
+
+        if not selected_commands[-1]:
+            del selected_commands[-1]
+
+    return selected_commands
+
+
 # Most excess locals are convenience, and improve readability
-# pylint: disable=too-many-locals
+# pylint: disable=too-many-arguments,too-many-locals
 def get_commands_to_run(
-    current_config_path: str, previous_config_path: str, only_return_diff: bool = False
+    current_config_path: str,
+    previous_config_path: str,
+    only_return_diff: bool = False,
+    changed_files: Optional[List[str]] = None,
+    previous_snapshot: Optional[CommandSnapshot] = None,
+    current_revision: Optional[str] = None,
+    live_commands: Optional[List[str]] = None,
+    revert_revisions: Optional[Tuple[str, str]] = None,
+    current_config: Optional[root_parser.RootNode] = None,
+    previous_config: Optional[root_parser.RootNode] = None,
+    deployment_revisions: Optional[Tuple[str, str]] = None,
 ) -> List[List[str]]:
     """
     Given two sets of configurations, returns the ordered command sets to execute
+
+    If the files changed between the configurations are provided and only the
+    difference is being applied, only the networks with changed files are compared
+    Everything outside of networks is always compared, as is every host, since
+    hosts add NAT rules and address groups
+
+    Otherwise, a stored snapshot of the previous commands is used instead of the
+    previous configuration if provided, and the current commands are stored for
+    the given current revision
+
+    If the commands running on the router are provided, the current configuration
+    is compared against those instead, with the previous one only used to find
+    which of them were configured here
+
+    If the revisions being deployed from and to are provided, the commands undoing
+    the deployment are stored for them
+
+    Configurations already loaded in full are used instead of loading them again
+
+    If the revisions being deployed from and to are provided, any drift of the
+    router's configuration is recorded in that deployment's log
     """
     deploy_config = file_paths.load_yaml_from_file("deploy.yaml")
+    apply_diff_only = only_return_diff or deploy_config["apply-difference-only"]
+    network_names = (
+        get_changed_networks(changed_files)
+        if apply_diff_only and changed_files is not None
+        else None
+    )
+    use_snapshot = previous_snapshot is not None and network_names is None
+    loaded_configs = (current_config, previous_config)
 
-    current_config = root_parser.RootNode.create_from_configs(current_config_path)
-    previous_config = root_parser.RootNode.create_from_configs(previous_config_path)
+    if current_config is None:
+        current_config = root_parser.RootNode.create_from_configs(
+            current_config_path, network_names
+        )
+    if previous_config is None and not use_snapshot:
+        previous_config = root_parser.RootNode.create_from_configs(
+            previous_config_path, network_names
+        )
 
-    current_ordered_commands, current_command_list = current_config.get_commands()
-    # The previous ordered commands are unused, but need the list
-    # pylint: disable=unused-variable
-    previous_ordered_commands, previous_command_list = previous_config.get_commands()
+    # Only the deployed snapshot has the numbers pinned when it was deployed,
+    # since generating the previous configuration numbers its rules afresh,
+    # so only pin when comparing against it or what the router is running
+    previous_rules = (
+        previous_snapshot.rules
+        if deploy_config.get("pin-rule-numbers", False)
+        and previous_snapshot is not None
+        and (use_snapshot or live_commands is not None)
+        else None
+    )
+    if previous_rules is not None:
+        rule_matching.pin_configuration_rules(current_config, previous_rules)
 
-    difference = diff_configurations(current_command_list, previous_command_list)
+    current_ordered_commands, current_command_list = current_config.get_commands(
+        network_names
+    )
 
-    apply_diff_only = only_return_diff or deploy_config["apply-difference-only"]
-    run_commands = [[]]
+    current_command_index = None
+    previous_command_list = None
+    if use_snapshot:
+        current_command_index = index_commands(current_command_list)
+        difference = diff_against_snapshot(
+            current_command_index,
+            previous_snapshot,
+            live_commands,
+            deployment_revisions,
+        )
+        previous_ruled_firewalls = get_snapshot_ruled_firewall_names(previous_snapshot)
+        previous_dhcp_networks = previous_snapshot.dhcp_networks
+    else:
+        difference, previous_command_list = diff_against_configuration(
+            (current_config, previous_config),
+            current_command_list,
+            network_names,
+            live_commands,
+            deployment_revisions,
+        )
+        previous_ruled_firewalls = get_ruled_firewall_names(previous_config)
+        previous_dhcp_networks = get_dhcp_network_names(previous_config)
+
+    # Only a complete list of commands can be compared against later
+    if current_revision is not None and network_names is None:
+        db.store_command_snapshot(
+            create_command_snapshot(
+                current_revision,
+                current_config,
+                current_command_list,
+                current_command_index,
+            )
+        )
 
     # Run deletes in a single batch first, since that _shouldn't_ cause any issues
-    for key, value in difference.removed.items():
-        if isinstance(value, list):
-            for each_value in value:
-                run_commands[0].append(
-                    " ".join(["delete", key, shlex.quote(each_value)])
-                )
-        else:
-            run_commands[0].append(" ".join(["delete", key, shlex.quote(value)]))
-
-    # If applying whole diff, ensure nat and firewalls get cleared, since
-    # rule re-ordering could mean something from a previous rule gets merged
-    # e.g. before:
-    # rule 20: source <addr> port 80
-    # after preserves source, ADDING destination instead of overwriting the original:
-    # rule 20 :destination <addr2> source <addr>
+    run_commands = [get_delete_commands(difference)]
     if not apply_diff_only:
-        # First get every firewall in the previous config
-        previous_firewall_names = [
-            firewall.name
-            for network in previous_config.networks
-            for firewall in network.firewalls
-        ]
-        # And then restrict the current ones to those in the previous, since
-        # won't need to reset a net-new firewall configuration
-        current_firewall_names = [
-            firewall.name
-            for network in current_config.networks
-            for firewall in network.firewalls
-            if firewall.name in previous_firewall_names
-        ]
         run_commands[0].extend(
-            [
-                "delete service nat",
-                *[
-                    f"delete firewall name {firewall_name} rule"
-                    for firewall_name in current_firewall_names
-                ],
-            ]
+            get_reset_commands(
+                current_config,
+                previous_ruled_firewalls,
+                previous_dhcp_networks,
+                previous_rules,
+            )
         )
 
-        # Can have multiple DHCP networks set, but on updates
-        # this will likely overlap (e.g. if shrinking or extending) address pool
-        # need to delete any that are in both previous and current configs
-        previous_dhcp_networks = [
-            network.name
-            for network in previous_config.networks
-            if hasattr(network, "stop") and network.stop
-        ]
+    run_commands.extend(
+        select_commands_to_run(current_ordered_commands, difference, apply_diff_only)
+    )
+
+    if deploy_config.get("pack-command-phases", False):
+        run_commands = phase_packing.pack_phases(run_commands)
+
+    # Check the changed networks are all that need comparing, e.g. that networks
+    # do not set the same keys as each other
+    if network_names is not None and deploy_config.get(
+        "verify-changed-file-plan", False
+    ):
+        full_run_commands = get_commands_to_run(
+            current_config_path,
+            previous_config_path,
+            only_return_diff,
+            None,
+            previous_snapshot,
+            current_revision,
+            live_commands,
+            revert_revisions,
+            *loaded_configs,
+            deployment_revisions,
+        )
+        if full_run_commands != run_commands:
+            print("Commands for changed files differ from full comparison, using full")
+
+        return full_run_commands
+
+    if revert_revisions is not None:
+        db.store_revert_commands(
+            *revert_revisions,
+            get_inverse_commands(
+                run_commands,
+                get_previous_command_index(
+                    live_commands,
+                    previous_snapshot if use_snapshot else None,
+                    previous_command_list,
+                ),
+            ),
+        )
+
+    return run_commands
+
+
+def diff_against_snapshot(
+    current_command_index: Dict[str, Union[str, List[str]]],
+    previous_snapshot: CommandSnapshot,
+    live_commands: Optional[List[str]],
+    deployment_revisions: Optional[Tuple[str, str]],
+) -> ConfigDifference:
+    """
+    Diffs the current commands against a snapshot of the previous ones, or
+    against the commands running on the router if provided
+    """
+    if live_commands is None:
+        return diff_command_indexes(current_command_index, previous_snapshot.index)
+
+    return plan_against_live_commands(
+        current_command_index,
+        previous_snapshot.index,
+        live_commands,
+        deployment_revisions,
+    )
+
 
-        current_dhcp_networks = [
-            network
+def diff_against_configuration(
+    configs: Tuple[root_parser.RootNode, root_parser.RootNode],
+    current_command_list: List[str],
+    network_names: Optional[Set[str]],
+    live_commands: Optional[List[str]],
+    deployment_revisions: Optional[Tuple[str, str]],
+) -> Tuple[ConfigDifference, List[str]]:
+    """
+    Diffs the current configuration against the previous one, or against the
+    commands running on the router if provided
+    Returns the difference and the previous configuration's commands
+    """
+    current_config, previous_config = configs
+    previous_command_list = previous_config.get_commands(network_names)[1]
+
+    if live_commands is None:
+        difference = diff_command_trees(
+            current_config.get_command_tree(current_command_list, network_names),
+            previous_config.get_command_tree(previous_command_list, network_names),
+        )
+    else:
+        difference = plan_against_live_commands(
+            index_commands(current_command_list),
+            index_commands(previous_command_list),
+            live_commands,
+            deployment_revisions,
+        )
+
+    return (difference, previous_command_list)
+
+
+def get_delete_commands(difference: ConfigDifference) -> List[str]:
+    """
+    The commands deleting everything removed from the configuration
+    """
+    delete_commands = []
+    for key, value in difference.removed.items():
+        for each_value in as_list(value):
+            delete_commands.append(" ".join(["delete", key, shlex.quote(each_value)]))
+
+    return delete_commands
+
+
+def get_reset_commands(
+    current_config: root_parser.RootNode,
+    previous_ruled_firewalls: List[str],
+    previous_dhcp_networks: List[str],
+    previous_rules: Optional[Dict[str, List[Tuple[int, str]]]],
+) -> List[str]:
+    """
+    The commands clearing NAT, firewall rules and DHCP pools before applying the
+    entire configuration, since rule re-ordering could mean something from a
+    previous rule gets merged
+    e.g. before:
+    rule 20: source <addr> port 80
+    after preserves source, ADDING destination instead of overwriting the original:
+    rule 20 :destination <addr2> source <addr>
+    """
+    reset_commands = ["delete service nat"]
+    # Restrict the current ones to those with rules in the previous, since
+    # won't need to reset a net-new firewall configuration, and the router
+    # refuses to delete the rules of a firewall that has none
+    current_firewalls = [
+        firewall
+        for network in current_config.networks
+        for firewall in network.firewalls
+        if firewall.name in previous_ruled_firewalls
+    ]
+    for firewall in current_firewalls:
+        # With rules matched by content, only rules which are gone or changed
+        # need removing, rather than every rule
+        if previous_rules is not None and firewall.name in previous_rules:
+            reset_commands.extend(
+                [
+                    f"delete firewall name {firewall.name} rule {number}"
+                    for number in rule_matching.get_stale_rule_numbers(
+                        firewall, previous_rules[firewall.name]
+                    )
+                ]
+            )
+        else:
+            reset_commands.append(f"delete firewall name {firewall.name} rule")
+
+    # Can have multiple DHCP networks set, but on updates
+    # this will likely overlap (e.g. if shrinking or extending) address pool
+    # need to delete any that are in both previous and current configs
+    reset_commands.extend(
+        [
+            f"delete service dhcp-server shared-network-name {network.name} "
+            f"subnet {network.cidr} start"
             for network in current_config.networks
             if hasattr(network, "stop")
             and network.stop
             and network.name in previous_dhcp_networks
         ]
+    )
 
-        run_commands[0].extend(
-            [
-                f"delete service dhcp-server shared-network-name {network.name} "
-                f"subnet {network.cidr} start"
-                for network in current_dhcp_networks
-            ]
-        )
+    return reset_commands
 
-    for command_set in current_ordered_commands:
-        run_commands.append([])
 
-        for command in command_set:
-            command_prefix = (
-                command if not apply_diff_only else get_command_key(command)
-            )
+def get_previous_command_index(
+    live_commands: Optional[List[str]],
+    previous_snapshot: Optional[CommandSnapshot],
+    previous_command_list: Optional[List[str]],
+) -> Dict[str, Union[str, List[str]]]:
+    """
+    Indexes what was on the router before a deployment ran, to undo it against:
+    the commands running on it if read, otherwise the snapshot compared against,
+    otherwise the previous configuration's commands
+    """
+    if live_commands is not None:
+        return index_commands(live_commands)
+    if previous_snapshot is not None:
+        return previous_snapshot.index
 
-            # Include commands only if applying the entire config
-            should_include = not apply_diff_only
-            if isinstance(
-                difference.changed.get(command_prefix, None), list
-            ) or isinstance(difference.added.get(command_prefix, None), list):
-                command_value = shlex.split(command)[-1]
-                should_include = should_include or (
-                    command_value in difference.added.get(command_prefix, [])
-                    or command_value in difference.changed.get(command_prefix, [])
-                )
+    return index_commands(previous_command_list)
+
+
+def get_inverse_commands(
+    run_commands: List[List[str]],
+    previous_commands_by_key: Dict[str, Union[str, List[str]]],
+) -> List[str]:
+    """
+    The commands undoing a deployment, given the commands it runs and the
+    configuration before it ran
+    Everything added is deleted first, then everything removed or changed is set
+    back to its previous value, so they can all run in one commit
+    """
+    deletes = OrderedValueSet()
+    sets = OrderedValueSet()
+    for command in [command for phase in run_commands for command in phase]:
+        action, path = command.split(" ", 1)
+        tokens = split_command(path)
+        command_key = " ".join(tokens[:-1])
+        previous_values = as_list(previous_commands_by_key.get(command_key, None))
+
+        if action == "delete":
+            if tokens[-1] in previous_values:
+                sets.append(f"set {command_key} {shlex.quote(tokens[-1])}")
             else:
-                # or the command's value is new or changed
-                should_include = should_include or (
-                    command_prefix in difference.changed
-                    or command_prefix in difference.added
-                )
+                # Deleting a whole path removes every value under it
+                sets.extend(get_path_commands(tokens, previous_commands_by_key))
+        elif tokens[-1] not in previous_values:
+            if isinstance(previous_commands_by_key.get(command_key, None), str):
+                sets.append(f"set {command_key} {shlex.quote(previous_values[0])}")
+            else:
+                deletes.append(command.replace("set ", "delete ", 1))
 
-            # the command's value changed
-            if should_include:
-                run_commands[-1].append("set " + command)
+    return list(deletes) + list(sets)
 
-        if not run_commands[-1]:
-            del run_commands[-1]
 
-    return run_commands
+def get_path_commands(
+    path_tokens: List[str], commands_by_key: Dict[str, Union[str, List[str]]]
+) -> List[str]:
+    """
+    The commands setting every value at or under a path
+    """
+    return [
+        f"set {command_key} {shlex.quote(value)}"
+        for command_key, values in commands_by_key.items()
+        for value in as_list(values)
+        if (command_key.split(" ") + [value])[: len(path_tokens)] == path_tokens
+    ]
 
 
-def generate_bash_commands(commands: List[str], deploy_config: dict) -> str:
+def get_script_header(deploy_config: dict, top_pid: str) -> str:
     """
-    Creates the commands to execute for vbash to update the configuration
+    The start of a vbash script, up to beginning the configuration session
+    Failures stop the process with the given PID
     """
-    header = (
+    check_command = (
         "function check_command() {\n"
         "  status=$1\n"
         '  output="${2}"\n'
@@ -331,11 +722,21 @@ def generate_bash_commands(commands: List[str], deploy_config: dict) -> str:
         "}\n\n"
     )
 
-    output = "\n".join(['trap "exit 1" TERM', "export TOP_PID=$1", ""]) + "\n"
+    output = "\n".join(['trap "exit 1" TERM', f"export TOP_PID={top_pid}", ""]) + "\n"
 
-    output += (
-        header if deploy_config["auto-rollback-on-failure"] else ""
-    ) + f"{deploy_config['script-cfg-path']} begin\n\n"
+    return (
+        output
+        + (check_command if deploy_config["auto-rollback-on-failure"] else "")
+        + f"{deploy_config['script-cfg-path']} begin\n\n"
+    )
+
+
+def get_script_commands(commands: List[str], deploy_config: dict) -> str:
+    """
+    Sets each command in the configuration session, checking it if rolling back
+    """
+    if deploy_config.get("compact-command-scripts", False):
+        return get_compact_script_commands(commands, deploy_config)
 
     command_template = (
         f"{deploy_config['script-cfg-path']} {{0}}\n"
@@ -347,10 +748,50 @@ def generate_bash_commands(commands: List[str], deploy_config: dict) -> str:
         )
     )
 
-    for command in commands:
-        output += command_template.format(command, shlex.quote(command))
+    return "".join(
+        [command_template.format(command, shlex.quote(command)) for command in commands]
+    )
+
+
+def get_compact_script_commands(commands: List[str], deploy_config: dict) -> str:
+    """
+    Sets each command in the configuration session from a list of them in the
+    script, read by a loop, so the script is a line per command and each command
+    needs only the process for the wrapper itself
+    """
+    if not commands:
+        return ""
+
+    cfg_path = deploy_config["script-cfg-path"]
+    rollback = deploy_config["auto-rollback-on-failure"]
+    # Parse quoting in the command the same way as if it were in the script
+    loop = ["while IFS= read -r command; do", '  eval "set -- ${command}"']
+    if rollback:
+        loop += [
+            f'  {cfg_path} "$@" < /dev/null > "${{output_file}}" 2>&1',
+            "  status=$?",
+            "  if [ $status -ne 0 ]; then",
+            '    check_command $status "$(< "${output_file}")" "${command}"',
+            "  fi",
+        ]
+    else:
+        loop.append(f'  {cfg_path} "$@" < /dev/null')
+
+    loop += ["done <<'END_OF_COMMANDS'"] + commands + ["END_OF_COMMANDS", ""]
+
+    return (
+        ("output_file=$(mktemp)\n" if rollback else "")
+        + "\n".join(loop)
+        + ('rm -f "${output_file}"\n' if rollback else "")
+    )
+
 
-    if deploy_config["reboot-after-minutes"]:
+def get_script_commit(deploy_config: dict, confirm: bool = True) -> str:
+    """
+    Commits the configuration session, scheduling a reboot first if confirming
+    """
+    output = ""
+    if confirm and deploy_config["reboot-after-minutes"]:
         output += (
             # commit-confirm isn't included in the script wrapper, for reasons??
             '\nsudo sg vyattacfg -c "'
@@ -375,6 +816,14 @@ def generate_bash_commands(commands: List[str], deploy_config: dict) -> str:
         "fi\n\n"
     )
 
+    return output
+
+
+def get_script_footer(deploy_config: dict) -> str:
+    """
+    The end of a vbash script, saving the committed configuration if configured
+    """
+    output = ""
     if deploy_config["save-after-commit"]:
         output += (
             f'{deploy_config["script-cfg-path"]} save\n'
@@ -384,9 +833,39 @@ def generate_bash_commands(commands: List[str], deploy_config: dict) -> str:
             "fi\n\n"
         )
 
-    output += "exit 0\n"
+    return output + "exit 0\n"
 
-    return output
+
+def generate_bash_commands(commands: List[str], deploy_config: dict) -> str:
+    """
+    Creates the commands to execute for vbash to update the configuration
+    """
+    return (
+        get_script_header(deploy_config, "$1")
+        + get_script_commands(commands, deploy_config)
+        + get_script_commit(deploy_config)
+        + get_script_footer(deploy_config)
+    )
+
+
+def generate_session_script(
+    command_groups: List[List[str]], deploy_config: dict
+) -> str:
+    """
+    Creates a single vbash script applying every group of commands in one
+    configuration session, committing after each group
+    Only one reboot is scheduled, before the first commit, since rebooting
+    reverts every commit made after it
+    """
+    command_groups = [commands for commands in command_groups if commands]
+    # The script stops itself on failure, so its exit status shows the failure
+    output = get_script_header(deploy_config, "$$")
+    for index, commands in enumerate(command_groups):
+        output += f'echo "On phase {index} of {len(command_groups)}..."\n'
+        output += get_script_commands(commands, deploy_config)
+        output += get_script_commit(deploy_config, index == 0)
+
+    return output + get_script_footer(deploy_config)
 
 
 def get_router_connection(deploy_config: dict) -> paramiko.SSHClient:
@@ -429,29 +908,25 @@ def get_router_connection(deploy_config: dict) -> paramiko.SSHClient:
     return client
 
 
-def write_data_to_router_file(
-    client: paramiko.SSHClient, file_path: str, file_data: str
-) -> bool:
+@contextmanager
+def router_session(deploy_config: dict) -> Iterator[paramiko.SSHClient]:
     """
-    Writes data to a file on the router
+    A connection to the router for the duration of the context, shared with
+    others in the process if reusing connections, otherwise closed afterwards
 
-    Throws ValueError
+    Can throw the same errors as connecting to the router
     """
-    ftp = client.open_sftp()  # type: paramiko.sftp_client.SFTPClient
-    remote_file = ftp.file(file_path, "w", -1)  # type: paramiko.sftp_file.SFTPFile
-    if not remote_file:
-        raise ValueError("Failed to open remote file")
-    if not remote_file.writable():
-        raise ValueError("Remote file not writable")
-
-    remote_file.write(file_data)
-    remote_file.flush()
-    remote_file.close()
-
-    written = ftp.open(file_path).read().decode()
-    ftp.close()
-
-    return written == file_data
+    if not deploy_config.get("reuse-router-connection", False):
+        client = get_router_connection(deploy_config)
+        try:
+            yield client
+        finally:
+            client.close()
+        return
+
+    pool = router_pool.get_router_pool(deploy_config, get_router_connection)
+    with pool.connection() as client:
+        yield client
 
 
 def run_router_command(client: paramiko.SSHClient, command: str) -> paramiko.Channel:
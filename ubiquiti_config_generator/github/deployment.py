@@ -1,15 +1,27 @@
 """
 The deployment of configurations
 """
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+import dataclasses
+import time
+from typing import Callable, Dict, List, Optional
 
 import paramiko
 
-from ubiquiti_config_generator.github import api, deploy_helper
+from ubiquiti_config_generator import root_parser
+from ubiquiti_config_generator.github import api, deploy_helper, file_transfer
 from ubiquiti_config_generator.github.deployment_metadata import DeployMetadata
 from ubiquiti_config_generator.messages import db
+from ubiquiti_config_generator.messages.deployment import Deployment
 from ubiquiti_config_generator.messages.log import Log
 
+# Output lines are written to the deployment log once this many are waiting,
+# or they have waited this long
+LOG_BATCH_SIZE = 100
+LOG_BATCH_SECONDS = 1
+OUTPUT_CHUNK_BYTES = 32768
+OUTPUT_POLL_SECONDS = 0.05
+
 
 def handle_deployment(form: dict, deploy_config: dict, access_token: str) -> bool:
     """
@@ -22,12 +34,14 @@ def handle_deployment(form: dict, deploy_config: dict, access_token: str) -> boo
     before = form["deployment"]["payload"]["previous_commit"]
     after = form["deployment"]["ref"]
 
+    deployed = get_deployed_revision(before, deploy_config)
     metadata = DeployMetadata(
         before,
         after,
         deploy_config["git"]["webhook-url"],
         form["deployment"]["statuses_url"],
         deploy_config,
+        deployed if deployed != before else None,
     )
 
     if not db.update_deployment_status(
@@ -35,6 +49,16 @@ def handle_deployment(form: dict, deploy_config: dict, access_token: str) -> boo
     ):
         print("Failed to update local copy of deploy to in progress")
 
+    if metadata.deployed_sha is not None:
+        db.add_deployment_log(
+            Log(
+                before,
+                f"Planning from {deployed}, since the deployment of {before} "
+                "was reverted",
+                revision2=after,
+            )
+        )
+
     api.update_deployment_state(
         metadata.status_url,
         metadata.external_app_url,
@@ -55,23 +79,77 @@ def handle_deployment(form: dict, deploy_config: dict, access_token: str) -> boo
             api.Repository(
                 deploy_config["git"]["config-folder"],
                 form["repository"]["clone_url"],
-                before,
+                metadata.base_sha,
             ),
         ],
     )
 
-    command_groups = deploy_helper.get_commands_to_run(
-        deploy_config["git"]["diff-config-folder"],
-        deploy_config["git"]["config-folder"],
-        deploy_config["apply-difference-only"],
+    changed_files = (
+        api.get_changed_files(
+            deploy_config["git"]["diff-config-folder"], metadata.base_sha, after
+        )
+        if deploy_config.get("plan-changed-files-only", False)
+        else None
     )
+    current_config = None
+    previous_config = None
+    if deploy_config.get("skip-unchanged-deployments", False):
+        # Loaded once for both comparing and planning
+        if deploy_helper.has_configuration_changes(changed_files):
+            current_config = root_parser.RootNode.create_from_configs(
+                deploy_config["git"]["diff-config-folder"]
+            )
+            previous_config = root_parser.RootNode.create_from_configs(
+                deploy_config["git"]["config-folder"]
+            )
+
+        if deploy_helper.is_configuration_unchanged(
+            deploy_config["git"]["diff-config-folder"],
+            deploy_config["git"]["config-folder"],
+            changed_files,
+            current_config,
+            previous_config,
+        ):
+            return complete_unchanged_deployment(metadata, access_token)
+
+    # Planning against the live configuration depends on each router, so can
+    # only be shared with a single router
+    shared_plan = len(get_router_deploy_configs(deploy_config)) == 1 or not (
+        deploy_config.get("plan-against-live-config", False)
+    )
+    command_groups = (
+        plan_deployment(
+            metadata,
+            access_token,
+            changed_files,
+            True,
+            current_config,
+            previous_config,
+        )
+        if shared_plan
+        else None
+    )
+    if shared_plan and command_groups is None:
+        return False
 
     result = (
         "success"
-        if load_and_execute_config_changes(command_groups, metadata, access_token)
+        if run_on_routers(
+            metadata,
+            lambda router_metadata: deploy_to_router(
+                router_metadata, access_token, changed_files, command_groups
+            ),
+        )
         else "failure"
     )
 
+    store_commands = deploy_config.get("store-revision-commands", False)
+    if store_commands and result == "success":
+        db.mark_command_snapshot_deployed(after)
+        db.prune_command_snapshots(
+            deploy_config["revision-commands-max-age-days"] * 24 * 60 * 60
+        )
+
     if not db.update_deployment_status(
         Log(before, "Deploy completed", revision2=after, status=result)
     ):
@@ -89,39 +167,316 @@ def handle_deployment(form: dict, deploy_config: dict, access_token: str) -> boo
     return result == "success"
 
 
-def load_and_execute_config_changes(
-    command_groups: List[List[str]], metadata: DeployMetadata, access_token: str
-) -> bool:
+def get_deployed_revision(previous_commit: str, deploy_config: dict) -> str:
     """
-    Load the configuration onto the router and execute it
+    The revision running on the router, which is not the previous commit if the
+    deployment of it has since been reverted
+    Deployments can only be reverted when their revert commands are stored
     """
+    if not deploy_config.get("store-revert-commands", False):
+        return previous_commit
+
+    last_deployment = db.get_last_successful_deployment()
+    if (
+        last_deployment is not None
+        and last_deployment.from_revision == previous_commit
+        and db.get_deployment(last_deployment.to_revision, previous_commit).status
+        == "reverted"
+    ):
+        return last_deployment.to_revision
+
+    return previous_commit
+
+
+def plan_deployment(
+    metadata: DeployMetadata,
+    access_token: str,
+    changed_files: Optional[List[str]],
+    store_revert_commands: bool,
+    current_config: Optional[root_parser.RootNode] = None,
+    previous_config: Optional[root_parser.RootNode] = None,
+) -> Optional[List[List[str]]]:
+    """
+    Plans the commands to run for a deployment, failing it if the router
+    configuration cannot be read
+    Configurations already loaded are planned with instead of loading them again
+    """
+    deploy_config = metadata.deployment_configuration
+    before = metadata.before_sha
+    after = metadata.after_sha
     try:
+        live_commands = (
+            read_live_commands(deploy_config)
+            if deploy_config.get("plan-against-live-config", False)
+            else None
+        )
+    except (ValueError, paramiko.SSHException, OSError) as error:
+        fail_deployment(
+            before,
+            after,
+            metadata.status_url,
+            metadata.external_app_url,
+            access_token,
+            "Failed to read router configuration - got:\n" + str(error),
+        )
+        return None
+
+    store_commands = deploy_config.get("store-revision-commands", False)
+    return deploy_helper.get_commands_to_run(
+        deploy_config["git"]["diff-config-folder"],
+        deploy_config["git"]["config-folder"],
+        deploy_config["apply-difference-only"],
+        changed_files,
+        db.get_command_snapshot(metadata.base_sha) if store_commands else None,
+        after if store_commands else None,
+        live_commands,
+        (before, after)
+        if store_revert_commands and deploy_config.get("store-revert-commands", False)
+        else None,
+        current_config,
+        previous_config,
+        (before, after),
+    )
+
+
+def deploy_to_router(
+    metadata: DeployMetadata,
+    access_token: str,
+    changed_files: Optional[List[str]],
+    command_groups: Optional[List[List[str]]],
+) -> bool:
+    """
+    Deploys to the router in the metadata's configuration, planning the commands
+    for it if they are not shared
+    """
+    if command_groups is None:
+        # Revert commands are stored per deployment, not per router, so none are
+        # stored when each router is planned against its own configuration
+        command_groups = plan_deployment(metadata, access_token, changed_files, False)
+        if command_groups is None:
+            return False
+
+    return load_and_execute_config_changes(command_groups, metadata, access_token)
+
+
+def get_router_deploy_configs(deploy_config: dict) -> List[dict]:
+    """
+    The deployment configuration for each router to deploy to
+    Each of the routers listed overrides the settings in the router block, or
+    there is only the router block
+    """
+    if not deploy_config.get("routers", None):
+        return [deploy_config]
+
+    return [
+        {**deploy_config, "router": {**deploy_config.get("router", {}), **router}}
+        for router in deploy_config["routers"]
+    ]
+
+
+def get_router_name(router_config: dict) -> str:
+    """
+    The name of a router, for its status and logs
+    """
+    return router_config.get("name", router_config["address"])
+
+
+def run_on_routers(
+    metadata: DeployMetadata, run: Callable[[DeployMetadata], bool]
+) -> bool:
+    """
+    Runs something for each router, with metadata for that router's configuration,
+    returning whether it succeeded for every one
+    Several routers are run at once, up to the configured limit, with each one's
+    status recorded separately
+    Their failures are only logged, not sent to GitHub, since the deployment's
+    state is set once every router has finished
+    """
+    deploy_config = metadata.deployment_configuration
+    router_configs = get_router_deploy_configs(deploy_config)
+    if len(router_configs) == 1:
+        return run(metadata)
+
+    def run_router(router_config: dict) -> bool:
+        router_name = get_router_name(router_config["router"])
+        db.update_deployment_router_status(
+            metadata.before_sha, metadata.after_sha, router_name, "in_progress"
+        )
         db.add_deployment_log(
             Log(
                 metadata.before_sha,
-                "Connecting to router",
+                f"Deploying to router {router_name}",
                 revision2=metadata.after_sha,
             )
         )
-        router_connection = deploy_helper.get_router_connection(
-            metadata.deployment_configuration
-        )
-        config_deploy_file = send_config_files_to_router(
-            router_connection, metadata, command_groups
+        # Failures on one router should not stop the others
+        # pylint: disable=broad-except
+        try:
+            succeeded = run(
+                dataclasses.replace(
+                    metadata, status_url="", deployment_configuration=router_config
+                )
+            )
+        except Exception as error:
+            print(f"Failed to deploy to router {router_name}: {error}")
+            succeeded = False
+
+        result = "success" if succeeded else "failure"
+        db.update_deployment_router_status(
+            metadata.before_sha, metadata.after_sha, router_name, result
         )
         db.add_deployment_log(
             Log(
                 metadata.before_sha,
-                "Command files deployed to the router",
+                f"Deployment to router {router_name} completed with {result}",
                 revision2=metadata.after_sha,
             )
         )
-        output = router_connection.exec_command(
-            f"bash {config_deploy_file}", get_pty=True
+        return succeeded
+
+    with ThreadPoolExecutor(
+        max_workers=deploy_config.get("max-parallel-routers", None)
+        or len(router_configs)
+    ) as executor:
+        return all(list(executor.map(run_router, router_configs)))
+
+
+def complete_unchanged_deployment(metadata: DeployMetadata, access_token: str) -> bool:
+    """
+    Completes a deployment which does not change the configuration,
+    without connecting to the router
+    """
+    deploy_config = metadata.deployment_configuration
+    if deploy_config.get("store-revision-commands", False):
+        # The commands deployed are the same, so compare against them next time
+        snapshot = db.get_command_snapshot(metadata.base_sha)
+        if snapshot is not None:
+            snapshot.revision = metadata.after_sha
+            db.store_command_snapshot(snapshot)
+            db.mark_command_snapshot_deployed(metadata.after_sha)
+
+    if not db.update_deployment_status(
+        Log(
+            metadata.before_sha,
+            "Deploy skipped, configuration unchanged",
+            revision2=metadata.after_sha,
+            status="success",
+        )
+    ):
+        print("Failed to update local copy of deploy to success")
+
+    api.update_deployment_state(
+        metadata.status_url,
+        metadata.external_app_url,
+        metadata.before_sha,
+        metadata.after_sha,
+        access_token,
+        "success",
+    )
+
+    return True
+
+
+def revert_deployment(
+    before: str, after: str, commands: List[str], deploy_config: dict
+) -> bool:
+    """
+    Runs the stored commands undoing a deployment on the router, recorded as a
+    deployment from its revision back to the one before it
+    Nothing is cloned or planned, and GitHub is not told about it
+    Only the most recent successful deployment should be reverted, since the
+    commands assume the router is still in the state it left
+    """
+    db.create_deployment(Deployment(after, before, "in_progress", time.time()))
+    if not db.update_deployment_status(
+        Log(after, "Revert in progress", revision2=before, status="in_progress")
+    ):
+        print("Failed to update local copy of revert to in progress")
+
+    result = (
+        "success"
+        if run_on_routers(
+            DeployMetadata(
+                after, before, deploy_config["git"]["webhook-url"], "", deploy_config
+            ),
+            lambda metadata: load_and_execute_config_changes(
+                [commands] if commands else [], metadata, ""
+            ),
+        )
+        else "failure"
+    )
+
+    # Even a failed revert may have changed the router, so the next deployment
+    # must not compare against the reverted revision
+    db.mark_command_snapshot_deployed(after, deployed=False)
+    # Once reverted, the next deployment is planned from the revision before
+    if result == "success" and not db.update_deployment_status(
+        Log(before, "Deployment reverted", revision2=after, status="reverted")
+    ):
+        print("Failed to update local copy of deploy to reverted")
+
+    if not db.update_deployment_status(
+        Log(after, "Revert completed", revision2=before, status=result)
+    ):
+        print(f"Failed to update local copy of revert to {result}")
+
+    return result == "success"
+
+
+def read_live_commands(deploy_config: dict) -> List[str]:
+    """
+    Reads the commands of the configuration running on the router
+
+    Can throw the same errors as connecting to the router
+    """
+    with deploy_helper.router_session(deploy_config) as router_connection:
+        return deploy_helper.get_live_commands(router_connection, deploy_config)
+
+
+def load_and_execute_config_changes(
+    command_groups: List[List[str]], metadata: DeployMetadata, access_token: str
+) -> bool:
+    """
+    Load the configuration onto the router and execute it
+    """
+    try:
+        db.add_deployment_log(
+            Log(
+                metadata.before_sha,
+                "Connecting to router",
+                revision2=metadata.after_sha,
+            )
         )
-        stdout = output[1].read().decode()
-        stderr = output[2].read().decode()
-        log_command_output(metadata.before_sha, metadata.after_sha, stdout, stderr)
+        with deploy_helper.router_session(
+            metadata.deployment_configuration
+        ) as router_connection:
+            output_logger = CommandOutputLogger(
+                metadata.before_sha, metadata.after_sha
+            )
+            if is_pipelined(metadata.deployment_configuration):
+                exit_status = run_pipelined_phases(
+                    router_connection, metadata, command_groups, output_logger
+                )
+            else:
+                config_deploy_file = send_config_files_to_router(
+                    router_connection, metadata, command_groups
+                )
+                db.add_deployment_log(
+                    Log(
+                        metadata.before_sha,
+                        "Command files deployed to the router",
+                        revision2=metadata.after_sha,
+                    )
+                )
+                shell = (
+                    "$(which vbash)"
+                    if is_single_session(metadata.deployment_configuration)
+                    else "bash"
+                )
+                output = router_connection.exec_command(
+                    f"{shell} {config_deploy_file}", get_pty=True
+                )
+                exit_status = stream_command_output(output[1].channel, output_logger)
 
     except ValueError as error:
         fail_deployment(
@@ -160,94 +515,157 @@ def load_and_execute_config_changes(
         )
         return False
 
-    return (
-        # No errors printed
-        not bool(stderr)
-        # No failure in setting value was output
-        and "Failed to execute command" not in stdout
-        # No consistency error in committing changes occurred
-        and "Commit failed" not in stdout
-    )
+    # The aggregate script always exits successfully, but a single session
+    # script exits as soon as anything fails
+    return output_logger.succeeded() and exit_status == 0
 
 
 def send_config_files_to_router(
-    router_connection: paramiko.Channel,
+    router_connection: paramiko.SSHClient,
     metadata: DeployMetadata,
     command_groups: List[List[str]],
 ) -> str:
     """
-    Creates the remote bash scripts to run on the router
-    Returns the name of the aggregate script to execute
+    Creates the remote bash scripts to run on the router, uploading them together
+    Returns the name of the aggregate script to execute, or the single script
+    applying every group of commands in one configuration session
     """
-    shell_file_base = (
-        f"{metadata.deployment_configuration['router']['command-file-path']}/"
-        f"{metadata.before_sha}..{metadata.after_sha}-[###].sh"
-    )
-
-    file_names = []
-    group_index = 0
-    for commands in command_groups:
-        # For now, while figuring out what to do
-        # pylint: disable=unused-variable
-        file_name = shell_file_base.replace("[###]", str(group_index).rjust(3, "0"))
-        file_names.append(file_name)
-
-        # pylint: disable=too-many-function-args
-        send_file_to_router(
+    shell_file_base = get_shell_file_base(metadata)
+    router_files = {}
+    aggregate_file_name = shell_file_base.replace("-[###]", "")
+    if is_single_session(metadata.deployment_configuration):
+        add_session_file(
             metadata.before_sha,
             metadata.after_sha,
-            router_connection,
-            commands,
+            router_files,
+            command_groups,
             metadata.deployment_configuration,
-            file_name,
+            aggregate_file_name,
         )
+    else:
+        file_names = []
+        for group_index, commands in enumerate(command_groups):
+            file_name = shell_file_base.replace(
+                "[###]", str(group_index).rjust(3, "0")
+            )
+            file_names.append(file_name)
 
-        group_index += 1
+            add_command_file(
+                metadata.before_sha,
+                metadata.after_sha,
+                router_files,
+                commands,
+                metadata.deployment_configuration,
+                file_name,
+            )
 
-    aggregate_file_name = shell_file_base.replace("-[###]", "")
-    send_aggregate_file_to_router(
-        metadata.before_sha,
-        metadata.after_sha,
-        router_connection,
-        file_names,
-        aggregate_file_name,
+        add_aggregate_file(
+            metadata.before_sha,
+            metadata.after_sha,
+            router_files,
+            file_names,
+            aggregate_file_name,
+        )
+
+    write_router_files(
+        router_connection, metadata.deployment_configuration, router_files
     )
 
     return aggregate_file_name
 
 
-# pylint: disable=too-many-arguments
-def send_file_to_router(
+def get_shell_file_base(metadata: DeployMetadata) -> str:
+    """
+    The path of the command files for a deployment, with [###] to replace
+    """
+    return (
+        f"{metadata.deployment_configuration['router']['command-file-path']}/"
+        f"{metadata.before_sha}..{metadata.after_sha}-[###].sh"
+    )
+
+
+def write_router_files(
+    router_connection: paramiko.SSHClient,
+    deploy_config: dict,
+    router_files: Dict[str, str],
+) -> None:
+    """
+    Writes files to the router in the configured way
+
+    Throws ValueError
+    """
+    write_files = (
+        file_transfer.write_files_to_router_as_tar
+        if deploy_config["router"].get("upload-mode", "sftp") == "tar"
+        else file_transfer.write_files_to_router
+    )
+    failed_files = write_files(router_connection, router_files)
+    if failed_files:
+        print(f"Failed to write {', '.join(failed_files)} to router")
+        raise ValueError("Failed to write files to router")
+
+
+def add_command_file(
     before: str,
     after: str,
-    router_connection: paramiko.SSHClient,
+    router_files: Dict[str, str],
     commands: List[str],
     deploy_config: dict,
     file_name: str,
 ):
     """
-    Sends a set of commands to the router
+    Adds a set of commands to the files to send to the router
     """
-    bash_contents = deploy_helper.generate_bash_commands(commands, deploy_config)
+    router_files[file_name] = deploy_helper.generate_bash_commands(
+        commands, deploy_config
+    )
     db.add_deployment_log(
         Log(before, f"Adding command set {file_name} to router", revision2=after)
     )
-    if not deploy_helper.write_data_to_router_file(
-        router_connection, file_name, bash_contents
-    ):
-        print(f"Failed to write {file_name} to router")
-        raise ValueError("Failed to write file to router")
 
 
-def send_aggregate_file_to_router(
+def is_single_session(deploy_config: dict) -> bool:
+    """
+    Whether every group of commands is applied in one configuration session,
+    rather than a script and session for each group
+    """
+    return deploy_config.get("execution-mode", "files") == "session"
+
+
+# pylint: disable=too-many-arguments
+def add_session_file(
     before: str,
     after: str,
-    router_connection: paramiko.SSHClient,
+    router_files: Dict[str, str],
+    command_groups: List[List[str]],
+    deploy_config: dict,
+    file_name: str,
+):
+    """
+    Adds the script applying every group of commands in one session to the files
+    to send to the router
+    """
+    router_files[file_name] = deploy_helper.generate_session_script(
+        command_groups, deploy_config
+    )
+    db.add_deployment_log(
+        Log(
+            before,
+            f"Adding single session command set {file_name} to router",
+            revision2=after,
+        )
+    )
+
+
+def add_aggregate_file(
+    before: str,
+    after: str,
+    router_files: Dict[str, str],
     file_names: List[str],
     aggregate_file_name: str,
 ):
     """
-    Sends the aggregate commands file to the router
+    Adds the aggregate commands file to the files to send to the router
     """
     mega_file = ""
 
@@ -267,11 +685,7 @@ def send_aggregate_file_to_router(
             revision2=after,
         )
     )
-    if not deploy_helper.write_data_to_router_file(
-        router_connection, aggregate_file_name, mega_file
-    ):
-        print("Failed to create aggregated command file on router")
-        raise ValueError("Failed to create aggregated command file on router")
+    router_files[aggregate_file_name] = mega_file
 
 
 # pylint: disable=too-many-arguments
@@ -285,16 +699,18 @@ def fail_deployment(
 ):
     """
     Fails the deployment
+    Reverts have no GitHub deployment to update
     """
-    api.update_deployment_state(
-        deployment_url,
-        external_app_url,
-        before,
-        after,
-        access_token,
-        "failure",
-        "Failed to run configuration deployment",
-    )
+    if deployment_url:
+        api.update_deployment_state(
+            deployment_url,
+            external_app_url,
+            before,
+            after,
+            access_token,
+            "failure",
+            "Failed to run configuration deployment",
+        )
 
     if not db.add_deployment_log(
         Log(before, failure_reason, revision2=after, status="failure",)
@@ -302,12 +718,202 @@ def fail_deployment(
         print("Failed to record deployment execution failure in DB")
 
 
-def log_command_output(before: str, after: str, stdout: str, stderr: str):
+class CommandOutputLogger:
     """
-    .
+    Logs the output of a command line by line as it arrives, writing the lines
+    to the deployment log in batches, and keeping only what is needed to tell
+    whether the command succeeded
     """
-    for log in stdout.split("\n") + stderr.split("\n"):
-        if not log:
-            continue
-        if not db.add_deployment_log(Log(before, log, revision2=after,)):
+
+    def __init__(
+        self,
+        before: str,
+        after: str,
+        batch_size: int = LOG_BATCH_SIZE,
+        batch_seconds: float = LOG_BATCH_SECONDS,
+    ):
+        self.before = before
+        self.after = after
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        # Incomplete last lines of standard output and error
+        self.partial_lines = {False: b"", True: b""}
+        self.pending: List[Log] = []
+        self.last_flush = time.monotonic()
+        self.has_errors = False
+        self.has_failures = False
+
+    def add(self, data: bytes, is_error: bool = False) -> None:
+        """
+        Adds output, logging any lines it completes
+        """
+        lines = (self.partial_lines[is_error] + data).split(b"\n")
+        self.partial_lines[is_error] = lines.pop()
+        for line in lines:
+            self.add_line(line.decode(errors="replace").rstrip("\r"), is_error)
+
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def add_line(self, line: str, is_error: bool) -> None:
+        """
+        Queues a line to be logged
+        """
+        if not line:
+            return
+
+        if is_error:
+            self.has_errors = True
+        # A value failed to be set, or the changes had a consistency error
+        elif "Failed to execute command" in line or "Commit failed" in line:
+            self.has_failures = True
+
+        self.pending.append(Log(self.before, line, revision2=self.after))
+
+    def flush_if_due(self) -> None:
+        """
+        Writes the pending lines if they have waited long enough
+        """
+        if self.pending and time.monotonic() - self.last_flush >= self.batch_seconds:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Writes the pending lines to the deployment log
+        """
+        self.last_flush = time.monotonic()
+        if not self.pending:
+            return
+
+        if not db.add_deployment_logs(self.pending):
             print("Failed to add deployment execution log in DB")
+        self.pending = []
+
+    def finish(self) -> None:
+        """
+        Logs the remaining output, once the command has finished
+        """
+        for is_error, line in self.partial_lines.items():
+            self.add_line(line.decode(errors="replace").rstrip("\r"), is_error)
+        self.partial_lines = {False: b"", True: b""}
+        self.flush()
+
+    def succeeded(self) -> bool:
+        """
+        Whether the output shows the command succeeded
+        """
+        return not self.has_errors and not self.has_failures
+
+
+def stream_command_output(
+    channel: paramiko.Channel, output_logger: CommandOutputLogger
+) -> int:
+    """
+    Reads the output of a command as it arrives until it exits,
+    returning its exit status
+    """
+    while True:
+        # Output is all sent before the exit status, so once it has arrived,
+        # there is nothing more to read after what is already buffered
+        exited = channel.exit_status_ready()
+        received = False
+        if channel.recv_ready():
+            output_logger.add(channel.recv(OUTPUT_CHUNK_BYTES))
+            received = True
+        if channel.recv_stderr_ready():
+            output_logger.add(channel.recv_stderr(OUTPUT_CHUNK_BYTES), True)
+            received = True
+
+        if received:
+            continue
+        if exited:
+            break
+
+        output_logger.flush_if_due()
+        time.sleep(OUTPUT_POLL_SECONDS)
+
+    output_logger.finish()
+    return channel.recv_exit_status()
+
+
+def is_pipelined(deploy_config: dict) -> bool:
+    """
+    Whether each phase is run as soon as it is uploaded, uploading the next one
+    while it runs
+    """
+    return deploy_config.get("execution-mode", "files") == "pipelined"
+
+
+def run_pipelined_phases(
+    router_connection: paramiko.SSHClient,
+    metadata: DeployMetadata,
+    command_groups: List[List[str]],
+    output_logger: CommandOutputLogger,
+) -> int:
+    """
+    Runs each phase as its own script, generating and uploading the next phase
+    while the previous one commits
+    Stops at the first phase to fail, returning its exit status
+
+    Throws ValueError
+    """
+    phases = [commands for commands in command_groups if commands]
+    shell_file_base = get_shell_file_base(metadata)
+    file_names = [
+        shell_file_base.replace("[###]", str(index).rjust(3, "0"))
+        for index in range(len(phases))
+    ]
+
+    def upload_phase(index: int) -> None:
+        router_files = {}
+        add_command_file(
+            metadata.before_sha,
+            metadata.after_sha,
+            router_files,
+            phases[index],
+            metadata.deployment_configuration,
+            file_names[index],
+        )
+        write_router_files(
+            router_connection, metadata.deployment_configuration, router_files
+        )
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        upload = executor.submit(upload_phase, 0) if phases else None
+        for index, file_name in enumerate(file_names):
+            upload.result()
+            upload = (
+                executor.submit(upload_phase, index + 1)
+                if index + 1 < len(phases)
+                else None
+            )
+
+            db.add_deployment_log(
+                Log(
+                    metadata.before_sha,
+                    f"Running phase {index} of {len(phases)}",
+                    revision2=metadata.after_sha,
+                )
+            )
+            # Replacing the shell with vbash gives it the PID passed to the
+            # script, so a failure stops the script itself
+            output = router_connection.exec_command(
+                f"exec $(which vbash) {file_name} $$", get_pty=True
+            )
+            exit_status = stream_command_output(output[1].channel, output_logger)
+            if exit_status != 0 or not output_logger.succeeded():
+                if upload is not None:
+                    upload.cancel()
+                db.add_deployment_log(
+                    Log(
+                        metadata.before_sha,
+                        f"Cancelled {len(phases) - index - 1} remaining phases",
+                        revision2=metadata.after_sha,
+                    )
+                )
+                return exit_status or 1
+
+    return 0
+
+
+# pylint: disable=too-many-arguments
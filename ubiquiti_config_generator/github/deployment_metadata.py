@@ -2,6 +2,7 @@
 Helper config for deployment
 """
 from dataclasses import dataclass
+from typing import Optional
 
 
 @dataclass
@@ -16,3 +17,13 @@ class DeployMetadata:
     external_app_url: str
     status_url: str
     deployment_configuration: dict
+    # The revision running on the router, if it is not the one before,
+    # e.g. since that was reverted
+    deployed_sha: Optional[str] = None
+
+    @property
+    def base_sha(self) -> str:
+        """
+        The revision to plan the deployment from
+        """
+        return self.deployed_sha or self.before_sha
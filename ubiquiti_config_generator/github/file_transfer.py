@@ -0,0 +1,132 @@
+"""
+Writes files to the router, checking they arrived intact
+"""
+import hashlib
+import io
+import shlex
+import tarfile
+import time
+from typing import Dict, List
+
+import paramiko
+
+
+def get_remote_checksums(
+    client: paramiko.SSHClient, remote_paths: List[str]
+) -> Dict[str, str]:
+    """
+    Gets the SHA-256 checksums of files on the router, with a single command
+    Files which could not be read are left out
+    """
+    # pylint: disable=unused-variable
+    stdin, stdout, stderr = client.exec_command(
+        "sha256sum -- "
+        + " ".join([shlex.quote(remote_path) for remote_path in remote_paths])
+    )
+
+    return parse_checksums(stdout.read().decode())
+
+
+def parse_checksums(output: str) -> Dict[str, str]:
+    """
+    Parses the output of sha256sum into the checksum of each file
+    """
+    checksums = {}
+    for line in output.splitlines():
+        checksum, _, file_path = line.partition("  ")
+        checksums[file_path] = checksum
+
+    return checksums
+
+
+def get_checksum_listing(files: Dict[str, str]) -> str:
+    """
+    The output sha256sum would give for files with the given contents
+    """
+    return "".join(
+        [
+            f"{hashlib.sha256(file_data.encode()).hexdigest()}  {file_path}\n"
+            for file_path, file_data in files.items()
+        ]
+    )
+
+
+def pack_files(files: Dict[str, str]) -> bytes:
+    """
+    Packs files into a compressed tar archive, relative to the root directory
+    """
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w:gz") as tar:
+        for file_path, file_data in files.items():
+            data = file_data.encode()
+            info = tarfile.TarInfo(file_path.lstrip("/"))
+            info.size = len(data)
+            info.mode = 0o644
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(data))
+
+    return archive.getvalue()
+
+
+def write_files_to_router_as_tar(
+    client: paramiko.SSHClient, files: Dict[str, str]
+) -> List[str]:
+    """
+    Writes files to the router as a single compressed tar stream, extracting them
+    and hashing their checksums into one manifest hash in the same command
+    Returns the paths of the files if the manifest does not match, since the
+    file at fault is unknown
+    """
+    # pylint: disable=unused-variable
+    stdin, stdout, stderr = client.exec_command(
+        "tar -xzf - -C / && sha256sum -- "
+        + " ".join([shlex.quote(file_path) for file_path in files])
+        + " | sha256sum"
+    )
+    stdin.write(pack_files(files))
+    stdin.channel.shutdown_write()
+
+    manifest_hash = stdout.read().decode().partition("  ")[0]
+    expected_hash = hashlib.sha256(get_checksum_listing(files).encode()).hexdigest()
+
+    return [] if manifest_hash == expected_hash else list(files.keys())
+
+
+def write_files_to_router(
+    client: paramiko.SSHClient, files: Dict[str, str]
+) -> List[str]:
+    """
+    Writes files to the router over a single SFTP session, without waiting for
+    each write to be acknowledged, then checksums all of them at once rather than
+    reading them back
+    Returns the paths of any files not written correctly
+
+    Throws ValueError
+    """
+    ftp = client.open_sftp()  # type: paramiko.sftp_client.SFTPClient
+    try:
+        remote_files = []
+        for file_path, file_data in files.items():
+            remote_file: paramiko.sftp_file.SFTPFile = ftp.file(file_path, "w", -1)
+            if not remote_file:
+                raise ValueError("Failed to open remote file")
+            if not remote_file.writable():
+                raise ValueError("Remote file not writable")
+
+            remote_file.set_pipelined(True)
+            remote_file.write(file_data)
+            remote_files.append(remote_file)
+
+        # Closing waits for the outstanding writes to be acknowledged
+        for remote_file in remote_files:
+            remote_file.close()
+    finally:
+        ftp.close()
+
+    checksums = get_remote_checksums(client, list(files.keys()))
+    return [
+        file_path
+        for file_path, file_data in files.items()
+        if checksums.get(file_path, None)
+        != hashlib.sha256(file_data.encode()).hexdigest()
+    ]
@@ -0,0 +1,95 @@
+"""
+Packs ordered command phases into as few commits as possible
+
+Each phase is committed separately on the router, which takes seconds, but most
+phases only exist to keep the generated commands in order. The only real ordering
+requirements are that groups exist before rules use them, and that firewalls
+exist before interfaces are bound to them.
+"""
+from typing import Dict, List, Set, Tuple
+
+GROUP_TYPES = ["address-group", "port-group", "network-group"]
+
+
+def get_command_resources(command: str) -> Tuple[Set[str], Set[str]]:
+    """
+    Gets the resources a command creates, and the ones it needs to already exist
+    """
+    provides = set()
+    requires = set()
+
+    # Resource names never need quoting, so a plain split is enough to find them,
+    # even if a later value (e.g. a description) is quoted
+    tokens = command.split()
+    if tokens and tokens[0] in ["set", "delete"]:
+        tokens = tokens[1:]
+
+    if tokens[:2] == ["firewall", "group"] and len(tokens) > 3:
+        provides.add(f"{tokens[2]} {tokens[3]}")
+    elif tokens[:2] == ["firewall", "name"] and len(tokens) > 2:
+        provides.add(f"firewall {tokens[2]}")
+    elif tokens[:1] == ["interfaces"] and "firewall" in tokens:
+        firewall_index = tokens.index("firewall")
+        if tokens[firewall_index + 2 : firewall_index + 3] == ["name"]:
+            requires.add(f"firewall {tokens[firewall_index + 3]}")
+
+    for index, token in enumerate(tokens[:-1]):
+        if token == "group" and tokens[index + 1] in GROUP_TYPES:
+            if len(tokens) > index + 2:
+                requires.add(f"{tokens[index + 1]} {tokens[index + 2]}")
+
+    # Never depend on something the command itself creates
+    return (provides, requires - provides)
+
+
+def is_delete_phase(commands: List[str]) -> bool:
+    """
+    Does a phase delete configuration
+    Deletions are always kept in their own, first, commit
+    """
+    return any([command.startswith("delete ") for command in commands])
+
+
+def pack_phases(command_phases: List[List[str]]) -> List[List[str]]:
+    """
+    Merges phases without dependencies between them into the same commit
+
+    Each phase is placed in the earliest commit after every earlier phase
+    providing something it requires. Phases in the same commit keep their
+    original relative order, as do the commands within them.
+    """
+    packed: List[List[str]] = []
+    phases = [phase for phase in command_phases if phase]
+    if phases and is_delete_phase(phases[0]):
+        packed.append(list(phases[0]))
+        phases = phases[1:]
+
+    levels: List[List[str]] = []
+    provider_levels: Dict[str, int] = {}
+    for phase in phases:
+        provides = set()
+        requires = set()
+        for command in phase:
+            command_provides, command_requires = get_command_resources(command)
+            provides.update(command_provides)
+            requires.update(command_requires)
+
+        requires -= provides
+        level = max(
+            [
+                provider_levels[resource] + 1
+                for resource in requires
+                if resource in provider_levels
+            ]
+            or [0]
+        )
+
+        while len(levels) <= level:
+            levels.append([])
+        levels[level].extend(phase)
+
+        for resource in provides:
+            provider_levels[resource] = max(provider_levels.get(resource, 0), level)
+
+    packed.extend([level for level in levels if level])
+    return packed
@@ -0,0 +1,124 @@
+"""
+Keeps an authenticated connection to the router open between deployments,
+so each one does not need a full key exchange and authentication
+"""
+from contextlib import contextmanager
+import threading
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+import paramiko
+
+# Connections shared by everything in the webhook process, by router
+# address, port, user and credentials
+ROUTER_POOLS: Dict[
+    Tuple[str, int, str, Optional[str], Optional[str]], "RouterConnectionPool"
+] = {}
+POOLS_LOCK = threading.Lock()
+
+
+class RouterConnectionPool:
+    """
+    Hands out a shared connection to the router, reconnecting if it has dropped
+    Each command or SFTP session opens its own channel on the connection, so
+    callers can share it at the same time
+    """
+
+    def __init__(
+        self, connect: Callable[[], paramiko.SSHClient], keepalive_seconds: int = 0
+    ):
+        self.connect = connect
+        self.keepalive_seconds = keepalive_seconds
+        self.client: Optional[paramiko.SSHClient] = None
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    def is_connected(self) -> bool:
+        """
+        Whether the connection is still open and authenticated
+        """
+        transport = self.client.get_transport() if self.client else None
+        return (
+            transport is not None
+            and transport.is_active()
+            and transport.is_authenticated()
+        )
+
+    def get_client(self) -> paramiko.SSHClient:
+        """
+        The connected client, connecting again if needed
+
+        Can throw the same errors as connecting to the router
+        """
+        with self.lock:
+            if not self.is_connected():
+                self.discard()
+                client = self.connect()
+                if self.keepalive_seconds:
+                    client.get_transport().set_keepalive(self.keepalive_seconds)
+
+                self.client = client
+                self.connections += 1
+
+            return self.client
+
+    def discard(self) -> None:
+        """
+        Closes the connection, so the next caller connects again
+        """
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+    @contextmanager
+    def connection(self) -> Iterator[paramiko.SSHClient]:
+        """
+        Uses the connection, dropping it if it fails while in use
+        Whatever was being done is not retried, since running commands again
+        may not be safe
+        """
+        client = self.get_client()
+        try:
+            yield client
+        except (paramiko.SSHException, EOFError, OSError):
+            with self.lock:
+                if self.client is client and not self.is_connected():
+                    self.discard()
+            raise
+
+
+def get_router_pool(
+    deploy_config: dict, connect: Callable[[dict], paramiko.SSHClient]
+) -> RouterConnectionPool:
+    """
+    The shared connection pool for the configured router
+    The credentials are part of the key, so a pool only ever connects with the
+    configuration that created it
+    """
+    router_config = deploy_config["router"]
+    key = (
+        router_config["address"],
+        router_config.get("port", 22),
+        router_config["user"],
+        router_config.get("keyfile"),
+        router_config.get("password"),
+    )
+    with POOLS_LOCK:
+        if key not in ROUTER_POOLS:
+            ROUTER_POOLS[key] = RouterConnectionPool(
+                lambda: connect(deploy_config),
+                router_config.get("keepalive-seconds", 0),
+            )
+
+        return ROUTER_POOLS[key]
+
+
+def close_router_pools() -> None:
+    """
+    Closes every shared connection
+    """
+    with POOLS_LOCK:
+        for pool in ROUTER_POOLS.values():
+            with pool.lock:
+                pool.discard()
+
+        ROUTER_POOLS.clear()
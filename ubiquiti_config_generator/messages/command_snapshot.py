@@ -0,0 +1,88 @@
+"""
+The commands generated for a revision, stored so they need not be regenerated
+"""
+import json
+import time
+from typing import Dict, List, Optional, Tuple, Union
+import zlib
+
+
+# pylint: disable=too-few-public-methods
+class CommandSnapshot:
+    """
+    Represents the generated commands of a deployed revision
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        revision: str,
+        commands: List[str],
+        index: Dict[str, Union[str, List[str]]],
+        firewalls: List[str],
+        dhcp_networks: List[str],
+        created_at: Optional[float] = None,
+        rules: Optional[Dict[str, List[Tuple[int, str]]]] = None,
+    ):
+        self.revision = revision
+        # The flat list of commands, and the same commands indexed by key
+        self.commands = commands
+        self.index = index
+        # Names needed to clear existing configuration when applying everything
+        self.firewalls = firewalls
+        self.dhcp_networks = dhcp_networks
+        self.created_at = created_at or time.time()
+        # The number and content of each firewall rule, to match rules against
+        self.rules = rules or {}
+
+    def to_blob(self) -> bytes:
+        """
+        Compress the snapshot for storage
+        """
+        return zlib.compress(
+            json.dumps(
+                {
+                    "commands": self.commands,
+                    "index": self.index,
+                    "firewalls": self.firewalls,
+                    "dhcp-networks": self.dhcp_networks,
+                    "rules": self.rules,
+                }
+            ).encode()
+        )
+
+    @classmethod
+    def from_blob(
+        cls, revision: str, blob: bytes, created_at: float
+    ) -> "CommandSnapshot":
+        """
+        Load a snapshot from its stored form
+        """
+        data = json.loads(zlib.decompress(blob).decode())
+        return cls(
+            revision,
+            data["commands"],
+            data["index"],
+            data["firewalls"],
+            data["dhcp-networks"],
+            created_at,
+            {
+                firewall: [tuple(rule) for rule in rules]
+                for firewall, rules in data.get("rules", {}).items()
+            },
+        )
+
+    def __eq__(self, other) -> bool:
+        """
+        Is this equal to something else
+        """
+        return (
+            isinstance(self, type(other))
+            and self.revision == other.revision
+            and self.commands == other.commands
+            and self.index == other.index
+            and self.firewalls == other.firewalls
+            and self.dhcp_networks == other.dhcp_networks
+            and self.created_at == other.created_at
+            and self.rules == other.rules
+        )
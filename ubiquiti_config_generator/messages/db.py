@@ -2,16 +2,55 @@
 Log database interaction functionality
 """
 from os import path
+import json
 import sqlite3
-from typing import Optional, List
+import time
+from typing import Dict, Optional, List
+import zlib
 
 from ubiquiti_config_generator.messages.check import Check
+from ubiquiti_config_generator.messages.command_snapshot import CommandSnapshot
 from ubiquiti_config_generator.messages.deployment import Deployment
 from ubiquiti_config_generator.messages.log import Log
 
 DB_PATH = "messages"
 DB_FILE = DB_PATH + "/messages.db"
 
+# Added after the other tables, so databases created before it need it added
+COMMAND_SNAPSHOT_TABLE = """
+    CREATE TABLE IF NOT EXISTS revision_commands (
+        revision      VARCHAR(40) PRIMARY KEY,
+        deployed      INTEGER NOT NULL DEFAULT 0,
+        created_at    FLOAT NOT NULL,
+        command_count INTEGER NOT NULL,
+        data          BLOB NOT NULL
+    )
+"""
+
+REVERT_COMMANDS_TABLE = """
+    CREATE TABLE IF NOT EXISTS deployment_revert (
+        from_revision VARCHAR(40),
+        to_revision   VARCHAR(40),
+        created_at    FLOAT NOT NULL,
+        data          BLOB NOT NULL,
+        PRIMARY KEY (from_revision, to_revision)
+    )
+"""
+
+DEPLOYMENT_ROUTER_TABLE = """
+    CREATE TABLE IF NOT EXISTS deployment_router (
+        from_revision VARCHAR(40),
+        to_revision   VARCHAR(40),
+        router        VARCHAR(255),
+        status        VARCHAR(20) NOT NULL,
+        started_at    FLOAT NOT NULL,
+        ended_at      FLOAT NULL,
+        PRIMARY KEY (from_revision, to_revision, router),
+        FOREIGN KEY (from_revision, to_revision)
+          REFERENCES deployment (from_revision, to_revision)
+    )
+"""
+
 
 def initialize_db(db_file: str = DB_FILE) -> sqlite3.Cursor:
     """
@@ -65,6 +104,9 @@ def initialize_db(db_file: str = DB_FILE) -> sqlite3.Cursor:
               REFERENCES deployment (to_revision)
         )
         """,
+        COMMAND_SNAPSHOT_TABLE,
+        REVERT_COMMANDS_TABLE,
+        DEPLOYMENT_ROUTER_TABLE,
     ]
     for statement in table_creation_statements:
         cursor.execute(statement)
@@ -144,6 +186,29 @@ def get_deployment(
     )
 
 
+def get_last_successful_deployment(
+    cursor: Optional[sqlite3.Cursor] = None,
+) -> Optional[Deployment]:
+    """
+    Get the deployment which most recently completed successfully, without its logs
+    """
+    cursor = cursor or get_cursor()
+    result = cursor.execute(
+        """
+        SELECT *
+        FROM deployment
+        WHERE status = 'success'
+        ORDER BY ended_at DESC
+        LIMIT 1
+        """
+    )
+    deployment = result.fetchone()
+    if not deployment:
+        return None
+
+    return Deployment(**deployment)
+
+
 def get_deployment_logs(
     from_revision: str, to_revision: str, cursor: Optional[sqlite3.Cursor] = None
 ) -> List[Log]:
@@ -291,7 +356,11 @@ def update_deployment_status(log: Log, cursor: Optional[sqlite3.Cursor] = None)
     Updates the status of a deployment, adding a log with a reason
     """
     cursor = cursor or get_cursor()
-    ended_at = log.utc_unix_timestamp if log.status in ["success", "failure"] else None
+    ended_at = (
+        log.utc_unix_timestamp
+        if log.status in ["success", "failure", "reverted"]
+        else None
+    )
     result = cursor.execute(
         """
         UPDATE deployment
@@ -333,3 +402,267 @@ def add_deployment_log(log: Log, cursor: Optional[sqlite3.Cursor] = None) -> boo
     )
 
     return bool(result.lastrowid)
+
+
+def add_deployment_logs(
+    logs: List[Log], cursor: Optional[sqlite3.Cursor] = None
+) -> bool:
+    """
+    Adds several logs for deployment messages in one transaction
+    """
+    if not logs:
+        return True
+
+    cursor = cursor or get_cursor()
+    # Without a transaction, each row would be committed to disk separately
+    autocommit = cursor.connection.isolation_level is None
+    if autocommit:
+        cursor.execute("BEGIN")
+
+    cursor.executemany(
+        """
+        INSERT INTO deployment_log (
+            from_revision,
+            to_revision,
+            status,
+            timestamp,
+            message
+        ) VALUES (
+            ?, ?, ?, ?, ?
+        )
+        """,
+        [
+            (
+                log.revision1,
+                log.revision2,
+                log.status,
+                log.utc_unix_timestamp,
+                log.message,
+            )
+            for log in logs
+        ],
+    )
+    inserted = cursor.rowcount
+    if autocommit:
+        cursor.execute("COMMIT")
+
+    return inserted == len(logs)
+
+
+def store_command_snapshot(
+    snapshot: CommandSnapshot, cursor: Optional[sqlite3.Cursor] = None
+) -> bool:
+    """
+    Stores the commands generated for a revision, replacing any existing ones
+    They are not used until the revision is marked as deployed
+    """
+    cursor = cursor or get_cursor()
+    cursor.execute(COMMAND_SNAPSHOT_TABLE)
+    result = cursor.execute(
+        """
+        INSERT OR REPLACE INTO revision_commands (
+            revision,
+            deployed,
+            created_at,
+            command_count,
+            data
+        ) VALUES (
+            ?, 0, ?, ?, ?
+        )
+        """,
+        (
+            snapshot.revision,
+            snapshot.created_at,
+            len(snapshot.commands),
+            snapshot.to_blob(),
+        ),
+    )
+
+    return bool(result.lastrowid)
+
+
+def mark_command_snapshot_deployed(
+    revision: str, cursor: Optional[sqlite3.Cursor] = None, deployed: bool = True
+) -> bool:
+    """
+    Marks the stored commands for a revision as successfully deployed, or as no
+    longer deployed, e.g. once reverted
+    """
+    cursor = cursor or get_cursor()
+    cursor.execute(COMMAND_SNAPSHOT_TABLE)
+    result = cursor.execute(
+        """
+        UPDATE revision_commands
+        SET    deployed = ?
+        WHERE  revision = ?
+        """,
+        (int(deployed), revision),
+    )
+
+    return bool(result.rowcount)
+
+
+def get_command_snapshot(
+    revision: str, cursor: Optional[sqlite3.Cursor] = None
+) -> Optional[CommandSnapshot]:
+    """
+    Get the stored commands of a deployed revision, if there are any
+    """
+    cursor = cursor or get_cursor()
+    cursor.execute(COMMAND_SNAPSHOT_TABLE)
+    result = cursor.execute(
+        """
+        SELECT revision, created_at, data
+        FROM   revision_commands
+        WHERE  revision = ?
+        AND    deployed = 1
+        """,
+        (revision,),
+    )
+    snapshot = result.fetchone()
+    if not snapshot:
+        return None
+
+    return CommandSnapshot.from_blob(
+        snapshot["revision"], snapshot["data"], snapshot["created_at"]
+    )
+
+
+def prune_command_snapshots(
+    max_age_seconds: float, cursor: Optional[sqlite3.Cursor] = None
+) -> int:
+    """
+    Removes stored commands older than a given age, returning how many were removed
+    """
+    cursor = cursor or get_cursor()
+    cursor.execute(COMMAND_SNAPSHOT_TABLE)
+    result = cursor.execute(
+        """
+        DELETE FROM revision_commands
+        WHERE  created_at < ?
+        """,
+        (time.time() - max_age_seconds,),
+    )
+
+    return result.rowcount
+
+
+def store_revert_commands(
+    from_revision: str,
+    to_revision: str,
+    commands: List[str],
+    cursor: Optional[sqlite3.Cursor] = None,
+) -> bool:
+    """
+    Stores the commands undoing a deployment, replacing any existing ones
+    """
+    cursor = cursor or get_cursor()
+    cursor.execute(REVERT_COMMANDS_TABLE)
+    result = cursor.execute(
+        """
+        INSERT OR REPLACE INTO deployment_revert (
+            from_revision,
+            to_revision,
+            created_at,
+            data
+        ) VALUES (
+            ?, ?, ?, ?
+        )
+        """,
+        (
+            from_revision,
+            to_revision,
+            time.time(),
+            zlib.compress(json.dumps(commands).encode()),
+        ),
+    )
+
+    return bool(result.lastrowid)
+
+
+def get_revert_commands(
+    from_revision: str, to_revision: str, cursor: Optional[sqlite3.Cursor] = None
+) -> Optional[List[str]]:
+    """
+    Get the stored commands undoing a deployment, if there are any
+    """
+    cursor = cursor or get_cursor()
+    cursor.execute(REVERT_COMMANDS_TABLE)
+    result = cursor.execute(
+        """
+        SELECT data
+        FROM   deployment_revert
+        WHERE  from_revision = ?
+        AND    to_revision = ?
+        """,
+        (from_revision, to_revision),
+    )
+    revert = result.fetchone()
+    if not revert:
+        return None
+
+    return json.loads(zlib.decompress(revert["data"]).decode())
+
+
+def update_deployment_router_status(
+    from_revision: str,
+    to_revision: str,
+    router: str,
+    status: str,
+    cursor: Optional[sqlite3.Cursor] = None,
+) -> bool:
+    """
+    Sets the status of a deployment on one of several routers
+    """
+    cursor = cursor or get_cursor()
+    cursor.execute(DEPLOYMENT_ROUTER_TABLE)
+    now = time.time()
+    result = cursor.execute(
+        """
+        INSERT INTO deployment_router (
+            from_revision,
+            to_revision,
+            router,
+            status,
+            started_at,
+            ended_at
+        ) VALUES (
+            ?, ?, ?, ?, ?, ?
+        )
+        ON CONFLICT (from_revision, to_revision, router) DO UPDATE
+        SET    status = excluded.status,
+               ended_at = excluded.ended_at
+        """,
+        (
+            from_revision,
+            to_revision,
+            router,
+            status,
+            now,
+            now if status in ["success", "failure"] else None,
+        ),
+    )
+
+    return bool(result.rowcount)
+
+
+def get_deployment_router_statuses(
+    from_revision: str, to_revision: str, cursor: Optional[sqlite3.Cursor] = None
+) -> Dict[str, str]:
+    """
+    Get the status of a deployment on each router, if it deployed to several
+    """
+    cursor = cursor or get_cursor()
+    cursor.execute(DEPLOYMENT_ROUTER_TABLE)
+    result = cursor.execute(
+        """
+        SELECT router, status
+        FROM   deployment_router
+        WHERE  from_revision = ?
+        AND    to_revision = ?
+        ORDER BY router
+        """,
+        (from_revision, to_revision),
+    )
+
+    return {row["router"]: row["status"] for row in result.fetchall()}
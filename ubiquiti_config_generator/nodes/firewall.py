@@ -5,7 +5,7 @@ from os import path
 import shlex
 from typing import Tuple, List
 
-from ubiquiti_config_generator import type_checker, file_paths
+from ubiquiti_config_generator import type_checker, file_paths, rule_optimizer
 from ubiquiti_config_generator.nodes.rule import Rule
 from ubiquiti_config_generator.nodes.validatable import Validatable
 
@@ -16,6 +16,7 @@ FIREWALL_TYPES = {
     "default-action": type_checker.is_action,
     "auto-increment": type_checker.is_number,
     "description": type_checker.is_description,
+    "optimize-rules": type_checker.is_string_boolean,
     "rules": lambda rules: all([rule.validate() for rule in rules]),
 }
 
@@ -70,10 +71,26 @@ class Firewall(Validatable):
         """
         return "Firewall " + self.name
 
+    def cache_key(self) -> tuple:
+        """
+        Firewall commands also change when any of its rules do
+        """
+        return (
+            *super().cache_key(),
+            tuple(rule.cache_key() for rule in self.rules),
+        )
+
     def commands(self) -> Tuple[List[List[str]], List[str]]:
         """
         Commands to create this firewall
         """
+        ordered_commands, command_list = self._cached_commands(self._generate_commands)
+        return ([list(commands) for commands in ordered_commands], list(command_list))
+
+    def _generate_commands(self) -> Tuple[List[List[str]], List[str]]:
+        """
+        Generate the commands for this firewall
+        """
         firewall_base = "firewall name {0} ".format(self.name)
         ordered_commands = [[]]
         command_list = []
@@ -99,19 +116,49 @@ class Firewall(Validatable):
 
             append_command(firewall_base + "description " + description)
 
-        for rule in self.rules:
+        rules = self.rules
+        if self.optimizes_rules():
+            optimization = self.optimize_rules()
+            rules = optimization.rules
+            # Groups must exist before the rules referencing them
+            for command in optimization.group_commands:
+                append_command(command)
+
+        for rule in rules:
             ordered_commands.append([])
             for command in rule.commands():
                 append_command(command)
 
         return (ordered_commands, command_list)
 
+    def optimizes_rules(self) -> bool:
+        """
+        Whether the rules are optimized when generating commands
+        """
+        return (
+            getattr(self, "optimize-rules", type_checker.DISABLE) == type_checker.ENABLE
+        )
+
+    def optimize_rules(self) -> rule_optimizer.RuleOptimization:
+        """
+        Combine rules that differ only by a single address or port
+        Reused until the firewall changes, like its commands
+        """
+        cache_key = self.cache_key()
+        cached = getattr(self, "_optimization_cache", None)
+        if cached is None or cached[0] != cache_key:
+            cached = (cache_key, rule_optimizer.optimize_rules(self.name, self.rules))
+            super().__setattr__("_optimization_cache", cached)
+
+        return cached[1]
+
     def add_rule(self, rule_properties: dict):
         """
         Add a rule to the list
         """
         if "number" not in rule_properties:
             rule_properties["number"] = self.next_rule_number()
+            rule_properties["auto_numbered"] = True
 
         if "firewall_name" not in rule_properties:
             rule_properties["firewall_name"] = self.name
@@ -36,11 +36,17 @@ class NATRule(Validatable):
         self.config_path = config_path
         self._add_keyword_attributes(kwargs)
 
-    # pylint: disable=too-many-branches
     def commands(self) -> List[str]:
         """
         Get the command for this rule
         """
+        return list(self._cached_commands(self._generate_commands))
+
+    # pylint: disable=too-many-branches
+    def _generate_commands(self) -> List[str]:
+        """
+        Generate the commands for this rule
+        """
         commands = []
         command_base = "service nat rule {0} ".format(self.number)
 
@@ -196,11 +196,28 @@ class Network(Validatable):
         hosts_consistent = [host.is_consistent() for host in self.hosts]
         return consistent and all(hosts_consistent)
 
-    # pylint: disable=too-many-locals,too-many-branches,too-many-statements
+    def cache_key(self) -> tuple:
+        """
+        Network commands also change when its firewalls or hosts do
+        """
+        return (
+            *super().cache_key(),
+            tuple(firewall.cache_key() for firewall in self.firewalls),
+            tuple(host.cache_key() for host in self.hosts),
+        )
+
     def commands(self) -> Tuple[List[List[str]], List[str]]:
         """
         The commands to generate this network
         """
+        ordered_commands, all_commands = self._cached_commands(self._generate_commands)
+        return ([list(commands) for commands in ordered_commands], list(all_commands))
+
+    # pylint: disable=too-many-locals,too-many-branches,too-many-statements
+    def _generate_commands(self) -> Tuple[List[List[str]], List[str]]:
+        """
+        Generate the commands for this network
+        """
         all_commands = []
         ordered_commands = [[]]
 
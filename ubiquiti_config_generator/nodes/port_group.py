@@ -33,12 +33,14 @@ class PortGroup(Validatable):
         Adds a port
         """
         self.__ports.append(port)
+        self.mark_changed()
 
     def add_ports(self, ports: List[int]) -> None:
         """
         Adds multiple ports
         """
         self.__ports.extend(ports)
+        self.mark_changed()
 
     @property
     def name(self) -> str:
@@ -78,6 +80,12 @@ class PortGroup(Validatable):
         """
         Commands to generate the port group
         """
+        return list(self._cached_commands(self._generate_commands))
+
+    def _generate_commands(self) -> List[str]:
+        """
+        Generate the commands for the port group
+        """
         base_command = "firewall group port-group {0}".format(self.name)
         return [base_command + " port {0}".format(port) for port in self.ports] + (
             [base_command + " description {0}".format(shlex.quote(self.description))]
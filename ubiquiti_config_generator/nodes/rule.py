@@ -28,18 +28,38 @@ class Rule(Validatable):
     Represents a firewall rule
     """
 
-    def __init__(self, number: int, firewall_name: str, config_path: str, **kwargs):
+    def __init__(
+        self,
+        number: int,
+        firewall_name: str,
+        config_path: str,
+        auto_numbered: bool = False,
+        **kwargs
+    ):
         super().__init__(RULE_TYPES, ["number"])
         self.number = number
         self.firewall_name = firewall_name
         self.config_path = config_path
+        self._auto_numbered = auto_numbered
         self._add_keyword_attributes(kwargs)
 
-    # pylint: disable=too-many-branches
+    def is_auto_numbered(self) -> bool:
+        """
+        Was this rule numbered by its firewall, rather than explicitly
+        """
+        return self._auto_numbered
+
     def commands(self) -> List[str]:
         """
         Get the command for this rule
         """
+        return list(self._cached_commands(self._generate_commands))
+
+    # pylint: disable=too-many-branches
+    def _generate_commands(self) -> List[str]:
+        """
+        Generate the commands for this rule
+        """
         command_base = "firewall name {0} rule {1} ".format(
             self.firewall_name, self.number
         )
@@ -1,7 +1,20 @@
 """
 Contains generic validation functions
 """
-from typing import List
+import hashlib
+import itertools
+from typing import Any, Callable, List
+
+# Revisions are drawn from one shared counter, so a revision number is never
+# reused - even by a different node - and can safely be used as a cache key
+_REVISIONS = itertools.count(1)
+
+
+def hash_commands(commands: List[str]) -> str:
+    """
+    Hashes a list of commands, so identical command lists can be compared cheaply
+    """
+    return hashlib.sha256("\n".join(commands).encode()).hexdigest()
 
 
 class Validatable:
@@ -10,10 +23,66 @@ class Validatable:
     """
 
     def __init__(self, validator_map: dict, attributes: List[str] = None):
+        self._revision = next(_REVISIONS)
+        self._command_cache = None
+        self._hash_cache = None
         self._validate_attributes = attributes or []
         self._validator_map = validator_map
         self._validation_errors = []
 
+    def __setattr__(self, name: str, value: Any) -> None:
+        """
+        Sets an attribute, marking the node as changed for public attributes
+        """
+        super().__setattr__(name, value)
+        if not name.startswith("_"):
+            self.mark_changed()
+
+    def mark_changed(self) -> None:
+        """
+        Marks this node as changed, so any cached commands are regenerated
+        Needed when mutating an attribute in-place, rather than setting it
+        """
+        super().__setattr__("_revision", next(_REVISIONS))
+
+    def cache_key(self) -> tuple:
+        """
+        A key which changes whenever the commands of this node may change
+        Nodes with children should include the keys of those children
+        """
+        return (getattr(self, "_revision", None),)
+
+    def _cached_commands(self, generate_commands: Callable[[], Any]) -> Any:
+        """
+        Returns the result of generating commands, reusing the previous
+        result if nothing has changed since it was generated
+        """
+        cache_key = self.cache_key()
+        cached = getattr(self, "_command_cache", None)
+        if cached is None or cached[0] != cache_key:
+            cached = (cache_key, generate_commands())
+            super().__setattr__("_command_cache", cached)
+
+        return cached[1]
+
+    def content_hash(self) -> str:
+        """
+        A hash of every command this node generates, including its children's
+        Reused until the node changes, like the commands themselves
+        """
+        cache_key = self.cache_key()
+        cached = getattr(self, "_hash_cache", None)
+        if cached is None or cached[0] != cache_key:
+            commands = self.commands()
+            # Nodes with ordered commands also return a flat list of them
+            if isinstance(commands, tuple):
+                commands = commands[1]
+
+            cached = (cache_key, hash_commands(commands))
+            super().__setattr__("_hash_cache", cached)
+
+        return cached[1]
+
     def validate(self) -> bool:
         """
         Validate this object
@@ -3,9 +3,12 @@ Contains the root configuration node
 """
 import ipaddress
 from os import path
-from typing import List, Tuple
+from typing import List, Optional, Set, Tuple
 
 from ubiquiti_config_generator import file_paths, secondary_configs
+from ubiquiti_config_generator.address_groups import AddressGroupRegistry
+from ubiquiti_config_generator.command_tree import build_tree, CommandTree
+from ubiquiti_config_generator.nodes.validatable import hash_commands
 from ubiquiti_config_generator.nodes import (
     GlobalSettings,
     PortGroup,
@@ -34,30 +37,58 @@ class RootNode:
         self.external_addresses = external_addresses
         self.networks = networks
         self.nat = nat
+        self._address_groups = None
+
+    @property
+    def address_groups(self) -> AddressGroupRegistry:
+        """
+        The address groups, their members and the rules referencing them
+        """
+        if self._address_groups is None:
+            self._address_groups = AddressGroupRegistry.from_configuration(
+                self.global_settings, self.external_addresses, self.networks, self.nat
+            )
+
+        return self._address_groups
+
+    def refresh_address_groups(self) -> AddressGroupRegistry:
+        """
+        Rebuild the address group registry, e.g. after hosts or rules are changed
+        """
+        self._address_groups = None
+        return self.address_groups
 
     @classmethod
-    def create_from_configs(cls, config_path: str):
+    def create_from_configs(
+        cls, config_path: str, network_names: Optional[Set[str]] = None
+    ):
         """
         Load configuration from files
+        If network names are given, only those networks have their firewalls loaded
+        Hosts are always loaded, since they add NAT rules and address groups
         """
         nat = NAT(config_path)
-        return cls(
+        networks = []
+        for network_folder in file_paths.get_folders_with_config(
+            [config_path, file_paths.NETWORK_FOLDER]
+        ):
+            network_name = network_folder.split(path.sep)[-2]
+            network_config = file_paths.load_yaml_from_file(network_folder)
+            if network_names is not None and network_name not in network_names:
+                network_config["firewalls"] = []
+
+            networks.append(Network(network_name, nat, config_path, **network_config))
+
+        root_node = cls(
             secondary_configs.get_global_configuration(config_path),
             secondary_configs.get_port_groups(config_path),
             secondary_configs.get_external_addresses(config_path),
-            [
-                Network(
-                    network_folder.split(path.sep)[-2],
-                    nat,
-                    config_path,
-                    **(file_paths.load_yaml_from_file(network_folder))
-                )
-                for network_folder in file_paths.get_folders_with_config(
-                    [config_path, file_paths.NETWORK_FOLDER]
-                )
-            ],
+            networks,
             nat,
         )
+        # Build the address group index up front, while loading
+        root_node.refresh_address_groups()
+        return root_node
 
     def is_valid(self) -> bool:
         """
@@ -86,6 +117,7 @@ class RootNode:
         port_groups_consistent = [group.is_consistent() for group in self.port_groups]
         networks_consistent = [network.is_consistent() for network in self.networks]
         nat_consistent = self.nat.is_consistent()
+        address_groups_consistent = self.address_groups_consistent()
 
         networks_consistent = all(networks_consistent) and True
 
@@ -121,8 +153,22 @@ class RootNode:
             and all(port_groups_consistent)
             and networks_consistent
             and nat_consistent
+            and address_groups_consistent
         )
 
+    def address_groups_consistent(self) -> bool:
+        """
+        Check that every address group used by a rule is defined somewhere
+        """
+        undefined_groups = self.address_groups.undefined_groups()
+        for group, rules in undefined_groups.items():
+            for rule in rules:
+                rule.add_validation_error(
+                    "{0} uses undefined address group {1}".format(str(rule), group)
+                )
+
+        return not undefined_groups
+
     def validate(self) -> bool:
         """
         Is the root node valid
@@ -148,7 +194,9 @@ class RootNode:
 
         return failures
 
-    def get_commands(self) -> Tuple[List[List[str]], List[str]]:
+    def get_commands(
+        self, network_names: Optional[Set[str]] = None
+    ) -> Tuple[List[List[str]], List[str]]:
         """
         Returns the commands to generate this configuration
 
@@ -156,6 +204,7 @@ class RootNode:
         distinct portions which need to be committed in-order
         Second value is a flat list of all commands, for comparison against
         the previous configuration, to check for needed deletions
+        If network names are given, only those networks' commands are included
         """
         # These 3 should just be a list of commands, since ordering won't matter
         external_addresses = self.external_addresses.commands()
@@ -166,21 +215,8 @@ class RootNode:
         nat_commands = self.nat.commands()
 
         # Address groups are used in NAT and firewall rules, which are set prior to
-        # the host being parsed. To avoid chicken and egg problems, just pull out
-        # the address groups here instead, which is sub-optimal for efficiency but
-        # necessary to avoid breaking at runtime
-        address_groups = []
-        for network in self.networks:
-            for host in network.hosts:
-                if hasattr(host, "address-groups"):
-                    address_groups.extend(
-                        [
-                            "firewall group address-group {0} address {1}".format(
-                                group, host.address
-                            )
-                            for group in getattr(host, "address-groups")
-                        ]
-                    )
+        # the host being parsed, so they are collected by the registry instead
+        address_groups = self.address_groups.commands()
 
         ordered_commands = [
             [*external_addresses, *port_groups, *address_groups],
@@ -188,12 +224,18 @@ class RootNode:
             nat_commands,
         ]
 
-        all_commands = external_addresses + port_groups + global_settings + nat_commands
+        all_commands = (
+            external_addresses
+            + port_groups
+            + address_groups
+            + global_settings
+            + nat_commands
+        )
 
         # Group ordered network commands together, extending the list of ordered
         # commands by all of them after they've all been created
         network_ordered_commands = []
-        for network in self.networks:
+        for network in self.get_networks(network_names):
             net_ordered_commands, net_command_list = network.commands()
             all_commands.extend(net_command_list)
 
@@ -206,3 +248,34 @@ class RootNode:
         ordered_commands.extend(network_ordered_commands)
 
         return (ordered_commands, all_commands)
+
+    def content_hash(self) -> str:
+        """
+        A hash of every command this configuration generates, which only changes
+        if the configuration itself does, not e.g. the formatting of its files
+        """
+        return hash_commands(self.get_commands()[1])
+
+    def get_command_tree(
+        self,
+        command_list: Optional[List[str]] = None,
+        network_names: Optional[Set[str]] = None,
+    ) -> CommandTree:
+        """
+        Returns the commands of this configuration, grouped by the nodes
+        generating them, for skipping unchanged nodes when diffing
+        The flat list of commands is generated if not provided
+        """
+        if command_list is None:
+            command_list = self.get_commands(network_names)[1]
+
+        return build_tree(self, command_list, self.get_networks(network_names))
+
+    def get_networks(self, network_names: Optional[Set[str]] = None) -> List[Network]:
+        """
+        The networks in this configuration, optionally only those with given names
+        """
+        if network_names is None:
+            return self.networks
+
+        return [network for network in self.networks if network.name in network_names]
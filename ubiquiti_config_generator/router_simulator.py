@@ -0,0 +1,362 @@
+"""
+Simulates a router for dry-run deployments, on top of the fake router
+
+Scripts sent to it run in a local bash, with the configuration wrapper replaced
+by one applying each command to an in-memory configuration over a pair of
+named pipes, so deployments can run end-to-end without a real router, and
+the time spent in each commit can be measured.
+"""
+from dataclasses import dataclass
+import os
+import re
+import shlex
+import stat
+import subprocess
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+import paramiko
+
+from ubiquiti_config_generator.github import phase_packing
+from ubiquiti_config_generator.testing_router import CommandResult, FakeRouter
+
+# Keys which can have several values at once, like multi nodes on the router
+# The schema is not known, so any key set more than once in the same session is
+# also assumed to have several values, and setting any other key replaces its value
+MULTI_VALUE_KEYS = [
+    re.compile(
+        r"^firewall group (address|network|port)-group \S+ (address|network|port)$"
+    ),
+    re.compile(r"^system name-server$"),
+    re.compile(r"^service dns forwarding (name-server|listen-on)$"),
+    re.compile(r"^interfaces .* address$"),
+    re.compile(r"^service dhcp-server .* dns-server$"),
+]
+SCRIPT_TIMEOUT_SECONDS = 600
+
+CFG_WRAPPER = """#!/bin/bash
+printf '%q ' "$@" > "{request}"
+{{ read -r status; IFS= read -r -d '' output; }} < "{response}"
+[ -n "$output" ] && printf '%s\\n' "$output"
+exit "$status"
+"""
+# Scheduling a reboot runs an absolute path through sudo and sg, so record it
+# instead of running it
+SG = """#!/bin/bash
+"{cfg_wrapper}" commit-confirm "$@"
+"""
+SUDO = """#!/bin/bash
+exec "$@"
+"""
+VBASH = """#!/bin/bash
+exec bash "$@"
+"""
+
+
+@dataclass
+class CommitRecord:
+    """
+    A commit made on the simulated router
+    """
+
+    commands: int
+    seconds: float
+    succeeded: bool
+
+
+def is_multi_value_key(key: str) -> bool:
+    """
+    Whether a key can have several values at once
+    """
+    return any([pattern.match(key) for pattern in MULTI_VALUE_KEYS])
+
+
+def to_command(tokens: List[str]) -> str:
+    """
+    Joins tokens into a command, quoting them as the router does
+    """
+    return " ".join([shlex.quote(token) for token in tokens])
+
+
+class RouterSimulator(FakeRouter):
+    """
+    A fake router running deployment scripts against an in-memory configuration
+
+    Command files must be written under its directory, and scripts must use its
+    configuration wrapper, so set command-file-path and script-cfg-path to
+    directory and cfg_wrapper_path
+    """
+
+    def __init__(self, directory: str, commit_delay_seconds: float = 0):
+        super().__init__()
+        self.directory = directory
+        self.commit_delay_seconds = commit_delay_seconds
+        # The values of each key, for the running, saved and session configurations
+        self.running: Dict[str, List[str]] = {}
+        self.saved: Dict[str, List[str]] = {}
+        self.session: Optional[Dict[str, List[str]]] = None
+        # Keys set in the current session
+        self.session_keys: Set[str] = set()
+        self.wrapper_calls: List[List[str]] = []
+        self.commits: List[CommitRecord] = []
+        self.reboot_minutes: Optional[int] = None
+        self.phase_commands = 0
+        self.phase_started = time.perf_counter()
+
+        bin_path = os.path.join(directory, "bin")
+        os.makedirs(bin_path)
+        self.request_path = os.path.join(directory, "wrapper-request")
+        self.response_path = os.path.join(directory, "wrapper-response")
+        os.mkfifo(self.request_path)
+        os.mkfifo(self.response_path)
+
+        self.cfg_wrapper_path = os.path.join(bin_path, "vyatta-cfg-cmd-wrapper")
+        self.path = bin_path + os.pathsep + os.environ.get("PATH", "")
+        for name, script in {
+            "vyatta-cfg-cmd-wrapper": CFG_WRAPPER,
+            "sg": SG,
+            "sudo": SUDO,
+            "vbash": VBASH,
+        }.items():
+            script_path = os.path.join(bin_path, name)
+            with open(script_path, "w") as script_file:
+                script_file.write(
+                    script.format(
+                        request=self.request_path,
+                        response=self.response_path,
+                        cfg_wrapper=self.cfg_wrapper_path,
+                    )
+                )
+            os.chmod(script_path, stat.S_IRWXU)
+
+        self.command_handlers.update(
+            {
+                "bash": self.run_script,
+                "vbash": self.run_script,
+                "vyatta-op-cmd-wrapper": self.run_op_command,
+            }
+        )
+
+    def load_commands(self, commands: List[str]) -> None:
+        """
+        Sets the running and saved configuration to generated commands
+        """
+        self.running = {}
+        keys = set()
+        for command in commands:
+            self.set_value(self.running, shlex.split(command), keys)
+        self.saved = self.copy(self.running)
+
+    def get_commands(self) -> List[str]:
+        """
+        The commands of the running configuration, as the router shows them
+        """
+        return [
+            to_command(key.split(" ") + [value])
+            for key in sorted(self.running)
+            for value in self.running[key]
+        ]
+
+    def run_command(self, channel: paramiko.Channel, command: str) -> None:
+        """
+        Runs a command, finding vbash the same way the deployment scripts do
+        Replacing the shell is not simulated, so the script runs in its place
+        """
+        command = command.replace("$(which vbash)", "vbash")
+        if command.startswith("exec "):
+            command = command[len("exec ") :]
+        super().run_command(channel, command)
+
+    # pylint: disable=unused-argument
+    def run_op_command(
+        self, router: FakeRouter, arguments: List[str], stdin
+    ) -> CommandResult:
+        """
+        Runs an operational command, of which only showing the configuration works
+        """
+        if arguments != ["show", "configuration", "commands"]:
+            return (1, "", "Invalid command\n")
+
+        return (
+            0,
+            "".join([f"set {command}\n" for command in self.get_commands()]),
+            "",
+        )
+
+    # pylint: disable=unused-argument
+    def run_script(
+        self, router: FakeRouter, arguments: List[str], stdin
+    ) -> CommandResult:
+        """
+        Runs a script in a local bash, with the files sent to the router
+        """
+        for file_path, file_data in self.files.items():
+            if os.path.dirname(file_path) == self.directory:
+                with open(file_path, "wb") as local_file:
+                    local_file.write(bytes(file_data))
+
+        # The PID of the shell is passed as $$, which becomes the script's own PID
+        # when the shell is replaced by it
+        script_command = "exec bash " + " ".join(
+            [
+                argument if argument == "$$" else shlex.quote(argument)
+                for argument in arguments
+            ]
+        )
+        server = threading.Thread(target=self.serve_wrapper, daemon=True)
+        server.start()
+        try:
+            result = subprocess.run(
+                ["bash", "-c", script_command],
+                capture_output=True,
+                stdin=subprocess.DEVNULL,
+                env={**os.environ, "PATH": self.path},
+                timeout=SCRIPT_TIMEOUT_SECONDS,
+                check=False,
+            )
+        finally:
+            # An empty request stops the server
+            with open(self.request_path, "w"):
+                pass
+            server.join()
+
+        # Scripts stopped by a signal exit as a shell reports them
+        status = (
+            result.returncode if result.returncode >= 0 else 128 - result.returncode
+        )
+        return (status, result.stdout.decode(), result.stderr.decode())
+
+    def serve_wrapper(self) -> None:
+        """
+        Answers the configuration wrapper until an empty request is sent
+        """
+        while True:
+            with open(self.request_path) as request_file:
+                request = request_file.read()
+            if not request.strip():
+                return
+
+            status, output = self.run_wrapper(shlex.split(request))
+            with open(self.response_path, "w") as response_file:
+                response_file.write(f"{status}\n{output}")
+
+    def run_wrapper(self, arguments: List[str]) -> Tuple[int, str]:
+        """
+        Runs a configuration wrapper command, returning its status and output
+        """
+        self.wrapper_calls.append(arguments)
+        action = arguments[0]
+        if action == "commit-confirm":
+            minutes = re.search(r"--minutes=(\d+)", " ".join(arguments))
+            self.reboot_minutes = int(minutes.group(1)) if minutes else None
+            return (0, "")
+        if action == "begin":
+            self.session = self.copy(self.running)
+            self.session_keys = set()
+            self.phase_commands = 0
+            self.phase_started = time.perf_counter()
+            return (0, "")
+        if self.session is None:
+            return (1, "Not in a configuration session")
+        if action in ["set", "delete"]:
+            self.phase_commands += 1
+            if action == "set":
+                self.set_value(self.session, arguments[1:], self.session_keys)
+                return (0, "")
+            return self.delete_path(arguments[1:])
+        if action == "commit":
+            return self.commit()
+        if action == "discard":
+            self.session = self.copy(self.running)
+            self.session_keys = set()
+            return (0, "")
+        if action == "save":
+            self.saved = self.copy(self.running)
+            return (0, "")
+        if action == "end":
+            self.session = None
+            return (0, "")
+
+        return (1, f"Invalid action {action}")
+
+    def commit(self) -> Tuple[int, str]:
+        """
+        Commits the session, if everything referenced in it exists
+        """
+        time.sleep(self.commit_delay_seconds)
+        provided = set()
+        required = set()
+        for key, values in self.session.items():
+            for value in values:
+                provides, requires = phase_packing.get_command_resources(
+                    key + " " + value
+                )
+                provided.update(provides)
+                required.update(requires)
+
+        missing = sorted(required - provided)
+        succeeded = not missing
+        if succeeded:
+            self.running = self.copy(self.session)
+        self.commits.append(
+            CommitRecord(
+                self.phase_commands, time.perf_counter() - self.phase_started, succeeded
+            )
+        )
+        self.phase_commands = 0
+        self.phase_started = time.perf_counter()
+
+        if not succeeded:
+            return (1, "Commit failed, missing " + ", ".join(missing))
+        return (0, "")
+
+    def delete_path(self, tokens: List[str]) -> Tuple[int, str]:
+        """
+        Deletes every value at or under a path in the session
+        """
+        prefix = " ".join(tokens)
+        deleted = False
+        for key in list(self.session.keys()):
+            values = self.session[key]
+            remaining = [
+                value
+                for value in values
+                if not (
+                    f"{key} {value}" == prefix
+                    or f"{key} {value}".startswith(prefix + " ")
+                    or f"{key} ".startswith(prefix + " ")
+                )
+            ]
+            if len(remaining) != len(values):
+                deleted = True
+                if remaining:
+                    self.session[key] = remaining
+                else:
+                    del self.session[key]
+
+        if not deleted:
+            return (1, "Nothing to delete (the specified node does not exist)")
+        return (0, "")
+
+    @staticmethod
+    def set_value(
+        configuration: Dict[str, List[str]], tokens: List[str], set_keys: Set[str]
+    ) -> None:
+        """
+        Sets a value in a configuration, alongside others if the key allows it,
+        given the keys already set in the same session
+        """
+        key = " ".join(tokens[:-1])
+        if not is_multi_value_key(key) and key not in set_keys:
+            configuration[key] = [tokens[-1]]
+            set_keys.add(key)
+        elif tokens[-1] not in configuration.setdefault(key, []):
+            configuration[key].append(tokens[-1])
+
+    @staticmethod
+    def copy(configuration: Dict[str, List[str]]) -> Dict[str, List[str]]:
+        """
+        Copies a configuration
+        """
+        return {key: list(values) for key, values in configuration.items()}
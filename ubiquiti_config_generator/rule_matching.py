@@ -0,0 +1,252 @@
+"""
+Matches firewall rules between configurations by their content rather than number
+
+Rules without an explicit number are numbered in the order they are added, so
+adding a host shifts the numbers of every rule added after it. Matching rules by
+content lets the unchanged rules keep their previous numbers, so only the rules
+actually added or removed need changing on the router.
+"""
+import json
+from typing import Dict, List, Optional, Tuple
+
+from ubiquiti_config_generator.nodes.firewall import Firewall
+from ubiquiti_config_generator.nodes.rule import Rule
+
+# A rule number, and the content of the rule with that number
+RuleContents = List[Tuple[int, str]]
+
+
+def get_rule_content(rule: Rule) -> str:
+    """
+    A representation of everything about a rule except its number
+    """
+    return json.dumps(
+        {
+            attribute: getattr(rule, attribute)
+            for attribute in rule.attributes()
+            if attribute != "number"
+        },
+        sort_keys=True,
+        default=str,
+    )
+
+
+def get_rule_contents(firewall: Firewall) -> RuleContents:
+    """
+    The numbers and contents of the rules of a firewall, in number order
+    """
+    return sorted(
+        [(int(rule.number), get_rule_content(rule)) for rule in firewall.rules],
+        key=lambda rule: rule[0],
+    )
+
+
+def get_configuration_rules(root_node) -> Dict[str, RuleContents]:
+    """
+    The rule numbers and contents of every firewall in a configuration
+    """
+    return {
+        firewall.name: get_rule_contents(firewall)
+        for network in root_node.networks
+        for firewall in network.firewalls
+    }
+
+
+def match_sequences(current: List[str], previous: List[str]) -> Dict[int, int]:
+    """
+    Finds the longest common subsequence of two lists,
+    returning the index in the previous list for each matched current index
+
+    Adding or removing rules leaves the rest in the same order, so the unchanged
+    start and end are matched directly before comparing what remains
+    """
+    start = 0
+    while (
+        start < len(current)
+        and start < len(previous)
+        and current[start] == previous[start]
+    ):
+        start += 1
+
+    end = 0
+    while (
+        end < len(current) - start
+        and end < len(previous) - start
+        and current[-end - 1] == previous[-end - 1]
+    ):
+        end += 1
+
+    matches = {index: index for index in range(start)}
+    current_middle = current[start : len(current) - end]
+    previous_middle = previous[start : len(previous) - end]
+
+    # Lengths of the common subsequences of the remaining suffixes
+    lengths = [[0] * (len(previous_middle) + 1) for _ in range(len(current_middle) + 1)]
+    for current_index in range(len(current_middle) - 1, -1, -1):
+        for previous_index in range(len(previous_middle) - 1, -1, -1):
+            if current_middle[current_index] == previous_middle[previous_index]:
+                lengths[current_index][previous_index] = (
+                    lengths[current_index + 1][previous_index + 1] + 1
+                )
+            else:
+                lengths[current_index][previous_index] = max(
+                    lengths[current_index + 1][previous_index],
+                    lengths[current_index][previous_index + 1],
+                )
+
+    current_index = 0
+    previous_index = 0
+    while current_index < len(current_middle) and previous_index < len(previous_middle):
+        if current_middle[current_index] == previous_middle[previous_index]:
+            matches[start + current_index] = start + previous_index
+            current_index += 1
+            previous_index += 1
+        elif (
+            lengths[current_index + 1][previous_index]
+            >= lengths[current_index][previous_index + 1]
+        ):
+            current_index += 1
+        else:
+            previous_index += 1
+
+    for offset in range(1, end + 1):
+        matches[len(current) - offset] = len(previous) - offset
+
+    return matches
+
+
+def spread_numbers(
+    count: int, lower: int, upper: Optional[int], preferred: List[int], step: int
+) -> Optional[List[int]]:
+    """
+    Picks increasing numbers strictly between two bounds for unmatched rules,
+    using the preferred numbers if they fit
+    """
+    if all(
+        [number > lower and (upper is None or number < upper) for number in preferred]
+    ):
+        return preferred
+
+    if upper is not None:
+        step = (upper - lower) // (count + 1)
+        if step < 1:
+            return None
+
+    return [lower + step * (index + 1) for index in range(count)]
+
+
+# pylint: disable=too-many-branches
+def pin_rule_numbers(firewall: Firewall, previous_rules: RuleContents) -> int:
+    """
+    Gives automatically-numbered rules matching a previous rule its number,
+    keeping the rules in the same order and renumbering the rest around them
+    Explicitly-numbered rules are never changed
+    Returns how many rules were renumbered
+    """
+    rules = sorted(firewall.rules, key=lambda rule: int(rule.number))
+    matches = match_sequences(
+        [get_rule_content(rule) for rule in rules],
+        [content for _, content in previous_rules],
+    )
+    # The next explicit number at or after each rule, which matched numbers
+    # must stay below
+    next_explicit: List[Optional[int]] = [None] * len(rules)
+    explicit_number = None
+    for index in range(len(rules) - 1, -1, -1):
+        if not rules[index].is_auto_numbered():
+            explicit_number = int(rules[index].number)
+        next_explicit[index] = explicit_number
+
+    # Keep matched numbers only while they stay in order and leave room
+    # for the unmatched rules before them
+    numbers: List[Optional[int]] = []
+    last_number = 0
+    unmatched = 0
+    for index, rule in enumerate(rules):
+        if not rule.is_auto_numbered():
+            number = int(rule.number)
+            # Explicit numbers are already in order, so this can only happen
+            # if there is no room left for the rules before it
+            if number - last_number <= unmatched:
+                return 0
+        elif index in matches:
+            number = previous_rules[matches[index]][0]
+            if number - last_number <= unmatched or (
+                next_explicit[index] is not None and number >= next_explicit[index]
+            ):
+                number = None
+        else:
+            number = None
+
+        numbers.append(number)
+        if number is None:
+            unmatched += 1
+        else:
+            last_number = number
+            unmatched = 0
+
+    # Fill in the rest between the numbers kept
+    index = 0
+    while index < len(rules):
+        if numbers[index] is not None:
+            index += 1
+            continue
+
+        end = index
+        while end < len(rules) and numbers[end] is None:
+            end += 1
+
+        lower = numbers[index - 1] if index else 0
+        upper = numbers[end] if end < len(rules) else None
+        # Nothing else can be numbered between the bounds, so the current
+        # numbers can be kept if they fit
+        filled = spread_numbers(
+            end - index,
+            lower,
+            upper,
+            [int(rule.number) for rule in rules[index:end]],
+            int(getattr(firewall, "auto-increment")),
+        )
+        if filled is None:
+            return 0
+
+        numbers[index:end] = filled
+        index = end
+
+    renumbered = 0
+    for rule, number in zip(rules, numbers):
+        if int(rule.number) != number:
+            rule.number = number
+            renumbered += 1
+
+    return renumbered
+
+
+def pin_configuration_rules(root_node, previous_rules: Dict[str, RuleContents]) -> int:
+    """
+    Pins the rule numbers of every firewall also in the previous configuration
+    Returns how many rules were renumbered
+    """
+    return sum(
+        [
+            pin_rule_numbers(firewall, previous_rules[firewall.name])
+            for network in root_node.networks
+            for firewall in network.firewalls
+            if firewall.name in previous_rules
+        ]
+    )
+
+
+def get_stale_rule_numbers(
+    firewall: Firewall, previous_rules: RuleContents
+) -> List[int]:
+    """
+    Numbers of previous rules that are gone or different in a firewall,
+    which need deleting so none of their properties are left behind
+    """
+    current_rules = set(get_rule_contents(firewall))
+    return [
+        number
+        for number, content in previous_rules
+        if (number, content) not in current_rules
+    ]
@@ -0,0 +1,218 @@
+"""
+Compacts firewall rules, merging rules which differ only in a single address or
+port into one rule matching an automatically-generated group
+"""
+from dataclasses import dataclass, field
+import hashlib
+import json
+import shlex
+from typing import List, Optional, Tuple
+
+from ubiquiti_config_generator import type_checker
+from ubiquiti_config_generator.nodes.rule import Rule
+
+# The connection and property which may vary between merged rules,
+# in order of preference when several could be merged
+# The router rejects group names longer than this
+MAX_GROUP_NAME_LENGTH = 31
+# Characters of the name's hash kept when shortening it, to keep it unique
+GROUP_NAME_HASH_LENGTH = 8
+
+MERGEABLE_FIELDS = [
+    (type_checker.SOURCE, type_checker.ADDRESS),
+    (type_checker.DESTINATION, type_checker.ADDRESS),
+    (type_checker.SOURCE, type_checker.PORT),
+    (type_checker.DESTINATION, type_checker.PORT),
+]
+
+
+@dataclass
+class RuleOptimization:
+    """
+    The result of optimizing the rules of a firewall
+    """
+
+    rules: List[Rule]
+    group_commands: List[str] = field(default_factory=list)
+    original_rule_count: int = 0
+
+    @property
+    def rules_saved(self) -> int:
+        """
+        How many fewer rules the router needs to evaluate
+        """
+        return self.original_rule_count - len(self.rules)
+
+    def summary(self) -> str:
+        """
+        A description of the optimization
+        """
+        return "Combined {0} rules into {1}, saving {2}".format(
+            self.original_rule_count, len(self.rules), self.rules_saved
+        )
+
+
+def is_mergeable_value(rule_field: Tuple[str, str], value) -> bool:
+    """
+    Can a value be put into a generated group
+    Only plain addresses and ports can - groups cannot be nested, and networks
+    would need a network group instead
+    """
+    if rule_field[1] == type_checker.ADDRESS:
+        return type_checker.is_ip_address(value)
+
+    return type_checker.is_number(value)
+
+
+def get_field_value(rule: Rule, rule_field: Tuple[str, str]) -> Optional[str]:
+    """
+    Gets the value of an address or port from a rule, if it is mergeable
+    """
+    value = getattr(rule, rule_field[0], {}).get(rule_field[1], None)
+    return (
+        value if value is not None and is_mergeable_value(rule_field, value) else None
+    )
+
+
+def get_rule_signature(rule: Rule, rule_field: Tuple[str, str]) -> str:
+    """
+    Gets everything that determines what a rule matches or does, except its number,
+    description, and the given field which is allowed to differ between merged rules
+    """
+    properties = {}
+    for attribute in rule.attributes():
+        if attribute in ["number", "description"]:
+            continue
+
+        value = getattr(rule, attribute)
+        if attribute == rule_field[0]:
+            value = {key: data for key, data in value.items() if key != rule_field[1]}
+
+        properties[attribute] = value
+
+    return json.dumps(properties, sort_keys=True, default=str)
+
+
+def get_mergeable_run_end(
+    rules: List[Rule], start: int, rule_field: Tuple[str, str]
+) -> int:
+    """
+    Finds the index after the last consecutive rule that can be merged with the rule
+    at the start index, by varying the given field
+    """
+    if get_field_value(rules[start], rule_field) is None:
+        return start + 1
+
+    signature = get_rule_signature(rules[start], rule_field)
+    end = start + 1
+    while (
+        end < len(rules)
+        and get_field_value(rules[end], rule_field) is not None
+        and get_rule_signature(rules[end], rule_field) == signature
+    ):
+        end += 1
+
+    return end
+
+
+def get_group_name(
+    firewall_name: str, rule_number: int, rule_field: Tuple[str, str]
+) -> str:
+    """
+    Names the group generated for a merged rule, shortening it to a prefix and
+    a hash of the full name if it is too long for the router
+    """
+    group_name = "{0}-{1}-{2}-{3}".format(firewall_name, rule_number, *rule_field)
+    if len(group_name) <= MAX_GROUP_NAME_LENGTH:
+        return group_name
+
+    name_hash = hashlib.sha256(group_name.encode()).hexdigest()
+    prefix_length = MAX_GROUP_NAME_LENGTH - GROUP_NAME_HASH_LENGTH - 1
+    return (
+        group_name[:prefix_length].rstrip("-")
+        + "-"
+        + name_hash[:GROUP_NAME_HASH_LENGTH]
+    )
+
+
+def merge_rules(
+    firewall_name: str, rules: List[Rule], rule_field: Tuple[str, str]
+) -> Tuple[Rule, List[str]]:
+    """
+    Merges rules into the first one, replacing the varying field with a group
+    Returns the merged rule and the commands to create the group
+    """
+    first_rule = rules[0]
+    connection, kind = rule_field
+    group_type = "address-group" if kind == type_checker.ADDRESS else "port-group"
+    group_name = get_group_name(firewall_name, first_rule.number, rule_field)
+    # Preserve order, but drop any duplicate values
+    values = list(dict.fromkeys([get_field_value(rule, rule_field) for rule in rules]))
+
+    properties = {
+        attribute: getattr(first_rule, attribute)
+        for attribute in first_rule.attributes()
+        if attribute != "number"
+    }
+    properties[connection] = {**properties[connection], kind: group_name}
+
+    descriptions = list(
+        dict.fromkeys([getattr(rule, "description", None) for rule in rules])
+    )
+    description = "Combined rules " + ", ".join([str(rule.number) for rule in rules])
+    if len(descriptions) == 1 and descriptions[0]:
+        description = descriptions[0]
+    properties["description"] = description
+
+    group_base = "firewall group {0} {1} ".format(group_type, group_name)
+    group_commands = [group_base + "{0} {1}".format(kind, value) for value in values]
+    group_commands.append(
+        group_base
+        + "description "
+        + shlex.quote("Generated for firewall {0}".format(firewall_name))
+    )
+
+    return (
+        Rule(
+            first_rule.number,
+            first_rule.firewall_name,
+            first_rule.config_path,
+            **properties
+        ),
+        group_commands,
+    )
+
+
+def optimize_rules(firewall_name: str, rules: List[Rule]) -> RuleOptimization:
+    """
+    Merges runs of consecutive rules that are identical except for one address or
+    port into a single rule using a group
+
+    Only rules adjacent in rule number order are merged, and they share an action,
+    so the first rule a packet matches still results in the same action
+    """
+    ordered_rules = sorted(rules, key=lambda rule: int(rule.number))
+    optimization = RuleOptimization([], [], len(ordered_rules))
+
+    index = 0
+    while index < len(ordered_rules):
+        best_field = None
+        best_end = index + 1
+        for rule_field in MERGEABLE_FIELDS:
+            end = get_mergeable_run_end(ordered_rules, index, rule_field)
+            if end > best_end:
+                best_field = rule_field
+                best_end = end
+
+        if best_field is None:
+            optimization.rules.append(ordered_rules[index])
+        else:
+            merged_rule, group_commands = merge_rules(
+                firewall_name, ordered_rules[index:best_end], best_field
+            )
+            optimization.rules.append(merged_rule)
+            optimization.group_commands.extend(group_commands)
+
+        index = best_end
+
+    return optimization
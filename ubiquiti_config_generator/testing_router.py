@@ -0,0 +1,286 @@
+"""
+A fake router for testing, serving SSH and SFTP in-process over a socket pair
+Files are kept in memory, and commands are run by handlers registered by name
+"""
+import hashlib
+import io
+import os
+import shlex
+import socket
+import tarfile
+import threading
+import traceback
+from typing import BinaryIO, Callable, Dict, List, Tuple
+
+import paramiko
+
+# Exit code, standard output and standard error of a command
+CommandResult = Tuple[int, str, str]
+CommandHandler = Callable[["FakeRouter", List[str], BinaryIO], CommandResult]
+COMMAND_DELAY_SECONDS = 0.01
+
+
+def sha256sum(
+    router: "FakeRouter", arguments: List[str], stdin: BinaryIO
+) -> CommandResult:
+    """
+    Checksums files, or standard input if none are given, like sha256sum
+    """
+    file_paths = [argument for argument in arguments if argument != "--"]
+    if not file_paths:
+        return (0, f"{hashlib.sha256(stdin.read()).hexdigest()}  -\n", "")
+
+    status = 0
+    output = ""
+    errors = ""
+    for file_path in file_paths:
+        if file_path not in router.files:
+            status = 1
+            errors += f"sha256sum: {file_path}: No such file or directory\n"
+            continue
+
+        checksum = hashlib.sha256(bytes(router.files[file_path])).hexdigest()
+        output += f"{checksum}  {file_path}\n"
+
+    return (status, output, errors)
+
+
+def tar(router: "FakeRouter", arguments: List[str], stdin: BinaryIO) -> CommandResult:
+    """
+    Extracts a tar archive from standard input, like tar -xzf - -C <directory>
+    """
+    directory = arguments[arguments.index("-C") + 1] if "-C" in arguments else "/"
+    try:
+        with tarfile.open(fileobj=io.BytesIO(stdin.read()), mode="r:*") as archive:
+            for member in archive.getmembers():
+                router.files[
+                    os.path.normpath(os.path.join(directory, member.name))
+                ] = bytearray(archive.extractfile(member).read())
+    except tarfile.TarError as error:
+        return (2, "", f"tar: {error}\n")
+
+    return (0, "", "")
+
+
+class FakeRouterFile(paramiko.SFTPHandle):
+    """
+    An open file on the fake router
+    """
+
+    def __init__(self, router: "FakeRouter", file_path: str, flags: int):
+        super().__init__(flags)
+        self.router = router
+        self.file_path = file_path
+        if flags & os.O_TRUNC or file_path not in router.files:
+            router.files[file_path] = bytearray()
+
+    def write(self, offset: int, data: bytes) -> int:
+        contents = self.router.files[self.file_path]
+        if offset > len(contents):
+            contents.extend(b"\0" * (offset - len(contents)))
+        contents[offset : offset + len(data)] = data
+        self.router.writes.append(self.file_path)
+        return paramiko.SFTP_OK
+
+    def read(self, offset: int, length: int) -> bytes:
+        self.router.reads.append(self.file_path)
+        return bytes(self.router.files[self.file_path][offset : offset + length])
+
+    def stat(self) -> paramiko.SFTPAttributes:
+        return self.router.stat(self.file_path)
+
+
+class FakeSFTPServer(paramiko.SFTPServerInterface):
+    """
+    Serves the files of the fake router
+    """
+
+    def __init__(self, server: paramiko.ServerInterface, router: "FakeRouter"):
+        super().__init__(server)
+        self.router = router
+
+    def open(self, path: str, flags: int, attr: paramiko.SFTPAttributes):
+        writing = flags & (os.O_WRONLY | os.O_RDWR)
+        if path not in self.router.files and not writing:
+            return paramiko.SFTP_NO_SUCH_FILE
+
+        return FakeRouterFile(self.router, path, flags)
+
+    def stat(self, path: str):
+        if path not in self.router.files:
+            return paramiko.SFTP_NO_SUCH_FILE
+
+        return self.router.stat(path)
+
+    def lstat(self, path: str):
+        return self.stat(path)
+
+    def remove(self, path: str) -> int:
+        if path not in self.router.files:
+            return paramiko.SFTP_NO_SUCH_FILE
+
+        del self.router.files[path]
+        return paramiko.SFTP_OK
+
+
+class FakeRouterServer(paramiko.ServerInterface):
+    """
+    Accepts any password, and runs commands on the fake router
+    """
+
+    def __init__(self, router: "FakeRouter"):
+        self.router = router
+
+    def get_allowed_auths(self, username: str) -> str:
+        return "password"
+
+    def check_auth_password(self, username: str, password: str) -> int:
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind: str, chanid: int) -> int:
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    # pylint: disable=too-many-arguments
+    def check_channel_pty_request(
+        self, channel, term, width, height, pixelwidth, pixelheight, modes
+    ) -> bool:
+        return True
+
+    def check_channel_exec_request(self, channel: paramiko.Channel, command) -> bool:
+        # The request is only acknowledged after this returns, so give that a
+        # moment to be sent before any output or the channel being closed
+        timer = threading.Timer(
+            COMMAND_DELAY_SECONDS,
+            self.router.run_command,
+            args=(channel, command.decode()),
+        )
+        timer.daemon = True
+        timer.start()
+        return True
+
+
+class FakeRouter:
+    """
+    A router to connect to in tests
+    """
+
+    def __init__(self):
+        self.files: Dict[str, bytearray] = {}
+        # Every command run, and the files written to and read from in order
+        self.commands: List[str] = []
+        self.writes: List[str] = []
+        self.reads: List[str] = []
+        self.command_handlers: Dict[str, CommandHandler] = {
+            "sha256sum": sha256sum,
+            "tar": tar,
+        }
+        self.host_key = paramiko.RSAKey.generate(1024)
+        self.transports: List[paramiko.Transport] = []
+
+    def connect(self) -> paramiko.SSHClient:
+        """
+        Opens a new connection to the router
+        """
+        client_socket, server_socket = socket.socketpair()
+        transport = paramiko.Transport(server_socket)
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler(
+            "sftp", paramiko.SFTPServer, FakeSFTPServer, self
+        )
+        transport.start_server(threading.Event(), server=FakeRouterServer(self))
+        self.transports.append(transport)
+
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(
+            "router",
+            username="user",
+            password="password",
+            sock=client_socket,
+            look_for_keys=False,
+            allow_agent=False,
+        )
+        return client
+
+    def close(self) -> None:
+        """
+        Closes every connection to the router
+        """
+        for transport in self.transports:
+            transport.close()
+
+    def stat(self, file_path: str) -> paramiko.SFTPAttributes:
+        """
+        The attributes of a file
+        """
+        attributes = paramiko.SFTPAttributes()
+        attributes.filename = os.path.basename(file_path)
+        attributes.st_size = len(self.files[file_path])
+        attributes.st_mode = 0o100644
+        return attributes
+
+    def read_file(self, file_path: str) -> str:
+        """
+        The contents of a file
+        """
+        return bytes(self.files[file_path]).decode()
+
+    def run_command(self, channel: paramiko.Channel, command: str) -> None:
+        """
+        Runs a command with its handlers, sending back its output and exit code
+        Commands may be joined with && and piped into each other with |
+        """
+        self.commands.append(command)
+
+        status = 0
+        errors = ""
+        output = ""
+        # Only the first command reads from the channel, so commands which never
+        # read input do not wait for the end of it
+        stdin: BinaryIO = channel.makefile("rb")
+        try:
+            for pipeline in split_tokens(shlex.split(command), "&&"):
+                for arguments in split_tokens(pipeline, "|"):
+                    status, output, command_errors = self.run_handler(arguments, stdin)
+                    errors += command_errors
+                    stdin = io.BytesIO(output.encode())
+
+                if status != 0:
+                    break
+        # Always exit, so the caller does not wait forever
+        # pylint: disable=broad-except
+        except Exception:
+            status = 1
+            errors += traceback.format_exc()
+
+        channel.sendall(output.encode())
+        channel.sendall_stderr(errors.encode())
+        channel.send_exit_status(status)
+        channel.close()
+
+    def run_handler(self, arguments: List[str], stdin: BinaryIO) -> CommandResult:
+        """
+        Runs a single command with its handler
+        """
+        handler = self.command_handlers.get(os.path.basename(arguments[0]), None)
+        if handler is None:
+            return (127, "", f"{arguments[0]}: command not found\n")
+
+        return handler(self, arguments[1:], stdin)
+
+
+def split_tokens(tokens: List[str], separator: str) -> List[List[str]]:
+    """
+    Splits a list of tokens on a separator token
+    """
+    parts = [[]]
+    for token in tokens:
+        if token == separator:
+            parts.append([])
+        else:
+            parts[-1].append(token)
+
+    return parts
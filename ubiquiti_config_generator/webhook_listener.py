@@ -31,11 +31,36 @@ def authenticate(credentials: HTTPBasicCredentials = Depends(security)):
     """
     Checks the current user for authentication
     """
-    logging_config = file_paths.load_yaml_from_file("deploy.yaml")["logging"]
-    correct_user = secrets.compare_digest(credentials.username, logging_config["user"])
-    correct_pass = secrets.compare_digest(credentials.password, logging_config["pass"])
+    return check_credentials(credentials, "logging")
 
-    if not (correct_user and correct_pass):
+
+def authenticate_revert(credentials: HTTPBasicCredentials = Depends(security)):
+    """
+    Checks the current user can revert deployments, which has its own credentials
+    since it changes the router rather than only showing logs
+    """
+    return check_credentials(credentials, "revert")
+
+
+def check_credentials(credentials: HTTPBasicCredentials, section: str) -> str:
+    """
+    Checks credentials against those in a section of the deployment configuration,
+    which must be set
+    """
+    section_config = file_paths.load_yaml_from_file("deploy.yaml").get(section) or {}
+    correct_user = secrets.compare_digest(
+        credentials.username, str(section_config.get("user") or "")
+    )
+    correct_pass = secrets.compare_digest(
+        credentials.password, str(section_config.get("pass") or "")
+    )
+
+    if not (
+        section_config.get("user")
+        and section_config.get("pass")
+        and correct_user
+        and correct_pass
+    ):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
@@ -90,6 +115,50 @@ async def deployment_status(
     return render_deployment(revision1, revision2)
 
 
+# pylint: disable=unused-argument
+@app.post("/deployments/{revision1}/{revision2}/revert")
+async def revert_deployment(
+    revision1: str, revision2: str, username: str = Depends(authenticate_revert)
+):
+    """
+    Reverts a deployment on the router
+    """
+    return await asyncio.to_thread(run_revert, revision1, revision2)
+
+
+def run_revert(revision1: str, revision2: str) -> dict:
+    """
+    Runs the stored commands undoing a deployment, if it is the most recent
+    successful one
+    """
+    last_deployment = db.get_last_successful_deployment()
+    if last_deployment is None or (
+        last_deployment.from_revision,
+        last_deployment.to_revision,
+    ) != (revision1, revision2):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Only the most recent successful deployment can be reverted",
+        )
+
+    commands = db.get_revert_commands(revision1, revision2)
+    if commands is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            # None are stored when each router is planned against its own
+            # live configuration
+            detail="No revert commands stored for deployment",
+        )
+
+    succeeded = deployment.revert_deployment(
+        revision1,
+        revision2,
+        commands,
+        file_paths.load_yaml_from_file("deploy.yaml"),
+    )
+    return {"status": "success" if succeeded else "failure"}
+
+
 def render_check(revision: str) -> str:
     """
     Renders the check status page